@@ -4,6 +4,7 @@ from flask_cors import CORS
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 from dotenv import load_dotenv
+from sqlalchemy import event
 import os
 
 # Load environment variables from .env file
@@ -51,6 +52,8 @@ else:
     dbString = 'sqlite:///volumes/'
     dbURI = dbString + dbName + '.db'
     backupURI = dbString + dbName + '_bak.db'
+# Any other database, e.g. the throwaway SQLite file of the test suite
+dbURI = os.environ.get('SQLALCHEMY_DATABASE_URI') or dbURI
 
 app.config['DB_ENDPOINT'] = DB_ENDPOINT
 app.config['DB_USERNAME'] = DB_USERNAME
@@ -63,6 +66,18 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 db = SQLAlchemy(app)
 migrate = Migrate(app, db)
 
+# pysqlite only BEGINs before DML and lets SAVEPOINT open or RELEASE commit the transaction, which
+# breaks begin_nested() (best-effort order baskets); SQLAlchemy's recipe takes over the BEGIN
+with app.app_context():
+    if db.engine.dialect.name == 'sqlite':
+        @event.listens_for(db.engine, 'connect')
+        def _sqlite_connect(dbapi_connection, connection_record):
+            dbapi_connection.isolation_level = None
+
+        @event.listens_for(db.engine, 'begin')
+        def _sqlite_begin(connection):
+            connection.exec_driver_sql('BEGIN')
+
 # Image upload settings 
 app.config['MAX_CONTENT_LENGTH'] = 5 * 1024 * 1024  # maximum size of uploaded content
 app.config['UPLOAD_EXTENSIONS'] = ['.jpg', '.png', '.gif']  # supported file types
@@ -79,3 +94,55 @@ app.config['GITHUB_TARGET_NAME'] = os.environ.get('GITHUB_TARGET_NAME') or 'nigh
 app.config['KASM_SERVER'] = os.environ.get('KASM_SERVER') or 'https://kasm.nighthawkcodingsociety.com'
 app.config['KASM_API_KEY'] = os.environ.get('KASM_API_KEY') or None
 app.config['KASM_API_KEY_SECRET'] = os.environ.get('KASM_API_KEY_SECRET') or None
+
+# Cache settings
+app.config['CACHE_VERSION_CHECK_INTERVAL'] = float(os.environ.get('CACHE_VERSION_CHECK_INTERVAL') or 1.0)  # seconds between cross-worker cache version checks
+app.config['RESPONSE_CACHE_SIZE'] = int(os.environ.get('RESPONSE_CACHE_SIZE') or 256)  # cached response bodies per endpoint group, least recently used evicted
+app.config['PRINCIPAL_CACHE_TTL'] = float(os.environ.get('PRINCIPAL_CACHE_TTL') or 60)  # seconds an authenticated user's id, uid, name and role are cached
+app.config['PRINCIPAL_CACHE_SIZE'] = int(os.environ.get('PRINCIPAL_CACHE_SIZE') or 4096)  # cached principals per worker, least recently used evicted
+
+# Password hashing settings
+app.config['PASSWORD_HASH_METHOD'] = os.environ.get('PASSWORD_HASH_METHOD') or 'pbkdf2:sha256:1000000'  # werkzeug method with its work factor, as stored in the hash; older hashes are replaced at login
+app.config['PASSWORD_SALT_LENGTH'] = int(os.environ.get('PASSWORD_SALT_LENGTH') or 10)  # salt characters of new hashes
+app.config['PASSWORD_HASH_WORKERS'] = int(os.environ.get('PASSWORD_HASH_WORKERS') or 0)  # hashing processes per web worker, 0 hashes in the request thread; only a threaded (gthread) worker gains from a pool
+app.config['PASSWORD_HASH_QUEUE'] = int(os.environ.get('PASSWORD_HASH_QUEUE') or 64)  # hashes submitted at once, further requests wait for a slot
+app.config['PASSWORD_HASH_TIMEOUT'] = float(os.environ.get('PASSWORD_HASH_TIMEOUT') or 10)  # seconds to wait for a slot before answering 503
+
+# Stock game settings
+app.config['ORDER_MAX_RETRIES'] = int(os.environ.get('ORDER_MAX_RETRIES') or 3)  # retries of an order transaction on lock or unique conflicts
+app.config['ORDER_RETRY_BACKOFF'] = float(os.environ.get('ORDER_RETRY_BACKOFF') or 0.05)  # seconds, grows linearly per retry
+app.config['ORDER_BATCH_LIMIT'] = int(os.environ.get('ORDER_BATCH_LIMIT') or 100)  # maximum orders accepted by /stock/orders
+app.config['TAX_RATE_LONG_TERM'] = float(os.environ.get('TAX_RATE_LONG_TERM') or 0.20)  # tax on gains of lots held over one year
+app.config['ALERTS_PER_USER'] = int(os.environ.get('ALERTS_PER_USER') or 100)  # active price alerts a user may set
+app.config['TAX_RATE_SHORT_TERM'] = float(os.environ.get('TAX_RATE_SHORT_TERM') or 0.30)  # tax on gains of lots held one year or less
+app.config['ACCOUNT_EXPIRY_WEEKS'] = int(os.environ.get('ACCOUNT_EXPIRY_WEEKS') or 6)  # weeks an account trades before the expiry sweep freezes it
+
+# Market data settings
+app.config['QUOTE_BASE_URL'] = os.environ.get('QUOTE_BASE_URL') or 'https://financialmodelingprep.com/api/v3/quote'  # FMP-compatible quote endpoint, e.g. http://127.0.0.1:8099/api/v3/quote for scripts/quote_server.py
+app.config['FMP_API_KEY'] = os.environ.get('FMP_API_KEY') or 'xAxPbodLC12nNCwa5gHiK6YZVQecllPA'
+app.config['QUOTE_BATCH_SIZE'] = int(os.environ.get('QUOTE_BATCH_SIZE') or 50)  # symbols per quote request
+app.config['QUOTE_MAX_WORKERS'] = int(os.environ.get('QUOTE_MAX_WORKERS') or 4)  # concurrent quote requests
+app.config['STOCK_LOAD_BATCH_SIZE'] = int(os.environ.get('STOCK_LOAD_BATCH_SIZE') or 500)  # rows per upsert when loading the stock CSV
+app.config['QUOTE_TIMEOUT'] = float(os.environ.get('QUOTE_TIMEOUT') or 5)  # seconds per quote request
+app.config['PRICE_HISTORY_RETENTION_DAYS'] = int(os.environ.get('PRICE_HISTORY_RETENTION_DAYS') or 400)  # days of price history kept by prune_price_history, at least the 1d chart's default year
+
+# Price refresh scheduler settings
+app.config['PRICE_SCHEDULER_ENABLED'] = (os.environ.get('PRICE_SCHEDULER_ENABLED') or 'false').lower() == 'true'  # run the scheduler thread inside the web app
+app.config['PRICE_REFRESH_INTERVAL'] = float(os.environ.get('PRICE_REFRESH_INTERVAL') or 60)  # seconds between refresh runs
+app.config['PRICE_REFRESH_JITTER'] = float(os.environ.get('PRICE_REFRESH_JITTER') or 5)  # random seconds added to each interval
+app.config['PRICE_REFRESH_RATE_BUDGET'] = int(os.environ.get('PRICE_REFRESH_RATE_BUDGET') or 10)  # quote requests per minute
+app.config['PRICE_REFRESH_TRADED_WINDOW'] = int(os.environ.get('PRICE_REFRESH_TRADED_WINDOW') or 60)  # minutes a traded symbol stays prioritized
+app.config['PRICE_REFRESH_WATCH_TTL'] = int(os.environ.get('PRICE_REFRESH_WATCH_TTL') or 300)  # seconds a watched symbol stays prioritized
+
+# Simulated market settings
+app.config['PRICE_SOURCE'] = os.environ.get('PRICE_SOURCE') or 'live'  # 'live' quote feed or 'simulated' market
+app.config['SIM_TICK_INTERVAL'] = float(os.environ.get('SIM_TICK_INTERVAL') or 1.0)  # seconds between simulated ticks, may be below 1
+app.config['SIM_TIME_SCALE'] = float(os.environ.get('SIM_TIME_SCALE') or 60)  # simulated market seconds per wall second
+app.config['SIM_SEED'] = int(os.environ['SIM_SEED']) if os.environ.get('SIM_SEED') else None  # random seed, set for repeatable runs
+
+# Price stream settings
+app.config['STREAM_MAX_SUBSCRIBERS'] = int(os.environ.get('STREAM_MAX_SUBSCRIBERS') or 48)  # stream clients per worker, each holds a worker thread so keep it below gunicorn --threads
+app.config['STREAM_HEARTBEAT'] = float(os.environ.get('STREAM_HEARTBEAT') or 15)  # seconds between keepalive comments
+
+# Trade ledger settings
+app.config['LEDGER_SNAPSHOT_KEEP'] = int(os.environ.get('LEDGER_SNAPSHOT_KEEP') or 3)  # ledger snapshots kept, older ones are deleted
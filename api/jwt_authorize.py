@@ -1,8 +1,99 @@
 from flask import request
 from flask import current_app, g
 from functools import wraps
+from collections import OrderedDict
+import threading
+import time
 import jwt
-from model.user import User
+from model.cache import VersionStamp
+from model.user import PRINCIPAL, User
+
+
+class Principal:
+    '''
+    The authenticated user of a request, built from the principal cache.
+    id, uid, name and role are served from the cache, so auth and role checks cost no query.
+    Touching anything else (read(), update(), pfp, ...) loads the User row once for the request
+    and delegates to it; from then on uid, name and role are read from that row, so they follow
+    the row through an update() in the same request.
+    '''
+    def __init__(self, id, uid, name, role):
+        self.id = id
+        self._cached = (uid, name, role)
+        self._user = None
+
+    @property
+    def uid(self):
+        return self._cached[0] if self._user is None else self._user._uid
+
+    @property
+    def name(self):
+        return self._cached[1] if self._user is None else self._user._name
+
+    @property
+    def role(self):
+        return self._cached[2] if self._user is None else self._user._role
+
+    # the column names of the same fields, as used on User
+    _uid, _name, _role = uid, name, role
+
+    def is_admin(self):
+        return self.role == "Admin"
+
+    def __getattr__(self, attr):
+        # only called for attributes the cache does not hold
+        if self._user is None:
+            user = User.query.options(*PRINCIPAL).get(self.id)
+            if user is None:
+                raise AttributeError(f"User {self._cached[0]} no longer exists")
+            self._user = user
+        return getattr(self._user, attr)
+
+
+class PrincipalCache:
+    '''
+    TTL + LRU cache of the fields auth and role checks need, keyed by uid.
+    Here is how it works:
+      1. every write to users (create, update, delete, set_uid, role changes) bumps the 'users' CacheVersion
+      2. each lookup compares that version, read through a throttled VersionStamp, with the one the cache
+         was filled at, and empties the cache when it moved, so every gunicorn worker drops stale principals
+      3. entries older than PRINCIPAL_CACHE_TTL seconds are reloaded, at most PRINCIPAL_CACHE_SIZE are kept
+    A hit costs no query, apart from the version check once per CACHE_VERSION_CHECK_INTERVAL.
+    '''
+    def __init__(self):
+        self._stamp = VersionStamp(User.VERSION_NAME)
+        self._version = None
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, uid):
+        '''Returns the Principal of uid, or None when no such user exists.'''
+        # read the version before the row, so an entry is never stamped newer than its data
+        version = self._stamp.current()
+        now = time.monotonic()
+        with self._lock:
+            if version != self._version:
+                self._entries.clear()
+                self._version = version
+            entry = self._entries.get(uid)
+            if entry is not None and now - entry[1] < current_app.config['PRINCIPAL_CACHE_TTL']:
+                self._entries.move_to_end(uid)
+                return Principal(*entry[0])
+        row = User.query.with_entities(User.id, User._uid, User._name, User._role).filter(User._uid == uid).first()
+        if row is None:
+            return None
+        with self._lock:
+            if version == self._version:
+                self._entries[uid] = (tuple(row), now)
+                self._entries.move_to_end(uid)
+                while len(self._entries) > current_app.config['PRINCIPAL_CACHE_SIZE']:
+                    self._entries.popitem(last=False)
+        return Principal(*row)
+
+
+# one principal cache per worker process
+principal_cache = PrincipalCache()
+
 
 def token_required(roles=None):
     '''
@@ -10,7 +101,7 @@ def token_required(roles=None):
     Here is how it works:
       1. checks for the presence of a valid JWT token in the request cookie
       2. decodes the token and retrieves the user data
-      3. checks if the user data is found in the database
+      3. checks if the user data is found in the principal cache or the database
       4. checks if the user has the required role
       5. set the current_user in the global context (Flask's g object)
       6. returns the decorated function if all checks pass
@@ -32,7 +123,8 @@ def token_required(roles=None):
             try:
                 # Decode the token and retrieve the user data
                 data = jwt.decode(token, current_app.config["SECRET_KEY"], algorithms=["HS256"])
-                current_user = User.query.filter_by(_uid=data["_uid"]).first()
+                # cached principal, the User row is loaded only by the endpoints that use more than id, uid, name and role
+                current_user = principal_cache.get(data["_uid"])
                 if current_user is None:
                     return {
                         "message": "Invalid Authentication token!",
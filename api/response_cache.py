@@ -0,0 +1,65 @@
+import threading
+import zlib
+from collections import OrderedDict
+
+from flask import Response, current_app, request
+
+from model.cache import VersionStamp
+
+
+class ResponseCache:
+    '''
+    This class caches serialized JSON responses of read endpoints that front ends poll.
+    Here is how it works:
+      1. the response of a key (endpoint, principal, query) is stamped with CacheVersion counters,
+         bumped by every model create/update/delete of the tables it is built from
+      2. the ETag is the counters plus a hash of the key, so it changes whenever the data can have
+      3. a request whose If-None-Match holds the current ETag gets a 304 and nothing is built
+      4. otherwise the body is served from a bounded LRU while the counters match, and rebuilt
+         and re-serialized once when they move
+    The LRU holds at most RESPONSE_CACHE_SIZE bodies per cache.
+    '''
+    def __init__(self, *names, maxsize=None):
+        self._stamps = [VersionStamp(name) for name in names]
+        self._maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def maxsize(self):
+        if self._maxsize is None:
+            return current_app.config['RESPONSE_CACHE_SIZE']
+        return self._maxsize
+
+    def respond(self, key, build):
+        '''
+        Returns the response of key, calling build() only on a miss.
+        build() returns the JSON-ready data, or (data, extra headers) for headers cached with the body.
+        '''
+        # read the counters before building, so a body is never stamped newer than its data
+        versions = '-'.join(str(stamp.current()) for stamp in self._stamps)
+        etag = f"{versions}-{zlib.crc32(repr(key).encode()):08x}"
+        headers = {'ETag': f'"{etag}"', 'Cache-Control': 'no-cache'}
+        if request.if_none_match.contains(etag):
+            return Response(status=304, headers=headers)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == etag:
+                self._entries.move_to_end(key)
+                return Response(entry[1], mimetype='application/json', headers={**headers, **entry[2]})
+        data = build()
+        extra = {}
+        if isinstance(data, tuple):
+            data, extra = data
+        body = current_app.json.dumps(data)
+        with self._lock:
+            self._entries[key] = (etag, body, extra)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return Response(body, mimetype='application/json', headers={**headers, **extra})
+
+
+def request_query():
+    '''The query parameters of the request as a hashable, order-independent key part.'''
+    return tuple(sorted(request.args.items(multi=True)))
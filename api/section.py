@@ -3,6 +3,7 @@ from flask_restful import Api, Resource # used for REST API building
 from datetime import datetime
 import jwt
 from api.jwt_authorize import token_required
+from api.response_cache import ResponseCache, request_query
 from model.user import Section
 
 section_api = Blueprint('section_api', __name__,
@@ -11,6 +12,9 @@ section_api = Blueprint('section_api', __name__,
 # API docs https://flask-restful.readthedocs.io/en/latest/api.html
 api = Api(section_api)
 
+# section list responses, stamped with the sections counter
+section_responses = ResponseCache(Section.VERSION_NAME)
+
 class SectionAPI:        
          
     class _CRUD(Resource):  # Users API operation for Create, Read, Update, Delete 
@@ -43,13 +47,12 @@ class SectionAPI:
             return {'message': f'Processed {name}, either a format error or User ID {abbreviation} is duplicate'}, 400
 
         def get(self):
-            sections = Section.query.all() # extract all sections from the database
-             
-            # prepare a json list of user dictionaries
-            json_ready = [section.read() for section in sections]  
-            
-            # return response, a json list of user dictionaries
-            return jsonify(json_ready)
+            def build():
+                # prepare a json list of section dictionaries with their user counts, rosters are not loaded
+                return Section.read_with_counts()
+
+            # return response, a json list of section dictionaries, 304 while unchanged
+            return section_responses.respond(('section', None, request_query()), build)
         
         @token_required("Admin")
         def delete(self): # Delete Method
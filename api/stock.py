@@ -1,21 +1,46 @@
 import json, jwt
-from flask import Blueprint, request, jsonify, current_app, Response, g
+import zlib
+from flask import Blueprint, request, jsonify, current_app, Response, g, stream_with_context
 from flask_restful import Api, Resource # used for REST API building
-from datetime import datetime
+from datetime import datetime, timezone
 import requests
 from api.jwt_authorize import token_required
-from model.user import User
-from model.stocks import StockUser,StockTransaction,TableStock, UserTransactionStock
+from model.user import User, Section
+from model.stocks import StockUser,StockTransaction,TableStock, UserTransactionStock, StockHolding, StockPriceHistory, price_snapshot, RESOLUTIONS, DEFAULT_RANGES, MAX_RANGES
+from model.orders import execute_buy, execute_sell, execute_orders, ALL_OR_NOTHING
+from model.quotes import QuoteClient, refresh_prices
+from model.scheduler import price_scheduler
+from model.stream import price_broadcaster, encode_price
+from model.leaderboard import leaderboard
+from model.market import market_simulator
+from model.alerts import create_alert, delete_alert, list_alerts, deliver_alerts
+from model.search import stock_search
+from model.loader import load_stocks, load_stocks_upload
+try:
+    import msgpack  # optional, enables Accept: application/msgpack on /stock/quotes
+except ImportError:
+    msgpack = None
 
 stock_api = Blueprint('stock_api', __name__,
                    url_prefix='/stock')
 
 # API docs https://flask-restful.readthedocs.io/en/latest/api.html
 api = Api(stock_api)
-""" For this code to work, first you would need to bulk update the stock table by using the data in the csv file: stocks_table_exp.csv. 
+""" For this code to work, first you would need to bulk update the stock table by using the data in the csv file: stocks_table_exp.csv,
+run `flask custom load_stocks` or POST to /stock/load as an Admin. 
 Then the first thing to run is _initilize_user to create a new user in the StockUser table. 
 A possible post request of postman:{"uid":"niko","quantity":10,"symbol": "AAPL"}.
 All db change are found in the model/user.py file"""
+
+
+def _utc(value):
+    """Parses an ISO 8601 date time to the naive UTC the price history is stored in, an offset is converted."""
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
 class StockAPI:
     # used to create a user log to stockuser table
     # Supposed to be called when user first starts
@@ -24,35 +49,32 @@ class StockAPI:
             #updates stock price:
             body = request.get_json()
             symbol = body.get("symbol")
-            isloop = False
-            api_key = 'xAxPbodLC12nNCwa5gHiK6YZVQecllPA'  # Replace with your FMP API key
-            url = f'https://financialmodelingprep.com/api/v3/quote/{symbol}?apikey={api_key}'
-            stocks = TableStock.updatestockprice(self,body,isloop)
-            response = requests.get(url)
-            for stock in stocks:
-                if stock.symbol == symbol:
-                    
-                    if response.status_code == 200:
-                        data = response.json()
-                        
-                        if data:  # Check if the list is not empty
-                            latest_price = data[0].get('price')
-                            # Use .get() to avoid KeyError
-                            if latest_price is not None:
-                                print("this is stock:" + str(stock))
-                                isloop = True
-                                price = TableStock.updatestockprice(self,body,isloop,latest_price,stock)
-                                print(f"Updated price for {symbol} to {latest_price}")
-                            else:
-                                print(f"Price data not found for {symbol}")
-                        else:
-                            print(f"Empty data for {symbol}")
-                    else:
-                        print(f"Failed to fetch data for {symbol}. Status code: {response.status_code}")
-                    print("this is new price" +  str(price))
-                    data = jsonify(str(price))
-                    print("this is data" + str(data))
-            return data         
+            if price_snapshot.get(symbol) is None:
+                return {'error': f'No such stock exists: {symbol}'}, 404
+            if current_app.config['PRICE_SOURCE'] == 'simulated':
+                # the simulator keeps every price current, there is no feed to call
+                return jsonify(str(price_snapshot.get(symbol).price))
+            price_scheduler.watch([symbol])
+            client = QuoteClient()
+            try:
+                prices, errors = client.fetch([symbol])
+            finally:
+                client.close()
+            if symbol not in prices:
+                return {'error': f'Failed to fetch price for {symbol}', 'details': errors}, 502
+            TableStock.bulk_update_prices(prices)
+            return jsonify(str(prices[symbol]))
+    class _Refresh(Resource):
+        @token_required("Admin")
+        def post(self):
+            """Refreshes prices for the symbols in the body, or every stock when none are given"""
+            body = request.get_json(silent=True) or {}
+            symbols = body.get("symbols")
+            if symbols is not None and not isinstance(symbols, list):
+                return {'message': 'Expected a list of symbols'}, 400
+            if current_app.config['PRICE_SOURCE'] == 'simulated':
+                return jsonify({"updated": market_simulator.step()})
+            return jsonify(refresh_prices(symbols))
     class _initilize_user(Resource):
         @token_required()
         def get(self):
@@ -84,63 +106,231 @@ class StockAPI:
     class _initial_stockbuy(Resource):
         def post(self):
             body = request.get_json()
-            body = request.get_json()
-            userbal = StockUser.get_balance(self,body)
-            stockval = TableStock.get_price(self,body)
-            quantity = body.get("quantity")
-            isbuy = True
-            transactionval = quantity * stockval
-            if userbal >= transactionval:
-                # update user bal
-                StockUser.updatebal(self,body,transactionval)
-                # create stocktransacotin log
-                u=StockTransaction.createlog_initialbuy(self,body)
-                UserTransactionStock.multilog_buy_initial(self,body = body,value = transactionval,transactionid=u)
-                # update stock quantity
-                TableStock.updatequantity(self,body,isbuy)
-                return jsonify("Transaction successful")
-            else:
-                return jsonify({'error': 'Insufficient funds'}), 400
+            # seeds a position backdated one year, as a single transaction
+            result, status = execute_buy(body.get("uid"), body.get("symbol"), body.get("quantity"), backdate=True)
+            if status != 200:
+                return result, status
+            return jsonify("Transaction successful")
             
             
     class _tranaction_buy(Resource):
         def post(self):
             body = request.get_json()
-            userbal = StockUser.get_balance(self,body)
-            stockval = TableStock.get_price(self,body)
-            quantity = body.get("quantity")
-            isbuy = True
-            transactionval = quantity * stockval
-            if userbal >= transactionval:
-                # update user bal
-                StockUser.updatebal(self,body,transactionval)
-                # create stocktransacotin log
-                u=StockTransaction.createlog_buy(self,body)
-                UserTransactionStock.multilog_buy(self,body = body,value = transactionval,transactionid=u)
-                # update stock quantity
-                TableStock.updatequantity(self,body,isbuy)
-                return jsonify("Transaction successful")
+            # balance check, debit, inventory and logs are one transaction
+            result, status = execute_buy(body.get("uid"), body.get("symbol"), body.get("quantity"))
+            if status != 200:
+                return result, status
+            return jsonify("Transaction successful")
+    class _LoadStocks(Resource):
+        @token_required("Admin")
+        def post(self):
+            """Upserts the stock table from an uploaded CSV (multipart field "file"), or from stocks_table_exp.csv"""
+            upload = request.files.get('file')
+            if upload is not None:
+                return jsonify(load_stocks_upload(upload.read()))
+            return jsonify(load_stocks())
+    class _Scheduler(Resource):
+        @token_required("Admin")
+        def get(self):
+            """Reports the price scheduler's last run latency, schedule lag and data age, or the simulator's ticks.
+            The run metrics are those of the worker that answers, only the lease is shared by every worker."""
+            if current_app.config['PRICE_SOURCE'] == 'simulated':
+                return jsonify(market_simulator.status())
+            return jsonify(price_scheduler.status())
+    class _Stream(Resource):
+        @token_required()
+        def get(self):
+            """Streams price changes as Server-Sent Events, optionally only for ?symbols=AAPL,MSFT"""
+            symbols = [symbol for symbol in request.args.get('symbols', '').split(',') if symbol]
+            subscription = price_broadcaster.subscribe(symbols)
+            if subscription is None:
+                return {'message': 'Too many price stream subscribers, try again later'}, 503
+            # start every client from the current prices
+            if symbols:
+                quotes = price_snapshot.get_many(symbols).values()
+                price_scheduler.watch(symbols)
             else:
-                return jsonify({'error': 'Insufficient funds'}), 400
-    class _transaction_sell(Resource):
+                quotes = price_snapshot.all()
+            initial = b''.join(encode_price(quote.symbol, quote.price) for quote in quotes)
+            response = Response(price_broadcaster.events(subscription, initial), mimetype='text/event-stream',
+                                headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+            # the server closes every response, also one whose body it never started sending
+            response.call_on_close(lambda: price_broadcaster.unsubscribe(subscription))
+            return response
+    class _Portfolio(Resource):
+        @token_required()
+        def get(self):
+            """Every position of the logged in user valued at current prices, with unrealized P&L"""
+            portfolio = StockHolding.portfolio(g.current_user.uid)
+            if portfolio is None:
+                return {'message': f'No stock account for {g.current_user.name} found'}, 404
+            return jsonify(portfolio)
+    class _Leaderboard(Resource):
+        @token_required()
+        def get(self):
+            """Accounts ranked by cash plus holdings value, ?section=CSA to rank one section, ?limit=50"""
+            section_id = None
+            abbreviation = request.args.get('section')
+            if abbreviation:
+                section = Section.query.filter_by(_abbreviation=abbreviation).first()
+                if section is None:
+                    return {'message': f'Section {abbreviation} not found'}, 404
+                section_id = section.id
+            limit = request.args.get('limit', type=int)
+            if limit is not None and limit < 1:
+                return {'message': 'limit must be a positive integer'}, 400
+            ranking = leaderboard.get(section_id)
+            return jsonify(ranking[:limit] if limit else ranking)
+    class _Alerts(Resource):
+        @token_required()
+        def get(self):
+            """Lists the price alerts of the logged in user, active and fired"""
+            return jsonify(list_alerts(g.current_user.uid))
+
+        @token_required()
         def post(self):
+            """Sets a price alert, a possible post request of postman: {"symbol":"AAPL","direction":"above","threshold":250}"""
             body = request.get_json()
-            quantity = body.get("quantity")
-            symbol = body.get("symbol")
-            avaliable_quantity = UserTransactionStock.check_stock_quantity(self,body)
-            if avaliable_quantity >= quantity :
-                x=UserTransactionStock.check_tax(self,body)
-                if x == True:
-                    tax_rate = 0.20
-                    x= UserTransactionStock.calculate_tax_value(self,body,tax_rate)
-                    print(x)
-                else:
-                    tax_rate = 0.30
-                    x= UserTransactionStock.calculate_tax_value(self,body,tax_rate)
-                    print(x)
-                
+            return create_alert(g.current_user.uid, body.get("symbol"), body.get("direction"), body.get("threshold"))
+
+        @token_required()
+        def delete(self):
+            body = request.get_json()
+            return delete_alert(g.current_user.uid, body.get("id"))
+    class _AlertDelivery(Resource):
+        @token_required()
+        def get(self):
+            """Returns the alerts fired since the last poll and removes them from the delivery queue"""
+            return jsonify(deliver_alerts(g.current_user.uid))
+    class _Quotes(Resource):
+        def get(self):
+            """Current quotes from the price snapshot, ?symbols=AAPL,MSFT or ?all=1.
+            ?format=columns returns parallel arrays, Accept: application/msgpack returns them packed.
+            The ETag names the price version, so a poll with If-None-Match costs a 304 until prices move.
+            Available quantities are not quoted, trades change them without moving the price version."""
+            if request.args.get('all') in ('1', 'true'):
+                symbols = None
+            else:
+                symbols = list(dict.fromkeys(symbol for symbol in request.args.get('symbols', '').split(',') if symbol))
+                if not symbols:
+                    return {'message': 'Expected ?symbols=AAPL,MSFT or ?all=1'}, 400
+            packed = msgpack is not None and request.accept_mimetypes.best_match(
+                ['application/json', 'application/msgpack']) == 'application/msgpack'
+            columnar = packed or request.args.get('format') == 'columns'
+            version, quotes = price_snapshot.read_versioned(symbols)
+            selection = zlib.crc32(','.join(symbols).encode()) if symbols is not None else 'all'
+            etag = f"{version}-{selection}-{'msgpack' if packed else 'columns' if columnar else 'rows'}"
+            headers = {'ETag': f'"{etag}"', 'Cache-Control': 'no-cache', 'Vary': 'Accept'}
+            if request.if_none_match.contains(etag):
+                return Response(status=304, headers=headers)
+
+            if columnar:
+                payload = {
+                    "version": version,
+                    "symbols": [quote.symbol for quote in quotes],
+                    "prices": [quote.price for quote in quotes],
+                }
             else:
-                return jsonify({'error':'No stock to sell'}), 400
+                payload = {
+                    "version": version,
+                    "quotes": [{"symbol": quote.symbol, "price": quote.price} for quote in quotes],
+                }
+            if symbols is not None and len(quotes) < len(symbols):
+                found = {quote.symbol for quote in quotes}
+                payload["missing"] = [symbol for symbol in symbols if symbol not in found]
+            if packed:
+                return Response(msgpack.packb(payload), mimetype='application/msgpack', headers=headers)
+            return Response(json.dumps(payload, separators=(',', ':')), mimetype='application/json', headers=headers)
+    class _Search(Resource):
+        def get(self):
+            """Autocomplete over symbols and company names, ?q=app&limit=10"""
+            limit = request.args.get('limit', 10, type=int)
+            if limit < 1:
+                return {'message': 'limit must be a positive integer'}, 400
+            return jsonify(stock_search.search(request.args.get('q', ''), min(limit, 50)))
+    class _Transactions(Resource):
+        @token_required()
+        def get(self):
+            """Trade history of the logged in user, newest first.
+            Filters: ?symbol=AAPL&type=buy|sell&start=2024-07-01&end=2024-08-01, pages: ?limit=50&cursor=<next_cursor>.
+            ?format=ndjson (or Accept: application/x-ndjson) streams every matching row, one JSON object per line."""
+            userid = StockUser.query.filter(StockUser._uid == g.current_user.uid).value(StockUser.id)
+            if userid is None:
+                return {'message': f'No stock account for {g.current_user.name} found'}, 404
+            stockid = None
+            if request.args.get('symbol'):
+                quote = price_snapshot.get(request.args['symbol'])
+                if quote is None:
+                    return {'message': f"No such stock exists: {request.args['symbol']}"}, 404
+                stockid = quote.id
+            transaction_type = request.args.get('type')
+            if transaction_type not in (None, 'buy', 'sell'):
+                return {'message': 'type must be buy or sell'}, 400
+            try:
+                start = datetime.fromisoformat(request.args['start']) if 'start' in request.args else None
+                end = datetime.fromisoformat(request.args['end']) if 'end' in request.args else None
+                cursor = UserTransactionStock.decode_cursor(request.args['cursor']) if 'cursor' in request.args else None
+            except ValueError:
+                return {'message': 'start and end must be ISO 8601 dates and cursor a next_cursor value'}, 400
+            query = UserTransactionStock.history(userid, stockid, transaction_type, start, end, cursor)
+            symbols = {quote.id: quote.symbol for quote in price_snapshot.all()}
+
+            def read(row):
+                transaction_id, time, kind, stock_id, quantity, price, amount, tax = row
+                return {"transaction_id": transaction_id, "time": time.isoformat(), "type": kind,
+                        "symbol": symbols.get(stock_id), "quantity": quantity, "price": price,
+                        "amount": amount, "tax": tax or 0}
+
+            if request.args.get('format') == 'ndjson' or request.accept_mimetypes.best == 'application/x-ndjson':
+                def export():
+                    # yield_per streams from a server-side cursor where the driver has one
+                    for row in query.yield_per(500):
+                        yield json.dumps(read(row), separators=(',', ':')) + '\n'
+                return Response(stream_with_context(export()), mimetype='application/x-ndjson',
+                                headers={'Content-Disposition': 'attachment; filename=transactions.ndjson'})
+
+            limit = max(1, min(request.args.get('limit', 50, type=int), 500))
+            rows = query.limit(limit + 1).all()
+            next_cursor = UserTransactionStock.encode_cursor(rows[limit - 1]) if len(rows) > limit else None
+            return jsonify({"transactions": [read(row) for row in rows[:limit]], "next_cursor": next_cursor})
+    class _History(Resource):
+        @token_required()
+        def get(self, symbol):
+            """OHLC bars of a symbol, ?resolution=1m|1h|1d&start=2024-07-01T00:00:00&end=... (ISO 8601, UTC unless an offset is given).
+            A range spans at most 7 days of 1m, 90 days of 1h or 3 years of 1d bars."""
+            quote = price_snapshot.get(symbol)
+            if quote is None:
+                return {'message': f'No such stock exists: {symbol}'}, 404
+            resolution = request.args.get('resolution', '1m')
+            if resolution not in RESOLUTIONS:
+                return {'message': f'Resolution must be one of {list(RESOLUTIONS)}'}, 400
+            try:
+                end = _utc(request.args['end']) if 'end' in request.args else datetime.utcnow()
+                start = _utc(request.args['start']) if 'start' in request.args else end - DEFAULT_RANGES[resolution]
+            except ValueError:
+                return {'message': 'start and end must be ISO 8601 date times'}, 400
+            if start >= end:
+                return {'message': 'start must be before end'}, 400
+            if end - start > MAX_RANGES[resolution]:
+                return {'message': f'A {resolution} range spans at most {MAX_RANGES[resolution].days} days'}, 400
+            bars = StockPriceHistory.ohlc(quote.id, resolution, start, end)
+            return jsonify({"symbol": symbol, "resolution": resolution, "bars": bars})
+    class _Orders(Resource):
+        @token_required()
+        def post(self):
+            """Executes a basket of buy/sell orders of the logged in user in one transaction.
+            A possible post request of postman: {"mode":"best_effort","orders":[{"side":"buy","symbol":"AAPL","quantity":10}]}"""
+            body = request.get_json(silent=True) or {}
+            result, status = execute_orders(g.current_user.uid, body.get("orders"), body.get("mode", ALL_OR_NOTHING))
+            return result, status
+    class _transaction_sell(Resource):
+        @token_required()
+        def post(self):
+            """Sells shares of the logged in user FIFO, or specific lots when "lots":[{"id":1,"quantity":5}] is given.
+            Realized gains are split long-term/short-term and taxed before the proceeds are credited."""
+            body = request.get_json(silent=True) or {}
+            result, status = execute_sell(g.current_user.uid, body.get("symbol"), body.get("quantity"), body.get("lots"))
+            return result, status
     class _Account_expirary(Resource):
         def post(self):
             body= request.get_json()
@@ -160,4 +350,17 @@ class StockAPI:
     api.add_resource(_Account_expirary, '/expire')
     api.add_resource(_initial_stockbuy, '/initialbuy')
     api.add_resource(_Singleupdata,'/singleupdate')
+    api.add_resource(_Orders, '/orders')
+    api.add_resource(_Refresh, '/refresh')
+    api.add_resource(_LoadStocks, '/load')
+    api.add_resource(_Scheduler, '/scheduler')
+    api.add_resource(_Stream, '/stream')
+    api.add_resource(_Portfolio, '/portfolio')
+    api.add_resource(_Leaderboard, '/leaderboard')
+    api.add_resource(_Alerts, '/alerts')
+    api.add_resource(_AlertDelivery, '/alerts/fired')
+    api.add_resource(_Quotes, '/quotes')
+    api.add_resource(_Search, '/search')
+    api.add_resource(_Transactions, '/transactions')
+    api.add_resource(_History, '/history/<string:symbol>')
 
@@ -2,10 +2,12 @@ import jwt
 from flask import Blueprint, app, request, jsonify, current_app, Response, g
 from flask_restful import Api, Resource # used for REST API building
 from datetime import datetime
-from __init__ import app
+from __init__ import app, db
 from api.jwt_authorize import token_required
-from model.user import User
+from api.response_cache import ResponseCache, request_query
+from model.user import PROFILE, Section, User
 from model.github import GitHubUser
+from model.passwords import PasswordHasherBusy
 
 user_api = Blueprint('user_api', __name__,
                    url_prefix='/api')
@@ -13,14 +15,21 @@ user_api = Blueprint('user_api', __name__,
 # API docs https://flask-restful.readthedocs.io/en/latest/api.html
 api = Api(user_api)
 
+# user and id responses, stamped with the users and sections counters
+user_responses = ResponseCache(User.VERSION_NAME, Section.VERSION_NAME)
+
 class UserAPI:        
     class _ID(Resource):  # Individual identification API operation
         @token_required()
         def get(self):
             ''' Retrieve the current user from the token_required authentication check '''
             current_user = g.current_user
-            ''' Return the current user as a json object '''
-            return jsonify(current_user.read())
+            ''' Return the current user as a json object, 304 while unchanged '''
+            def build():
+                # full profile, the principal from token_required was loaded without sections
+                return User.query.options(*PROFILE).filter(User.id == current_user.id).one().read()
+
+            return user_responses.respond(('id', current_user.id, ()), build)
     
     class _BULK(Resource):  # Users API operation for Create, Read, Update, Delete 
         def post(self):
@@ -96,23 +105,53 @@ class UserAPI:
 
         @token_required()
         def get(self):
+            """Lists users in id order.
+            Filters: ?role=Admin&section=CSP&kasm_server_needed=true, projection: ?fields=uid,name,sections,
+            pages: ?limit=100&cursor=<X-Next-Cursor>. The body stays a JSON list, the next page cursor is in
+            the X-Next-Cursor header and is absent on the last page."""
             # retrieve the current user from the token_required authentication check  
             current_user = g.current_user
-            # current_user extracted from the token using token_required decorator
-            users = User.query.all() # extract all users from the database
-             
-            # prepare a json list of user dictionaries
-            json_ready = []  
-            for user in users:
-                user_data = user.read()
-                if current_user.role == 'Admin' or current_user.id == user.id:
-                    user_data['access'] = ['rw'] # read-write access control 
-                else:
-                    user_data['access'] = ['ro'] # read-only access control 
-                json_ready.append(user_data)
-            
-            # return response, a json list of user dictionaries
-            return jsonify(json_ready)
+            fields = None
+            if request.args.get('fields'):
+                fields = [field.strip() for field in request.args['fields'].split(',') if field.strip()]
+                unknown = set(fields) - set(User.LIST_FIELDS) - {'sections', 'access'}
+                if unknown:
+                    return {'message': f'Unknown fields: {sorted(unknown)}'}, 400
+            kasm_server_needed = request.args.get('kasm_server_needed')
+            if kasm_server_needed not in (None, 'true', 'false'):
+                return {'message': 'kasm_server_needed must be true or false'}, 400
+            try:
+                cursor = int(request.args['cursor']) if 'cursor' in request.args else None
+                limit = int(request.args['limit']) if 'limit' in request.args else None
+            except ValueError:
+                return {'message': 'cursor and limit must be integers'}, 400
+            if limit is not None and limit < 1:
+                return {'message': 'limit must be positive'}, 400
+
+            def build():
+                users, next_cursor = User.listing(
+                    fields=fields + ['id'] if fields else None,
+                    role=request.args.get('role'),
+                    section=request.args.get('section'),
+                    kasm_server_needed=None if kasm_server_needed is None else kasm_server_needed == 'true',
+                    cursor=cursor,
+                    limit=limit)
+
+                # access control and projection
+                for user_data in users:
+                    if fields is None or 'access' in fields:
+                        if current_user.role == 'Admin' or current_user.id == user_data['id']:
+                            user_data['access'] = ['rw'] # read-write access control 
+                        else:
+                            user_data['access'] = ['ro'] # read-only access control 
+                    if fields is not None and 'id' not in fields:
+                        del user_data['id']
+                # the next page cursor goes in a header, the body stays a json list of user dictionaries
+                return users, {'X-Next-Cursor': str(next_cursor)} if next_cursor is not None else {}
+
+            # every admin gets the same listing, other users differ in the access of their own row
+            principal = current_user.role if current_user.role == 'Admin' else (current_user.role, current_user.id)
+            return user_responses.respond(('user', principal, request_query()), build)
         
         @token_required()
         def put(self):
@@ -253,7 +292,14 @@ class UserAPI:
     
                 user = User.query.filter_by(_uid=uid).first()
                 
-                if user is None or not user.is_password(password):
+                try:
+                    valid = user is not None and user.is_password(password)
+                    # a hash made under an older work-factor policy is replaced on a successful login
+                    if valid and user.upgrade_password(password):
+                        db.session.commit()
+                except PasswordHasherBusy as e:
+                    return {'message': str(e)}, 503
+                if not valid:
                     
                     return {'message': f"Invalid user id or password"}, 401
                             
@@ -3,9 +3,14 @@ from urllib.parse import urljoin, urlparse
 from flask import abort, redirect, render_template, request, send_from_directory, url_for, jsonify  # import render_template from "public" flask libraries
 from flask_login import current_user, login_user, logout_user
 from flask.cli import AppGroup
+import click
 from flask_login import current_user, login_required
 from flask import current_app
 from werkzeug.security import generate_password_hash
+import multiprocessing
+import os
+import sys
+import time
 
 
 # import "objects" from "this" project
@@ -17,7 +22,16 @@ from api.pfp import pfp_api
 from api.stock import stock_api
 from api.analytics import analytics_api
 # database Initialization functions
-from model.user import User, initUsers
+from model.user import PRINCIPAL, ROSTER, User, initUsers
+from model.stocks import StockHolding, StockLot, StockPriceHistory
+from model.quotes import QuoteClient, refresh_prices
+from model.scheduler import price_scheduler
+from model.market import market_simulator
+from model.loader import load_stocks
+from model.passwords import PasswordHasherBusy
+from model import ledger
+from model.expiry import expire_accounts
+from model.schema import migrate_schema
 # server only Views
 
 # register URIs for api endpoints
@@ -37,7 +51,7 @@ def unauthorized_callback():
 # register URIs for server pages
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    return User.query.options(*PRINCIPAL).get(int(user_id))
 
 @app.context_processor
 def inject_user():
@@ -54,8 +68,15 @@ def login():
     error = None
     next_page = request.args.get('next', '') or request.form.get('next', '')
     if request.method == 'POST':
-        user = User.query.filter_by(_uid=request.form['username']).first()
-        if user and user.is_password(request.form['password']):
+        user = User.query.options(*PRINCIPAL).filter_by(_uid=request.form['username']).first()
+        try:
+            valid = user is not None and user.is_password(request.form['password'])
+            # a hash made under an older work-factor policy is replaced on a successful login
+            if valid and user.upgrade_password(request.form['password']):
+                db.session.commit()
+        except PasswordHasherBusy as e:
+            return render_template("login.html", error=str(e), next=next_page), 503
+        if valid:
             login_user(user)
             if not is_safe_url(next_page):
                 return abort(400)
@@ -82,13 +103,13 @@ def index():
 @app.route('/users/table')
 @login_required
 def utable():
-    users = User.query.all()
+    users = User.query.options(*ROSTER).all()
     return render_template("utable.html", user_data=users)
 
 @app.route('/users/table2')
 @login_required
 def u2table():
-    users = User.query.all()
+    users = User.query.options(*ROSTER).all()
     return render_template("u2table.html", user_data=users)
 
 # Helper function to extract uploads for a user (ie PFP image)
@@ -128,8 +149,112 @@ custom_cli = AppGroup('custom', help='Custom commands')
 def generate_data():
     initUsers()
 
+# Define a command to add the columns and indexes of newer models to an existing database, safe to rerun
+@custom_cli.command('migrate_schema')
+def migrate_schema_command():
+    applied = migrate_schema()
+    print(f"Applied {', '.join(applied)}" if applied else "Schema is up to date")
+
+# Define a command to recompute the tax lots and stock holdings tables from the transaction log
+@custom_cli.command('rebuild_holdings')
+def rebuild_holdings():
+    lots = StockLot.rebuild()
+    count = StockHolding.rebuild()
+    print(f"Rebuilt {lots} open tax lots and {count} stock holdings")
+
+# Define a command to load or reload the stock table from stocks_table_exp.csv, or another CSV
+@custom_cli.command('load_stocks')
+@click.option('--file', 'path', default=None, type=click.Path(exists=True, dir_okay=False), help='CSV with _symbol,_company,_quantity,_sheesh columns')
+@click.option('--batch-size', default=None, type=int, help='Rows per upsert statement')
+def load_stocks_command(path, batch_size):
+    if path:
+        with open(path, newline='') as f:
+            result = load_stocks(f, batch_size)
+    else:
+        result = load_stocks(batch_size=batch_size)
+    print(f"Inserted {result['inserted']}, updated {result['updated']}, unchanged {result['unchanged']}, skipped {result['skipped']} in {result['elapsed']}s")
+    for error in result['errors']:
+        print(f"  {error}")
+
+# Define a command to refresh every stock price from the quote feed in batched requests
+@custom_cli.command('refresh_prices')
+@click.option('--base-url', default=None, help='Quote endpoint, e.g. a local stand-in server')
+def refresh_prices_command(base_url):
+    result = refresh_prices(client=QuoteClient(base_url=base_url))
+    print(f"Updated {result['updated']} of {result['requested']} prices in {result['elapsed']}s")
+    for error in result['errors']:
+        print(f"  {error}")
+
+# Define a command to run the price refresh scheduler in the foreground
+@custom_cli.command('price_scheduler')
+def price_scheduler_command():
+    print(f"Price scheduler {price_scheduler.owner} running every {app.config['PRICE_REFRESH_INTERVAL']}s, Ctrl-C to stop")
+    price_scheduler.loop()
+
+# Define a command to run the simulated market in the foreground
+@custom_cli.command('simulate_market')
+@click.option('--ticks', default=0, help='Number of ticks to run, 0 runs until Ctrl-C')
+def simulate_market(ticks):
+    print(f"Market simulator {market_simulator.owner} ticking every {app.config['SIM_TICK_INTERVAL']}s at {app.config['SIM_TIME_SCALE']}x")
+    if ticks == 0:
+        market_simulator.loop()
+        return
+    for _ in range(ticks):
+        updated = market_simulator.run_once()
+        print(f"Updated {updated} prices" if updated is not None else "Lease held by another process, skipped")
+        time.sleep(app.config['SIM_TICK_INTERVAL'])
+
+# Define a command to freeze and archive every account past its trading window, run it daily (e.g. from cron)
+@custom_cli.command('expire_accounts')
+@click.option('--as-of', default=None, type=click.DateTime(formats=['%Y-%m-%d']), help='Sweep as of this day instead of today')
+def expire_accounts_command(as_of):
+    result = expire_accounts(as_of.date() if as_of else None)
+    print(f"Expired {result['expired']} accounts and liquidated {result['positions']} positions in {result['elapsed']}s")
+
+# Define a command to delete price history past its retention, run it daily (e.g. from cron)
+@custom_cli.command('prune_price_history')
+@click.option('--days', default=None, type=int, help='Days to keep instead of PRICE_HISTORY_RETENTION_DAYS')
+def prune_price_history(days):
+    result = StockPriceHistory.prune(days)
+    print(f"Deleted {result['deleted']} prices before {result['cutoff']} in {result['elapsed']}s")
+
+# Define a command to snapshot the trade ledger, run it periodically (e.g. from cron) to bound replay
+@custom_cli.command('ledger_snapshot')
+@click.option('--from-live', is_flag=True, help='Copy the live tables, once, to start the ledger of an existing database')
+def ledger_snapshot(from_live):
+    result = ledger.take_snapshot(from_live)
+    print(f"Snapshot {result['id']} at event {result['event_id']} with {result['rows']} rows, replayed {result['replayed']} events in {result['elapsed']}s")
+
+# Define a command to verify balances, holdings and inventory against the trade ledger
+@custom_cli.command('ledger_reconcile')
+@click.option('--limit', default=50, help='Mismatches to print')
+def ledger_reconcile(limit):
+    result = ledger.reconcile(limit)
+    checked = result['checked']
+    print(f"Replayed {result['replayed']} events to {result['event_id']} from snapshot {result['snapshot_id']}, checked "
+          f"{checked['balances']} balances, {checked['holdings']} holdings, {checked['inventory']} stocks in {result['elapsed']}s")
+    for mismatch in result['mismatches']:
+        print(f"  {mismatch['kind']} {mismatch['key']}: ledger {mismatch['ledger']}, live {mismatch['live']}")
+    print(f"{result['mismatch_count']} mismatches")
+    if result['mismatch_count']:
+        sys.exit(1)
+
+# Define a command to rewrite balances, holdings and inventory from the trade ledger
+@custom_cli.command('ledger_rebuild')
+def ledger_rebuild():
+    result = ledger.rebuild()
+    print(f"Rebuilt {result['balances']} balances, {result['holdings']} holdings, {result['inventory']} stocks "
+          f"at event {result['event_id']} in {result['elapsed']}s")
+
 # Register the custom command group with the Flask application
 app.cli.add_command(custom_cli)
+
+# Start the in-app price source for the web server, flask CLI commands and password hashing processes do not start it
+if app.config['PRICE_SCHEDULER_ENABLED'] and not os.environ.get('FLASK_RUN_FROM_CLI') and multiprocessing.parent_process() is None:
+    if app.config['PRICE_SOURCE'] == 'simulated':
+        market_simulator.start()
+    else:
+        price_scheduler.start()
         
 # this runs the flask application on the development server
 if __name__ == "__main__":
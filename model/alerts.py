@@ -0,0 +1,299 @@
+""" Price alerts of the stock game, evaluated on every price write """
+import threading
+from bisect import bisect_left, bisect_right
+from datetime import datetime
+
+from sqlalchemy import bindparam
+
+from __init__ import app, db
+from model.cache import VersionStamp, bump_version, on_commit, on_rollback
+from model.stocks import StockUser, TableStock, price_snapshot
+
+ABOVE = 'above'
+BELOW = 'below'
+DIRECTIONS = (ABOVE, BELOW)
+
+
+class PriceAlert(db.Model):
+    """
+    PriceAlert Model
+
+    A user's request to be told when a stock trades at or above, or at or below, a threshold.
+    An alert fires once: the price write that crosses it stamps _fired, and the alert then waits
+    in the user's delivery queue until it is read through /stock/alerts/fired.
+
+    Attributes:
+        id (Column): The primary key, an integer representing the alert.
+        _user_id (Column): Foreign key to the 'stock_users' table.
+        _stock_id (Column): Foreign key to the 'table_stocks' table.
+        _direction (Column): 'above' or 'below'.
+        _threshold (Column): The price that fires the alert.
+        _created (Column): When the alert was set.
+        _fired (Column): When a price write crossed the threshold, None while active.
+        _fired_price (Column): The price that fired the alert.
+        _delivered (Column): True once the fired alert has been read by the user.
+    """
+    __tablename__ = 'price_alerts'
+    __table_args__ = (
+        db.Index('ix_price_alerts_delivery', '_user_id', '_delivered', '_fired'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    _user_id = db.Column(db.Integer, db.ForeignKey('stock_users.id', ondelete='CASCADE'), nullable=False)
+    _stock_id = db.Column(db.Integer, db.ForeignKey('table_stocks.id', ondelete='CASCADE'), nullable=False)
+    _direction = db.Column(db.String(8), nullable=False)
+    _threshold = db.Column(db.Float, nullable=False)
+    _created = db.Column(db.DateTime, nullable=False)
+    _fired = db.Column(db.DateTime, nullable=True)
+    _fired_price = db.Column(db.Float, nullable=True)
+    _delivered = db.Column(db.Boolean, nullable=False, default=False)
+
+    def __init__(self, user_id, stock_id, direction, threshold):
+        self._user_id = user_id
+        self._stock_id = stock_id
+        self._direction = direction
+        self._threshold = threshold
+        self._created = datetime.utcnow()
+        self._delivered = False
+
+    def read(self, symbol=None):
+        return {
+            "id": self.id,
+            "symbol": symbol,
+            "direction": self._direction,
+            "threshold": self._threshold,
+            "created": self._created.isoformat(),
+            "fired": self._fired.isoformat() if self._fired else None,
+            "fired_price": self._fired_price,
+        }
+
+
+class AlertIndex:
+    """
+    Active alerts of every stock as sorted threshold arrays, one per direction.
+
+    A price write bisects the arrays of each stock it touches: every 'above' alert at or below
+    the new price, and every 'below' alert at or above it, is a contiguous run at one end of its
+    array. A tick costs O(log n) per stock plus the alerts it fires, however many alerts are
+    set. Fired alerts are cut from the arrays and stamped with one conditional executemany
+    UPDATE, so two workers evaluating the same tick fire each alert once.
+
+    The index is stamped with the 'price_alerts' CacheVersion and reloaded when another worker
+    adds, removes or fires an alert.
+    """
+    VERSION_NAME = 'price_alerts'
+
+    def __init__(self):
+        self._stamp = VersionStamp(self.VERSION_NAME)
+        self._version = None
+        self._lock = threading.Lock()
+        # stock_id -> ([thresholds ascending], [alert ids in the same order])
+        self._index = {ABOVE: {}, BELOW: {}}
+
+    def reload(self):
+        """Loads every active alert with one query ordered by threshold."""
+        with self._lock:
+            version = self._stamp.refresh()
+            rows = (db.session.query(PriceAlert.id, PriceAlert._stock_id, PriceAlert._direction, PriceAlert._threshold)
+                    .filter(PriceAlert._fired.is_(None))
+                    .order_by(PriceAlert._threshold, PriceAlert.id)
+                    .all())
+            index = {ABOVE: {}, BELOW: {}}
+            for alert_id, stock_id, direction, threshold in rows:
+                thresholds, ids = index[direction].setdefault(stock_id, ([], []))
+                thresholds.append(threshold)
+                ids.append(alert_id)
+            self._index = index
+            self._version = version
+
+    def _ensure(self):
+        if self._stamp.current() != self._version:
+            self.reload()
+
+    def invalidate(self):
+        """Forces a reload on the next evaluate, e.g. after a write that cut alerts was rolled back."""
+        with self._lock:
+            self._version = None
+
+    def add(self, alert_id, stock_id, direction, threshold):
+        """Adds a new alert to this worker's index, other workers pick it up on reload."""
+        with self._lock:
+            thresholds, ids = self._index[direction].setdefault(stock_id, ([], []))
+            position = bisect_right(thresholds, threshold)
+            thresholds.insert(position, threshold)
+            ids.insert(position, alert_id)
+
+    def remove(self, alert_id, stock_id, direction, threshold):
+        with self._lock:
+            entry = self._index[direction].get(stock_id)
+            if entry is None:
+                return
+            thresholds, ids = entry
+            position = bisect_left(thresholds, threshold)
+            while position < len(ids) and thresholds[position] == threshold:
+                if ids[position] == alert_id:
+                    del thresholds[position], ids[position]
+                    return
+                position += 1
+
+    def evaluate(self, prices):
+        """
+        Fires the alerts crossed by a price write, inside the writer's transaction.
+
+        The fired alerts are cut from the index right away, so a second write before the commit
+        does not fire them again; if the transaction rolls back the index is reloaded instead.
+
+        Parameters:
+        - prices (dict): {stock_id: new price}
+
+        Returns:
+        - list: The ids of the alerts fired by this write.
+        """
+        self._ensure()
+        fired = []
+        with self._lock:
+            above, below = self._index[ABOVE], self._index[BELOW]
+            for stock_id, price in prices.items():
+                entry = above.get(stock_id)
+                if entry and entry[0] and entry[0][0] <= price:
+                    count = bisect_right(entry[0], price)
+                    fired.extend((alert_id, price) for alert_id in entry[1][:count])
+                    del entry[0][:count], entry[1][:count]
+                entry = below.get(stock_id)
+                if entry and entry[0] and entry[0][-1] >= price:
+                    start = bisect_left(entry[0], price)
+                    fired.extend((alert_id, price) for alert_id in entry[1][start:])
+                    del entry[0][start:], entry[1][start:]
+        if not fired:
+            return []
+        on_rollback(self.invalidate)
+        table = PriceAlert.__table__
+        db.session.execute(
+            table.update()
+            .where(table.c.id == bindparam('b_id'), table.c._fired.is_(None))
+            .values(_fired=datetime.utcnow(), _fired_price=bindparam('b_price')),
+            [{'b_id': alert_id, 'b_price': price} for alert_id, price in fired])
+        bump_version(self.VERSION_NAME)
+        return [alert_id for alert_id, _ in fired]
+
+
+def _delete_user_alerts(userid):
+    """Deletes the alerts of a closing stock account, other workers drop them on reload."""
+    if db.session.query(PriceAlert).filter(PriceAlert._user_id == userid).delete(synchronize_session=False):
+        bump_version(AlertIndex.VERSION_NAME)
+        on_commit(alert_index.invalidate)
+
+
+# one alert index per worker process, evaluated by every price write
+alert_index = AlertIndex()
+TableStock.price_write_hooks.append(alert_index.evaluate)
+StockUser.close_hooks.append(_delete_user_alerts)
+
+
+def _stock_user_id(uid):
+    return db.session.query(StockUser.id).filter(StockUser._uid == uid).scalar()
+
+
+def _symbols():
+    return {quote.id: quote.symbol for quote in price_snapshot.all()}
+
+
+def create_alert(uid, symbol, direction, threshold):
+    """
+    Sets a price alert for a user.
+
+    Parameters:
+    - uid (str): The uid of the stock user.
+    - symbol (str): The stock to watch.
+    - direction (str): 'above' or 'below'.
+    - threshold (float): The price that fires the alert.
+
+    Returns:
+    - tuple: (the alert or an error message, HTTP status)
+    """
+    if direction not in DIRECTIONS:
+        return {'message': f'direction must be one of {list(DIRECTIONS)}'}, 400
+    if isinstance(threshold, bool) or not isinstance(threshold, (int, float)) or threshold <= 0:
+        return {'message': 'threshold must be a positive number'}, 400
+    quote = price_snapshot.get(symbol)
+    if quote is None:
+        return {'message': f'No such stock exists: {symbol}'}, 404
+    userid = _stock_user_id(uid)
+    if userid is None:
+        return {'message': "Can't find user in StockUser table. Possible fix: Run /initilize first to log user in StockUser table"}, 404
+    active = (PriceAlert.query
+              .filter(PriceAlert._user_id == userid, PriceAlert._fired.is_(None))
+              .count())
+    if active >= app.config['ALERTS_PER_USER']:
+        return {'message': f"At most {app.config['ALERTS_PER_USER']} active alerts per user"}, 400
+    alert = PriceAlert(userid, quote.id, direction, float(threshold))
+    try:
+        db.session.add(alert)
+        db.session.flush()
+        bump_version(AlertIndex.VERSION_NAME)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    alert_index.add(alert.id, quote.id, direction, float(threshold))
+    return alert.read(symbol), 200
+
+
+def delete_alert(uid, alert_id):
+    """Removes an alert of a user, returns (message, HTTP status)."""
+    userid = _stock_user_id(uid)
+    alert = db.session.get(PriceAlert, alert_id) if userid is not None else None
+    if alert is None or alert._user_id != userid:
+        return {'message': f'Alert {alert_id} not found'}, 404
+    entry = (alert.id, alert._stock_id, alert._direction, alert._threshold)
+    try:
+        db.session.delete(alert)
+        bump_version(AlertIndex.VERSION_NAME)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    alert_index.remove(*entry)
+    return {'message': f'Alert {alert_id} deleted'}, 200
+
+
+def list_alerts(uid):
+    """Returns every alert of a user, active and fired, newest first."""
+    userid = _stock_user_id(uid)
+    if userid is None:
+        return []
+    symbols = _symbols()
+    alerts = PriceAlert.query.filter(PriceAlert._user_id == userid).order_by(PriceAlert.id.desc()).all()
+    return [alert.read(symbols.get(alert._stock_id)) for alert in alerts]
+
+
+def deliver_alerts(uid):
+    """
+    Pops the delivery queue of a user: fired alerts not yet read, oldest first.
+
+    The alerts are marked delivered with a conditional UPDATE, so concurrent polls of the same
+    user return each fired alert once.
+    """
+    userid = _stock_user_id(uid)
+    if userid is None:
+        return []
+    pending = (PriceAlert.query
+               .filter(PriceAlert._user_id == userid, PriceAlert._delivered == False, PriceAlert._fired.isnot(None))
+               .order_by(PriceAlert._fired, PriceAlert.id)
+               .all())
+    if not pending:
+        return []
+    table = PriceAlert.__table__
+    symbols = _symbols()
+    delivered = []
+    try:
+        for alert in pending:
+            result = db.session.execute(
+                table.update().where(table.c.id == alert.id, table.c._delivered == False).values(_delivered=True))
+            if result.rowcount:
+                delivered.append(alert.read(symbols.get(alert._stock_id)))
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return delivered
@@ -0,0 +1,166 @@
+""" Shared version stamps used to invalidate in-process caches across workers """
+import time
+import threading
+
+from sqlalchemy import event
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+
+from __init__ import app, db
+
+
+class CacheVersion(db.Model):
+    """
+    CacheVersion Model
+
+    One row per cached data set holding a counter that is bumped, in the same transaction, by
+    every write to that data set. Each worker keeps its own in-memory copy of the data and
+    compares the counter it loaded with the one in this table to know when to reload.
+
+    Attributes:
+        _name (Column): The name of the cached data set, the primary key.
+        _version (Column): The change counter.
+    """
+    __tablename__ = 'cache_versions'
+
+    _name = db.Column(db.String(64), primary_key=True)
+    _version = db.Column(db.Integer, nullable=False, default=0)
+
+    def __init__(self, name, version=0):
+        self._name = name
+        self._version = version
+
+    def read(self):
+        return {"name": self._name, "version": self._version}
+
+
+# dialect name -> insert construct with a native upsert
+UPSERT_INSERTS = {
+    'sqlite': sqlite_insert,
+    'postgresql': postgresql_insert,
+    'mysql': mysql_insert,
+    'mariadb': mysql_insert,
+}
+
+
+def on_commit(callback):
+    """Runs callback() once the current transaction commits, never when it rolls back."""
+    db.session.info.setdefault('on_commit', []).append(callback)
+
+
+def on_rollback(callback):
+    """Runs callback() when the current transaction ends without committing."""
+    db.session.info.setdefault('on_rollback', []).append(callback)
+
+
+@event.listens_for(Session, 'after_commit')
+def _run_commit_callbacks(session):
+    session.info.pop('on_rollback', None)
+    for callback in session.info.pop('on_commit', ()):
+        callback()
+
+
+@event.listens_for(Session, 'after_transaction_end')
+def _run_rollback_callbacks(session, transaction):
+    # savepoints end inside the outer transaction, only its end decides
+    if transaction.parent is not None:
+        return
+    session.info.pop('on_commit', None)
+    for callback in session.info.pop('on_rollback', ()):
+        callback()
+
+
+# name -> number of committed bumps made by this worker, so its own stamps reread without waiting out the interval
+_local_bumps = {}
+
+
+def _count_local_bump(name):
+    _local_bumps[name] = _local_bumps.get(name, 0) + 1
+
+
+def bump_version(name):
+    """
+    Increments the version of a data set inside the caller's transaction, caller commits.
+
+    The first bump of a name creates its row, with one native upsert statement, so two workers
+    bumping a new name at once never collide on the insert. This worker's stamps see the bump
+    once it has committed.
+    """
+    table = CacheVersion.__table__
+    dialect = db.session.get_bind().dialect.name
+    insert = UPSERT_INSERTS.get(dialect)
+    if insert is None:
+        result = db.session.execute(
+            table.update().where(table.c._name == name).values(_version=table.c._version + 1))
+        if result.rowcount == 0:
+            db.session.execute(table.insert().values(_name=name, _version=1))
+    else:
+        statement = insert(table).values(_name=name, _version=1)
+        if dialect in ('mysql', 'mariadb'):
+            statement = statement.on_duplicate_key_update(_version=table.c._version + 1)
+        else:
+            statement = statement.on_conflict_do_update(index_elements=['_name'], set_={'_version': table.c._version + 1})
+        db.session.execute(statement)
+    on_commit(lambda: _count_local_bump(name))
+
+
+def read_version(name):
+    """Returns the current version of a data set, 0 when it has never been written."""
+    return db.session.query(CacheVersion._version).filter(CacheVersion._name == name).scalar() or 0
+
+
+class VersionStamp:
+    """
+    Throttled reader of a CacheVersion counter.
+
+    current() reads the counter from the database at most once per interval seconds and
+    otherwise returns the value it last read, so a hot path pays for at most one primary key
+    lookup per interval instead of one per call. The interval defaults to
+    CACHE_VERSION_CHECK_INTERVAL. A bump made by this worker forces the next read, so a worker
+    never serves its own writes stale.
+
+    reader replaces the counter lookup with any other cheap, growing value, e.g. the id of the
+    newest row of an append-only table, for data written too often to bump a shared counter.
+    """
+    def __init__(self, name, interval=None, reader=None):
+        self.name = name
+        self._interval = interval
+        self._reader = reader or (lambda: read_version(name))
+        self._version = None
+        self._checked = 0.0
+        self._local = 0
+        self._lock = threading.Lock()
+
+    @property
+    def interval(self):
+        if self._interval is None:
+            return app.config['CACHE_VERSION_CHECK_INTERVAL']
+        return self._interval
+
+    def current(self):
+        now = time.monotonic()
+        local = _local_bumps.get(self.name, 0)
+        if self._version is None or local != self._local or now - self._checked >= self.interval:
+            with self._lock:
+                if self._version is None or local != self._local or now - self._checked >= self.interval:
+                    self._version = self._reader()
+                    self._checked = now
+                    self._local = local
+        return self._version
+
+    def observe(self, version):
+        """Records a version this worker has just written, saving the next read."""
+        with self._lock:
+            if self._version is None or version > self._version:
+                self._version = version
+                self._checked = time.monotonic()
+
+    def refresh(self):
+        """Reads the counter now, ignoring the interval."""
+        with self._lock:
+            self._version = self._reader()
+            self._checked = time.monotonic()
+        return self._version
+
@@ -0,0 +1,8 @@
+""" File locations and fixed values shared by the app and the standalone scripts, importing it never starts the app """
+import os
+
+# seed data of the stock table: _symbol, _company, _quantity (shares available, up to trillions) and _sheesh (price)
+STOCKS_CSV = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'stocks_table_exp.csv')
+
+# largest share count or cash amount a BIGINT column holds
+MAX_QUANTITY = 2**63 - 1
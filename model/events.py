@@ -0,0 +1,85 @@
+""" Append-only log of every change to balances, holdings and inventory """
+from datetime import datetime
+
+from __init__ import db
+
+
+class TradeEvent(db.Model):
+    """
+    TradeEvent Model
+
+    One row per change to a cash balance, a holding or a stock's inventory, appended in the same
+    transaction as the change and never updated or deleted. Each event carries the deltas it
+    applied, so replaying the log in id order reproduces every balance, holding and inventory
+    whatever the kind of event. See model/ledger.py for snapshots, rebuild and reconciliation.
+
+    User and stock ids are plain integers rather than foreign keys, so deleting a user or a
+    stock never removes its history.
+
+    Attributes:
+        id (Column): The primary key, the position of the event in the log.
+        _kind (Column): 'open', 'buy', 'sell', 'adjust', 'supply', 'expire' or 'close'.
+        _user_id (Column): The StockUser id, None for inventory-only events.
+        _stock_id (Column): The TableStock id, None for cash-only events.
+        _transaction_id (Column): The StockTransaction of a trade.
+        _price (Column): Price per share of a trade.
+        _cash (Column): Change to the user's balance.
+        _shares (Column): Change to the user's holding of the stock.
+        _cost (Column): Change to the cost basis of the holding.
+        _inventory (Column): Change to the stock's available quantity.
+        _created (Column): When the event was appended.
+    """
+    __tablename__ = 'trade_events'
+
+    id = db.Column(db.Integer, primary_key=True)
+    _kind = db.Column(db.String(16), nullable=False)
+    _user_id = db.Column(db.Integer, nullable=True)
+    _stock_id = db.Column(db.Integer, nullable=True)
+    _transaction_id = db.Column(db.Integer, nullable=True)
+    _price = db.Column(db.Float, nullable=True)
+    _cash = db.Column(db.Float, nullable=False, default=0)
+    _shares = db.Column(db.Integer, nullable=False, default=0)
+    _cost = db.Column(db.Float, nullable=False, default=0)
+    _inventory = db.Column(db.BigInteger, nullable=False, default=0)
+    _created = db.Column(db.DateTime, nullable=False)
+
+    def read(self):
+        return {
+            "id": self.id,
+            "kind": self._kind,
+            "user_id": self._user_id,
+            "stock_id": self._stock_id,
+            "transaction_id": self._transaction_id,
+            "price": self._price,
+            "cash": self._cash,
+            "shares": self._shares,
+            "cost": self._cost,
+            "inventory": self._inventory,
+            "created": self._created,
+        }
+
+
+def record_event(kind, user_id=None, stock_id=None, cash=0.0, shares=0, cost=0.0, inventory=0, price=None,
+                 transaction_id=None):
+    """Appends an event inside the caller's transaction, caller commits."""
+    db.session.execute(TradeEvent.__table__.insert().values(
+        _kind=kind, _user_id=user_id, _stock_id=stock_id, _transaction_id=transaction_id, _price=price,
+        _cash=cash, _shares=shares, _cost=cost, _inventory=inventory, _created=datetime.utcnow()))
+
+
+def last_event_id():
+    """Returns the id of the newest event, 0 for an empty log; a primary key lookup, not a scan."""
+    return db.session.query(db.func.max(TradeEvent.id)).scalar() or 0
+
+
+def record_events(events):
+    """Appends many events with one executemany INSERT, caller commits."""
+    if not events:
+        return
+    now = datetime.utcnow()
+    rows = [{"_kind": event["kind"], "_user_id": event.get("user_id"), "_stock_id": event.get("stock_id"),
+             "_transaction_id": event.get("transaction_id"), "_price": event.get("price"),
+             "_cash": event.get("cash", 0.0), "_shares": event.get("shares", 0), "_cost": event.get("cost", 0.0),
+             "_inventory": event.get("inventory", 0), "_created": now}
+            for event in events]
+    db.session.execute(TradeEvent.__table__.insert(), rows)
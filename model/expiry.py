@@ -0,0 +1,138 @@
+""" Batch expiry of stock game accounts past their trading window """
+import time
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import func, literal, null, select, update
+
+from __init__ import app, db
+from model.cache import bump_version
+from model.events import TradeEvent
+from model.stocks import PriceSnapshot, StockHolding, StockLot, StockUser, TableStock, price_snapshot
+
+# claimed by the running sweep, only ever seen inside its transaction
+EXPIRING = 'expiring'
+
+
+class StockAccountArchive(db.Model):
+    """
+    StockAccountArchive Model
+
+    The final value of an expired stock account, written by the sweep that froze it.
+
+    Attributes:
+        id (Column): The primary key.
+        _user_id (Column): The StockUser id of the expired account.
+        _uid (Column): The uid of the user.
+        _cash (Column): The balance at expiry.
+        _holdings_value (Column): The holdings at expiry valued at the current prices.
+        _final_value (Column): Balance plus holdings value, the account's final score.
+        _positions (Column): The number of holdings liquidated.
+        _archived (Column): When the account was expired.
+    """
+    __tablename__ = 'stock_account_archives'
+
+    id = db.Column(db.Integer, primary_key=True)
+    _user_id = db.Column(db.Integer, nullable=False, index=True)
+    _uid = db.Column(db.String(255), nullable=False)
+    _cash = db.Column(db.Float, nullable=False)
+    _holdings_value = db.Column(db.Float, nullable=False)
+    _final_value = db.Column(db.Float, nullable=False)
+    _positions = db.Column(db.Integer, nullable=False)
+    _archived = db.Column(db.DateTime, nullable=False)
+
+    def read(self):
+        return {
+            "user_id": self._user_id,
+            "uid": self._uid,
+            "cash": self._cash,
+            "holdings_value": self._holdings_value,
+            "final_value": self._final_value,
+            "positions": self._positions,
+            "archived": self._archived.isoformat(),
+        }
+
+
+def expire_accounts(today=None):
+    """
+    Freezes every active account opened more than ACCOUNT_EXPIRY_WEEKS ago.
+
+    The sweep is a fixed number of set-based statements in one transaction, however many
+    accounts expire: one conditional UPDATE claims the accounts with a range scan of the
+    (_status, _accountdate) index, then the final values are archived, the holdings are
+    returned to the stocks' inventory at the current prices, the open lots are closed, the
+    balances are zeroed and the ledger events are appended, each as one INSERT ... SELECT,
+    UPDATE or DELETE over the claimed accounts. Trading checks the status flag, so an expired
+    account is refused without recomputing dates. Run it daily, e.g. from cron.
+
+    Parameters:
+    - today (date): The day to sweep as of, defaults to today.
+
+    Returns:
+    - dict: The number of accounts expired and positions liquidated, and elapsed seconds.
+    """
+    start = time.perf_counter()
+    cutoff = (today or date.today()) - timedelta(weeks=app.config['ACCOUNT_EXPIRY_WEEKS'])
+    now = datetime.utcnow()
+    expiring = select(StockUser.id).where(StockUser._status == EXPIRING)
+    held = (select(StockHolding._user_id, StockHolding._stock_id, StockHolding._quantity, StockHolding._cost_basis)
+            .where(StockHolding._user_id.in_(expiring), StockHolding._quantity > 0))
+    try:
+        claimed = db.session.execute(
+            update(StockUser)
+            .where(StockUser._status == StockUser.ACTIVE, StockUser._accountdate <= cutoff)
+            .values(_status=EXPIRING)
+            .execution_options(synchronize_session=False)).rowcount
+        if claimed == 0:
+            db.session.rollback()
+            return {"expired": 0, "positions": 0, "elapsed": round(time.perf_counter() - start, 3)}
+
+        holdings_value = func.coalesce(func.sum(StockHolding._quantity * TableStock._sheesh), 0.0)
+        db.session.execute(StockAccountArchive.__table__.insert().from_select(
+            ['_user_id', '_uid', '_cash', '_holdings_value', '_final_value', '_positions', '_archived'],
+            select(StockUser.id, StockUser._uid, StockUser._stockmoney, holdings_value,
+                   StockUser._stockmoney + holdings_value, func.count(StockHolding._stock_id), literal(now))
+            .select_from(StockUser)
+            .outerjoin(StockHolding, (StockHolding._user_id == StockUser.id) & (StockHolding._quantity > 0))
+            .outerjoin(TableStock, TableStock.id == StockHolding._stock_id)
+            .where(StockUser._status == EXPIRING)
+            .group_by(StockUser.id, StockUser._uid, StockUser._stockmoney)))
+
+        events = TradeEvent.__table__
+        columns = ['_kind', '_user_id', '_stock_id', '_cash', '_shares', '_cost', '_inventory', '_created']
+        held = held.subquery()
+        positions = db.session.execute(events.insert().from_select(columns, select(
+            literal('expire'), held.c._user_id, held.c._stock_id, literal(0.0), -held.c._quantity,
+            -held.c._cost_basis, held.c._quantity, literal(now)))).rowcount
+        db.session.execute(events.insert().from_select(columns, select(
+            literal('expire'), StockUser.id, null(), -StockUser._stockmoney, literal(0), literal(0.0), literal(0),
+            literal(now)).where(StockUser._status == EXPIRING)))
+
+        returned = (select(func.sum(StockHolding._quantity))
+                    .where(StockHolding._stock_id == TableStock.id, StockHolding._user_id.in_(expiring))
+                    .scalar_subquery())
+        db.session.execute(
+            update(TableStock)
+            .where(TableStock.id.in_(select(held.c._stock_id)))
+            .values(_quantity=TableStock._quantity + returned)
+            .execution_options(synchronize_session=False))
+        db.session.execute(
+            update(StockLot)
+            .where(StockLot._open == True, StockLot._user_id.in_(expiring))
+            .values(_open=False, _remaining=0)
+            .execution_options(synchronize_session=False))
+        db.session.query(StockHolding).filter(StockHolding._user_id.in_(expiring)).delete(synchronize_session=False)
+        expired = db.session.execute(
+            update(StockUser)
+            .where(StockUser._status == EXPIRING)
+            .values(_status=StockUser.EXPIRED, _stockmoney=0)
+            .execution_options(synchronize_session=False)).rowcount
+
+        bump_version(StockUser.VERSION_NAME)
+        bump_version(PriceSnapshot.VERSION_NAME)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    # liquidated shares are back in the inventory
+    price_snapshot.reload()
+    return {"expired": expired, "positions": positions, "elapsed": round(time.perf_counter() - start, 3)}
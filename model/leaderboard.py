@@ -0,0 +1,114 @@
+""" Section leaderboards of the stock game, ranked by total account value """
+import threading
+
+import numpy as np
+
+from __init__ import db
+from model.cache import VersionStamp
+from model.events import last_event_id
+from model.stocks import StockUser, StockHolding, price_snapshot
+from model.user import User, UserSection
+
+
+class Leaderboard:
+    """
+    Ranks stock accounts by cash plus holdings at current prices.
+
+    Holdings are loaded as a sparse user x stock matrix in coordinate form (row, column,
+    quantity) and the prices as a vector indexed by the same stock columns, so every account
+    value is one sparse matrix-vector product: np.bincount sums quantity * price per row.
+
+    Rankings are cached per section and stamped with the price version, the stock account version
+    and the id of the newest trade event. Trades move only the last, which is read from the
+    append-only event log, so orders never contend on a shared counter row; a trade shows in the
+    ranking within CACHE_VERSION_CHECK_INTERVAL.
+    """
+    def __init__(self):
+        self._accounts = VersionStamp(StockUser.VERSION_NAME)
+        self._trades = VersionStamp('trade_events', reader=last_event_id)
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def _load_accounts(self, section_id):
+        """Returns (stock user ids, uids, names, cash) of every account, or of one section."""
+        query = (db.session.query(StockUser.id, StockUser._uid, User._name, StockUser._stockmoney)
+                 .join(User, User._uid == StockUser._uid))
+        if section_id is not None:
+            query = query.join(UserSection, UserSection.user_id == User.id).filter(UserSection.section_id == section_id)
+        rows = query.order_by(StockUser.id).all()
+        ids = np.array([row[0] for row in rows], dtype=np.int64)
+        cash = np.array([row[3] for row in rows], dtype=np.float64)
+        return ids, [row[1] for row in rows], [row[2] for row in rows], cash
+
+    def _load_holdings(self, section_id):
+        """Returns the (stock user id, stock id, quantity) triples of every open position."""
+        query = db.session.query(StockHolding._user_id, StockHolding._stock_id, StockHolding._quantity)
+        if section_id is not None:
+            query = (query.join(StockUser, StockUser.id == StockHolding._user_id)
+                     .join(User, User._uid == StockUser._uid)
+                     .join(UserSection, UserSection.user_id == User.id)
+                     .filter(UserSection.section_id == section_id))
+        rows = query.filter(StockHolding._quantity > 0).all()
+        # fromiter over plain values, np.array on Row objects probes each row for the array protocol
+        triples = np.fromiter((value for row in rows for value in row), dtype=np.int64, count=3 * len(rows)).reshape(-1, 3)
+        return triples[:, 0], triples[:, 1], triples[:, 2].astype(np.float64)
+
+    def compute(self, section_id=None):
+        """
+        Ranks every account, or the accounts of one section, by total value.
+
+        Parameters:
+        - section_id (int): The section to rank, None for every account.
+
+        Returns:
+        - list: One dictionary per account, ordered by rank.
+        """
+        ids, uids, names, cash = self._load_accounts(section_id)
+        if len(ids) == 0:
+            return []
+        user_ids, stock_ids, quantities = self._load_holdings(section_id)
+
+        quotes = price_snapshot.all()
+        stock_index = np.array([quote.id for quote in quotes], dtype=np.int64)
+        prices = np.array([quote.price for quote in quotes], dtype=np.float64)
+        order = np.argsort(stock_index)
+        stock_index, prices = stock_index[order], prices[order]
+
+        # map database ids to matrix rows and price vector columns
+        rows = np.searchsorted(ids, user_ids)
+        columns = np.searchsorted(stock_index, stock_ids)
+        known = columns < len(stock_index)
+        known[known] = stock_index[columns[known]] == stock_ids[known]
+        holdings = np.bincount(rows[known], weights=quantities[known] * prices[columns[known]], minlength=len(ids))
+        totals = cash + holdings
+
+        ranking = np.argsort(-totals, kind='stable')
+        return [
+            {
+                "rank": rank,
+                "uid": uids[i],
+                "name": names[i],
+                "cash": float(cash[i]),
+                "holdings": round(float(holdings[i]), 2),
+                "total": round(float(totals[i]), 2),
+            }
+            for rank, i in enumerate(ranking, start=1)
+        ]
+
+    def get(self, section_id=None):
+        """Returns the cached ranking of a section, recomputing it when prices or accounts changed."""
+        version = (price_snapshot.version, self._accounts.current(), self._trades.current())
+        cached = self._cache.get(section_id)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        with self._lock:
+            cached = self._cache.get(section_id)
+            if cached is not None and cached[0] == version:
+                return cached[1]
+            ranking = self.compute(section_id)
+            self._cache[section_id] = (version, ranking)
+            return ranking
+
+
+# one leaderboard cache per worker process
+leaderboard = Leaderboard()
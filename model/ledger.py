@@ -0,0 +1,292 @@
+""" Snapshots, rebuild and reconciliation of balances, holdings and inventory from the trade event log """
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import bindparam, func
+
+from __init__ import app, db
+from model.cache import bump_version
+from model.events import TradeEvent
+from model.stocks import PriceSnapshot, StockHolding, StockLot, StockUser, TableStock
+
+# events younger than this are left to the next snapshot, so transactions still in flight with
+# lower event ids have committed before a snapshot passes them
+SNAPSHOT_LAG_SECONDS = 10
+# float tolerance when comparing balances and cost bases
+TOLERANCE = 0.01
+
+
+class LedgerSnapshot(db.Model):
+    """
+    LedgerSnapshot Model
+
+    The state of every balance, holding and inventory after a given event, so a rebuild loads
+    the latest snapshot and replays only the events after it.
+
+    Attributes:
+        id (Column): The primary key.
+        _event_id (Column): The last TradeEvent included in the snapshot.
+        _source (Column): 'ledger' when replayed from the log, 'live' when copied from the live tables.
+        _created (Column): When the snapshot was taken.
+    """
+    __tablename__ = 'ledger_snapshots'
+
+    id = db.Column(db.Integer, primary_key=True)
+    _event_id = db.Column(db.Integer, nullable=False)
+    _source = db.Column(db.String(16), nullable=False)
+    _created = db.Column(db.DateTime, nullable=False)
+
+    def __init__(self, event_id, source):
+        self._event_id = event_id
+        self._source = source
+        self._created = datetime.utcnow()
+
+    def read(self):
+        return {"id": self.id, "event_id": self._event_id, "source": self._source, "created": self._created}
+
+
+class LedgerSnapshotRow(db.Model):
+    """
+    LedgerSnapshotRow Model
+
+    One balance (user only), holding (user and stock) or inventory (stock only) of a snapshot,
+    stored with the same delta columns as TradeEvent, so a snapshot replays like a compacted
+    prefix of the log.
+
+    Attributes:
+        id (Column): The primary key.
+        _snapshot_id (Column): Foreign key to the 'ledger_snapshots' table.
+        _user_id (Column): The StockUser id of a balance or holding.
+        _stock_id (Column): The TableStock id of a holding or inventory.
+        _cash (Column): The balance.
+        _shares (Column): The shares held.
+        _cost (Column): The cost basis of the holding.
+        _inventory (Column): The stock's available quantity.
+    """
+    __tablename__ = 'ledger_snapshot_rows'
+
+    id = db.Column(db.Integer, primary_key=True)
+    _snapshot_id = db.Column(db.Integer, db.ForeignKey('ledger_snapshots.id', ondelete='CASCADE'), nullable=False, index=True)
+    _user_id = db.Column(db.Integer, nullable=True)
+    _stock_id = db.Column(db.Integer, nullable=True)
+    _cash = db.Column(db.Float, nullable=False, default=0)
+    _shares = db.Column(db.Integer, nullable=False, default=0)
+    _cost = db.Column(db.Float, nullable=False, default=0)
+    _inventory = db.Column(db.BigInteger, nullable=False, default=0)
+
+
+class LedgerState:
+    """Balances, holdings and inventory accumulated from snapshot rows and events."""
+    def __init__(self):
+        self.cash = {}
+        self.holdings = {}
+        self.inventory = {}
+        self.event_id = 0
+        self.snapshot_id = None
+        self.replayed = 0
+
+    def apply(self, user_id, stock_id, cash, shares, cost, inventory):
+        if user_id is not None:
+            self.cash[user_id] = self.cash.get(user_id, 0.0) + cash
+            if stock_id is not None:
+                held_shares, held_cost = self.holdings.get((user_id, stock_id), (0, 0.0))
+                self.holdings[(user_id, stock_id)] = (held_shares + shares, held_cost + cost)
+        if stock_id is not None:
+            self.inventory[stock_id] = self.inventory.get(stock_id, 0) + inventory
+
+    def open_holdings(self):
+        return {key: value for key, value in self.holdings.items() if value[0] != 0}
+
+    def rows(self):
+        """Returns the state as snapshot row dictionaries."""
+        rows = [{"_user_id": user_id, "_stock_id": None, "_cash": cash, "_shares": 0, "_cost": 0.0, "_inventory": 0}
+                for user_id, cash in self.cash.items()]
+        rows += [{"_user_id": user_id, "_stock_id": stock_id, "_cash": 0.0, "_shares": shares, "_cost": cost, "_inventory": 0}
+                 for (user_id, stock_id), (shares, cost) in self.open_holdings().items()]
+        rows += [{"_user_id": None, "_stock_id": stock_id, "_cash": 0.0, "_shares": 0, "_cost": 0.0, "_inventory": quantity}
+                 for stock_id, quantity in self.inventory.items()]
+        return rows
+
+
+def load_state(upto=None):
+    """
+    Loads the latest snapshot and replays the events after it, streaming both.
+
+    Parameters:
+    - upto (int): Replay events up to and including this id, defaults to the end of the log.
+
+    Returns:
+    - LedgerState: The replayed state.
+    """
+    state = LedgerState()
+    snapshot = LedgerSnapshot.query.order_by(LedgerSnapshot.id.desc()).first()
+    if snapshot is not None:
+        state.snapshot_id = snapshot.id
+        state.event_id = snapshot._event_id
+        rows = (db.session.query(LedgerSnapshotRow._user_id, LedgerSnapshotRow._stock_id, LedgerSnapshotRow._cash,
+                                 LedgerSnapshotRow._shares, LedgerSnapshotRow._cost, LedgerSnapshotRow._inventory)
+                .filter(LedgerSnapshotRow._snapshot_id == snapshot.id)
+                .yield_per(1000))
+        for row in rows:
+            state.apply(*row)
+    events = (db.session.query(TradeEvent.id, TradeEvent._user_id, TradeEvent._stock_id, TradeEvent._cash,
+                               TradeEvent._shares, TradeEvent._cost, TradeEvent._inventory)
+              .filter(TradeEvent.id > state.event_id))
+    if upto is not None:
+        events = events.filter(TradeEvent.id <= upto)
+    for event_id, *deltas in events.order_by(TradeEvent.id).yield_per(1000):
+        state.apply(*deltas)
+        state.event_id = event_id
+        state.replayed += 1
+    return state
+
+
+def _live_state():
+    """Reads the live tables into a LedgerState."""
+    state = LedgerState()
+    for user_id, cash in db.session.query(StockUser.id, StockUser._stockmoney).yield_per(1000):
+        state.cash[user_id] = float(cash)
+    for user_id, stock_id, shares, cost in db.session.query(
+            StockHolding._user_id, StockHolding._stock_id, StockHolding._quantity, StockHolding._cost_basis).yield_per(1000):
+        state.holdings[(user_id, stock_id)] = (shares, cost)
+    for stock_id, quantity in db.session.query(TableStock.id, TableStock._quantity).yield_per(1000):
+        state.inventory[stock_id] = quantity
+    return state
+
+
+def take_snapshot(from_live=False):
+    """
+    Writes a snapshot of the ledger and keeps the LEDGER_SNAPSHOT_KEEP most recent ones.
+
+    Parameters:
+    - from_live (bool): Copy the live tables instead of replaying the log. Use it once to start
+      the ledger of a database that has trades from before the event log existed.
+
+    Returns:
+    - dict: The snapshot and the number of rows written.
+    """
+    start = time.perf_counter()
+    if from_live:
+        upto = db.session.query(func.max(TradeEvent.id)).scalar() or 0
+        state = _live_state()
+        state.event_id = upto
+    else:
+        cutoff = datetime.utcnow() - timedelta(seconds=SNAPSHOT_LAG_SECONDS)
+        upto = db.session.query(func.max(TradeEvent.id)).filter(TradeEvent._created < cutoff).scalar() or 0
+        state = load_state(upto)
+    snapshot = LedgerSnapshot(state.event_id, 'live' if from_live else 'ledger')
+    rows = state.rows()
+    try:
+        db.session.add(snapshot)
+        db.session.flush()
+        for row in rows:
+            row["_snapshot_id"] = snapshot.id
+        if rows:
+            db.session.execute(LedgerSnapshotRow.__table__.insert(), rows)
+        keep = (db.session.query(LedgerSnapshot.id)
+                .order_by(LedgerSnapshot.id.desc())
+                .limit(app.config['LEDGER_SNAPSHOT_KEEP'])
+                .all())
+        stale = LedgerSnapshot.id.notin_([snapshot_id for snapshot_id, in keep])
+        stale_ids = [snapshot_id for snapshot_id, in db.session.query(LedgerSnapshot.id).filter(stale)]
+        if stale_ids:
+            db.session.query(LedgerSnapshotRow).filter(LedgerSnapshotRow._snapshot_id.in_(stale_ids)).delete(synchronize_session=False)
+            db.session.query(LedgerSnapshot).filter(LedgerSnapshot.id.in_(stale_ids)).delete(synchronize_session=False)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    result = snapshot.read()
+    result.update({"rows": len(rows), "replayed": state.replayed, "elapsed": round(time.perf_counter() - start, 3)})
+    return result
+
+
+def reconcile(limit=50):
+    """
+    Verifies the live balances, holdings and inventory against the ledger.
+
+    The ledger side is the latest snapshot plus one streaming pass over the events after it;
+    the live side is one streaming read of each table.
+
+    Returns:
+    - dict: The event the ledger was replayed to, counts checked, and the first limit mismatches.
+    """
+    start = time.perf_counter()
+    ledger = load_state()
+    live = _live_state()
+    mismatches = []
+
+    def compare(kind, key, expected, actual):
+        if isinstance(expected, tuple):
+            same = expected[0] == actual[0] and abs(expected[1] - actual[1]) <= TOLERANCE
+        else:
+            same = abs(expected - actual) <= TOLERANCE
+        if not same:
+            mismatches.append({"kind": kind, "key": key, "ledger": expected, "live": actual})
+
+    for user_id in ledger.cash.keys() | live.cash.keys():
+        compare("balance", user_id, ledger.cash.get(user_id, 0.0), live.cash.get(user_id, 0.0))
+    ledger_holdings = ledger.open_holdings()
+    for key in ledger_holdings.keys() | live.holdings.keys():
+        compare("holding", list(key), ledger_holdings.get(key, (0, 0.0)), live.holdings.get(key, (0, 0.0)))
+    for stock_id in ledger.inventory.keys() | live.inventory.keys():
+        compare("inventory", stock_id, ledger.inventory.get(stock_id, 0), live.inventory.get(stock_id, 0))
+
+    return {
+        "event_id": ledger.event_id,
+        "snapshot_id": ledger.snapshot_id,
+        "replayed": ledger.replayed,
+        "checked": {"balances": len(live.cash), "holdings": len(live.holdings), "inventory": len(live.inventory)},
+        "mismatch_count": len(mismatches),
+        "mismatches": mismatches[:limit],
+        "elapsed": round(time.perf_counter() - start, 3),
+    }
+
+
+def rebuild():
+    """
+    Rewrites balances, holdings and inventory from the ledger in one transaction.
+
+    Lot counts of the rebuilt holdings come from the open tax lots.
+
+    Returns:
+    - dict: The event the ledger was replayed to and the rows written.
+    """
+    start = time.perf_counter()
+    state = load_state()
+    holdings = state.open_holdings()
+    lot_counts = dict(((user_id, stock_id), count) for user_id, stock_id, count in
+                      db.session.query(StockLot._user_id, StockLot._stock_id, func.count(StockLot.id))
+                      .filter(StockLot._open == True)
+                      .group_by(StockLot._user_id, StockLot._stock_id))
+    users = StockUser.__table__
+    stocks = TableStock.__table__
+    try:
+        if state.cash:
+            db.session.execute(
+                users.update().where(users.c.id == bindparam('b_id')).values(_stockmoney=bindparam('b_cash')),
+                [{"b_id": user_id, "b_cash": cash} for user_id, cash in state.cash.items()])
+        db.session.query(StockHolding).delete()
+        if holdings:
+            db.session.execute(StockHolding.__table__.insert(), [
+                {"_user_id": user_id, "_stock_id": stock_id, "_quantity": shares, "_cost_basis": cost,
+                 "_lot_count": lot_counts.get((user_id, stock_id), 0)}
+                for (user_id, stock_id), (shares, cost) in holdings.items()])
+        if state.inventory:
+            db.session.execute(
+                stocks.update().where(stocks.c.id == bindparam('b_id')).values(_quantity=bindparam('b_quantity')),
+                [{"b_id": stock_id, "b_quantity": quantity} for stock_id, quantity in state.inventory.items()])
+        bump_version(StockUser.VERSION_NAME)
+        bump_version(PriceSnapshot.VERSION_NAME)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return {
+        "event_id": state.event_id,
+        "replayed": state.replayed,
+        "balances": len(state.cash),
+        "holdings": len(holdings),
+        "inventory": len(state.inventory),
+        "elapsed": round(time.perf_counter() - start, 3),
+    }
@@ -0,0 +1,163 @@
+""" Bulk loader of the stock table from stocks_table_exp.csv """
+import csv
+import io
+import time
+
+from __init__ import app, db
+from model.cache import UPSERT_INSERTS, bump_version
+from model.constants import MAX_QUANTITY, STOCKS_CSV
+from model.events import record_events
+from model.search import stock_search
+from model.stocks import PriceSnapshot, StockPriceHistory, TableStock, price_snapshot
+
+
+def _upsert(rows):
+    """Inserts or updates rows keyed on the unique _symbol with one dialect-native statement."""
+    dialect = db.session.get_bind().dialect.name
+    insert = UPSERT_INSERTS.get(dialect)
+    if insert is None:
+        # no native upsert, the rows were classified against the table inside this transaction
+        for row in rows:
+            stock = TableStock.query.filter_by(_symbol=row['_symbol']).first()
+            if stock is None:
+                db.session.add(TableStock(row['_symbol'], row['_company'], row['_quantity'], row['_sheesh']))
+            else:
+                stock._company, stock._quantity, stock._sheesh = row['_company'], row['_quantity'], row['_sheesh']
+        db.session.flush()
+        return
+    # executemany of one cached statement, SQLAlchemy batches the rows into multi-row VALUES
+    statement = insert(TableStock.__table__)
+    if dialect in ('mysql', 'mariadb'):
+        statement = statement.on_duplicate_key_update(
+            _company=statement.inserted._company,
+            _quantity=statement.inserted._quantity,
+            _sheesh=statement.inserted._sheesh)
+    else:
+        statement = statement.on_conflict_do_update(
+            index_elements=['_symbol'],
+            set_={'_company': statement.excluded._company,
+                  '_quantity': statement.excluded._quantity,
+                  '_sheesh': statement.excluded._sheesh})
+    db.session.execute(statement, rows)
+
+
+def _read_rows(stream):
+    """Yields (line number, row dict or error message) from a _symbol,_company,_quantity,_sheesh CSV."""
+    for line, record in enumerate(csv.DictReader(stream), start=2):
+        try:
+            symbol = record['_symbol'].strip().upper()
+            if not symbol:
+                raise ValueError('empty _symbol')
+            quantity = int(record['_quantity'])
+            if not 0 <= quantity <= MAX_QUANTITY:
+                raise ValueError(f'_quantity {quantity} outside 0..{MAX_QUANTITY}')
+            yield line, {
+                '_symbol': symbol,
+                '_company': record['_company'].strip(),
+                '_quantity': quantity,
+                '_sheesh': float(record['_sheesh']),
+            }
+        except (KeyError, TypeError, ValueError, AttributeError) as e:
+            yield line, f"line {line}: {type(e).__name__} {str(e)}"
+
+
+def load_stocks(stream=None, batch_size=None):
+    """
+    Streams a stock CSV into TableStock, upserting in batches keyed on symbol.
+
+    Each batch is classified against the table with one SELECT of its symbols, then the inserted
+    and changed rows are written with one INSERT ... ON CONFLICT (or ON DUPLICATE KEY) statement,
+    so unchanged rows cost no write and a reload never duplicates a symbol. The whole load is one
+    transaction; the prices of inserted and repriced stocks are recorded in the price history,
+    and the price and catalog versions are bumped once so every worker reloads its snapshot and
+    search index.
+
+    Parameters:
+    - stream (file): A text stream of the CSV, defaults to the bundled stocks_table_exp.csv.
+    - batch_size (int): Rows per upsert statement, defaults to STOCK_LOAD_BATCH_SIZE.
+
+    Returns:
+    - dict: Counts of inserted, updated, unchanged and skipped rows, the first errors and elapsed seconds.
+    """
+    start = time.perf_counter()
+    batch_size = batch_size or app.config['STOCK_LOAD_BATCH_SIZE']
+    own_stream = stream is None
+    if own_stream:
+        stream = open(STOCKS_CSV, newline='')
+    counts = {"inserted": 0, "updated": 0, "unchanged": 0, "skipped": 0}
+    errors = []
+    price_changes = {}
+
+    def flush(batch):
+        existing = {
+            symbol: (stockid, company, quantity, price)
+            for stockid, symbol, company, quantity, price in db.session.query(
+                TableStock.id, TableStock._symbol, TableStock._company, TableStock._quantity, TableStock._sheesh)
+            .filter(TableStock._symbol.in_(batch.keys()))
+        }
+        writes = []
+        events = []
+        for symbol, row in batch.items():
+            current = existing.get(symbol)
+            if current is None:
+                counts["inserted"] += 1
+            elif current[1:] == (row['_company'], row['_quantity'], row['_sheesh']):
+                counts["unchanged"] += 1
+                continue
+            else:
+                counts["updated"] += 1
+                if current[3] != row['_sheesh']:
+                    price_changes[current[0]] = row['_sheesh']
+                if current[2] != row['_quantity']:
+                    events.append({"kind": 'supply', "stock_id": current[0], "inventory": row['_quantity'] - current[2]})
+            writes.append(row)
+        if writes:
+            _upsert(writes)
+        inserted = [symbol for symbol in batch if symbol not in existing]
+        if inserted:
+            # the ledger records the starting inventory of new stocks, the price history their first price
+            for stockid, quantity, price in (db.session.query(TableStock.id, TableStock._quantity, TableStock._sheesh)
+                                             .filter(TableStock._symbol.in_(inserted))):
+                events.append({"kind": 'supply', "stock_id": stockid, "inventory": quantity})
+                price_changes[stockid] = price
+        record_events(events)
+
+    try:
+        batch = {}
+        for line, row in _read_rows(stream):
+            if isinstance(row, str):
+                counts["skipped"] += 1
+                if len(errors) < 10:
+                    errors.append(row)
+                continue
+            # a symbol repeated in the file keeps its last row
+            batch[row['_symbol']] = row
+            if len(batch) >= batch_size:
+                flush(batch)
+                batch = {}
+        if batch:
+            flush(batch)
+        if counts["inserted"] or counts["updated"]:
+            if price_changes:
+                StockPriceHistory.record(price_changes)
+                TableStock._run_price_write_hooks(price_changes)
+            bump_version(PriceSnapshot.VERSION_NAME)
+            bump_version(TableStock.CATALOG_VERSION)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    finally:
+        if own_stream:
+            stream.close()
+    if counts["inserted"] or counts["updated"]:
+        price_snapshot.reload()
+        stock_search.rebuild()
+    counts["errors"] = errors
+    counts["elapsed"] = round(time.perf_counter() - start, 3)
+    return counts
+
+
+def load_stocks_upload(data):
+    """Loads an uploaded CSV given as bytes, see load_stocks."""
+    return load_stocks(io.StringIO(data.decode('utf-8-sig'), newline=''))
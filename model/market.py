@@ -0,0 +1,132 @@
+""" Simulated stock market, an offline replacement for the live quote feed """
+import math
+import os
+import socket
+import threading
+import time
+from datetime import datetime
+
+import numpy as np
+
+from __init__ import app, db
+from model.market_parameters import TRADING_YEAR, DEFAULT_DRIFT, DEFAULT_VOLATILITY, load_parameters
+from model.stocks import TableStock, price_snapshot
+from model.scheduler import SchedulerLease
+
+
+class MarketSimulator:
+    """
+    Advances every stock price with vectorized geometric Brownian motion.
+
+    Each tick draws one normal per symbol and applies
+        price *= exp((drift - volatility^2 / 2) * dt + volatility * sqrt(dt) * z)
+    to the whole price vector at once, then writes the new prices through
+    TableStock.bulk_update_prices, the same path as the live feed. dt is the tick interval
+    times SIM_TIME_SCALE in trading years, so a demo can run a trading day in minutes.
+
+    Like the price scheduler it runs under a database lease, so one process moves the market
+    however many workers are started.
+    """
+    LEASE_NAME = 'market_simulator'
+
+    def __init__(self, seed=None):
+        seed = app.config['SIM_SEED'] if seed is None else seed
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self._rng = np.random.default_rng(seed)
+        self._parameters = None
+        self._symbols = None
+        self._prices = None
+        self._drift = None
+        self._volatility = None
+        self._thread = None
+        self._stop = threading.Event()
+        self.metrics = {"ticks": 0, "skipped": 0, "last_tick": None, "last_latency": None, "last_updated": 0}
+
+    def _ensure(self):
+        """Aligns the price, drift and volatility vectors with the symbols of the stock table."""
+        quotes = price_snapshot.all()
+        symbols = [quote.symbol for quote in quotes]
+        if symbols == self._symbols:
+            return
+        if self._parameters is None:
+            self._parameters = load_parameters()
+        self._symbols = symbols
+        self._prices = np.array([quote.price for quote in quotes], dtype=np.float64)
+        parameters = [self._parameters.get(symbol, (DEFAULT_DRIFT, DEFAULT_VOLATILITY)) for symbol in symbols]
+        self._drift = np.array([drift for drift, _ in parameters], dtype=np.float64)
+        self._volatility = np.array([volatility for _, volatility in parameters], dtype=np.float64)
+
+    def step(self, seconds=None):
+        """
+        Advances the market by one tick and writes every price with one bulk update.
+
+        Parameters:
+        - seconds (float): Wall seconds the tick covers, defaults to SIM_TICK_INTERVAL.
+
+        Returns:
+        - int: The number of prices written.
+        """
+        self._ensure()
+        if not self._symbols:
+            return 0
+        seconds = app.config['SIM_TICK_INTERVAL'] if seconds is None else seconds
+        dt = seconds * app.config['SIM_TIME_SCALE'] / TRADING_YEAR
+        shocks = self._rng.standard_normal(len(self._prices))
+        self._prices *= np.exp((self._drift - 0.5 * self._volatility ** 2) * dt + self._volatility * math.sqrt(dt) * shocks)
+        prices = dict(zip(self._symbols, np.round(self._prices, 4).tolist()))
+        return TableStock.bulk_update_prices(prices)
+
+    def run_once(self):
+        """Runs one tick if this process holds the lease, returns the prices written or None."""
+        started = time.monotonic()
+        lease_ttl = max(app.config['SIM_TICK_INTERVAL'] * 3, 5)
+        if not SchedulerLease.acquire(self.LEASE_NAME, self.owner, lease_ttl):
+            self.metrics["skipped"] += 1
+            # another process moves the market, resync from its prices when taking over
+            self._symbols = None
+            return None
+        updated = self.step()
+        self.metrics["ticks"] += 1
+        self.metrics["last_tick"] = datetime.utcnow().isoformat()
+        self.metrics["last_latency"] = round(time.monotonic() - started, 4)
+        self.metrics["last_updated"] = updated
+        return updated
+
+    def status(self):
+        """Returns the tick metrics of this process, as PriceScheduler.status does, and the current lease holder."""
+        metrics = dict(self.metrics)
+        metrics["running"] = self._thread is not None and self._thread.is_alive()
+        metrics["tick_interval"] = app.config['SIM_TICK_INTERVAL']
+        metrics["time_scale"] = app.config['SIM_TIME_SCALE']
+        lease = db.session.get(SchedulerLease, self.LEASE_NAME)
+        return {"process": self.owner, "metrics": metrics, "lease": lease.read() if lease else None}
+
+    def loop(self):
+        """Ticks every SIM_TICK_INTERVAL seconds until stop(), on a fixed schedule without drift."""
+        interval = app.config['SIM_TICK_INTERVAL']
+        next_tick = time.monotonic()
+        while not self._stop.is_set():
+            with app.app_context():
+                try:
+                    self.run_once()
+                except Exception as e:
+                    db.session.rollback()
+                    print(f"Market simulator tick failed: {str(e)}")
+                finally:
+                    db.session.remove()
+            next_tick = max(next_tick + interval, time.monotonic())
+            self._stop.wait(next_tick - time.monotonic())
+
+    def start(self):
+        """Starts the loop in a daemon thread of this process."""
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self.loop, name='market-simulator', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+
+# one simulator per worker process, the lease decides which one ticks
+market_simulator = MarketSimulator()
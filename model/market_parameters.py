@@ -0,0 +1,36 @@
+""" Drift and volatility of the simulated market, shared with the standalone quote server, importing it never starts the app """
+import csv
+import math
+import zlib
+
+import numpy as np
+
+from model.constants import STOCKS_CSV
+
+# trading seconds in a year, 252 sessions of 6.5 hours
+TRADING_YEAR = 252 * 6.5 * 3600
+DEFAULT_DRIFT = 0.07
+DEFAULT_VOLATILITY = 0.30
+
+
+def load_parameters(path=STOCKS_CSV):
+    """
+    Derives an annual drift and volatility for every symbol of the seed CSV.
+
+    Volatility falls with the size column (_quantity, market cap) from 60% for a $10B company
+    to 15% at $10T and above, and both values get a small offset seeded from the symbol, so each
+    symbol moves differently but identically from run to run.
+
+    Returns:
+    - dict: symbol -> (drift, volatility)
+    """
+    parameters = {}
+    with open(path, newline='') as f:
+        for row in csv.DictReader(f):
+            symbol = row['_symbol']
+            rng = np.random.default_rng(zlib.crc32(symbol.encode()))
+            size = math.log10(max(float(row['_quantity'] or 0), 1e9))
+            volatility = min(0.60, max(0.15, 0.60 - 0.15 * (size - 10))) * rng.uniform(0.8, 1.2)
+            drift = DEFAULT_DRIFT + rng.normal(0, 0.05)
+            parameters[symbol] = (drift, volatility)
+    return parameters
@@ -0,0 +1,384 @@
+""" Order execution service for the stock game """
+import time
+from datetime import date, datetime
+
+from dateutil.relativedelta import relativedelta
+
+from sqlalchemy import update
+from sqlalchemy.exc import IntegrityError, OperationalError
+
+from __init__ import app, db
+from model.constants import MAX_QUANTITY
+from model.events import record_event
+from model.stocks import TableStock, StockUser, StockTransaction, UserTransactionStock, StockHolding, StockLot, StockLotSale, price_snapshot
+
+
+ALL_OR_NOTHING = 'all_or_nothing'
+BEST_EFFORT = 'best_effort'
+ORDER_MODES = (ALL_OR_NOTHING, BEST_EFFORT)
+
+
+class OrderError(Exception):
+    """Raised inside an order transaction when the order cannot be filled."""
+    def __init__(self, message, code=400):
+        super().__init__(message)
+        self.message = message
+        self.code = code
+
+
+def _is_quantity(quantity):
+    """True for a positive int share count within the BIGINT range, False for bools, which are ints too."""
+    return isinstance(quantity, int) and not isinstance(quantity, bool) and 0 < quantity <= MAX_QUANTITY
+
+
+def _cash(amount):
+    """Rounds a cash amount to the whole units that balances, transaction amounts and tax are stored in."""
+    return int(round(amount))
+
+
+def _resolve_user(uid):
+    """Returns the StockUser id for a uid or raises OrderError."""
+    if not isinstance(uid, str):
+        raise OrderError("uid must be a string")
+    user = db.session.query(StockUser.id, StockUser._status).filter(StockUser._uid == uid).first()
+    if user is None:
+        raise OrderError("Can't find user in StockUser table. Possible fix: Run /initilize first to log user in StockUser table", 404)
+    if user._status != StockUser.ACTIVE:
+        raise OrderError("Account has expired", 403)
+    return user.id
+
+
+def _resolve_stocks(symbols):
+    """
+    Returns {symbol: (id, price)} for the requested symbols that are strings and exist.
+
+    The prices are read from the stock table inside the order transaction, with one query on the
+    unique symbol index, so an order fills at the committed price and never at a worker's price
+    snapshot that has not yet seen the latest price write.
+    """
+    symbols = {symbol for symbol in symbols if isinstance(symbol, str)}
+    if not symbols:
+        return {}
+    rows = (db.session.query(TableStock._symbol, TableStock.id, TableStock._sheesh)
+            .filter(TableStock._symbol.in_(symbols)))
+    return {symbol: (stockid, price) for symbol, stockid, price in rows}
+
+
+def _resolve_stock(symbol):
+    """Returns the (id, price) of a stock symbol, read as in _resolve_stocks, or raises OrderError."""
+    if not isinstance(symbol, str):
+        raise OrderError("Symbol must be a string")
+    stock = _resolve_stocks([symbol]).get(symbol)
+    if stock is None:
+        raise OrderError(f"No such stock exists: {symbol}", 404)
+    return stock
+
+
+def _apply_fills(fills):
+    """Applies the inventory change of committed fills to this worker's price snapshot."""
+    for fill in fills:
+        delta = fill["quantity"] if fill.get("side") == "sell" else -fill["quantity"]
+        price_snapshot.adjust_quantity(fill["stock_id"], delta)
+
+
+def _buy(userid, stockid, price, quantity, transaction_date):
+    """
+    Applies one buy inside the caller's transaction.
+
+    The balance check and debit are a single conditional UPDATE, so two concurrent buys can
+    never both spend the same money, and the inventory decrement is guarded the same way.
+    The balance is charged the value rounded to whole units, the lot keeps the exact cost.
+    Nothing is committed here.
+    """
+    if not _is_quantity(quantity):
+        raise OrderError("Quantity must be a positive integer")
+    value = quantity * price
+    amount = _cash(value)
+    if amount > MAX_QUANTITY:
+        # past what any balance column can hold, let alone cover
+        raise OrderError("Insufficient funds")
+    order_time = _order_time(transaction_date)
+
+    debit = db.session.execute(
+        update(StockUser)
+        .where(StockUser.id == userid, StockUser._status == StockUser.ACTIVE, StockUser._stockmoney >= amount)
+        .values(_stockmoney=StockUser._stockmoney - amount)
+        .execution_options(synchronize_session=False))
+    if debit.rowcount == 0:
+        raise OrderError("Insufficient funds")
+
+    inventory = db.session.execute(
+        update(TableStock)
+        .where(TableStock.id == stockid, TableStock._quantity >= quantity)
+        .values(_quantity=TableStock._quantity - quantity)
+        .execution_options(synchronize_session=False))
+    if inventory.rowcount == 0:
+        raise OrderError("Insufficient stock available")
+
+    transaction = StockTransaction(user_id=userid, transaction_type='buy', quantity=quantity, transaction_date=transaction_date)
+    db.session.add(transaction)
+    db.session.flush()  # assigns transaction.id for the link row
+    db.session.add(UserTransactionStock(user_id=userid, transaction_id=transaction.id, stock_id=stockid, quantity=quantity,
+                                        price_per_stock=price, transaction_amount=amount, transaction_time=order_time))
+    StockHolding.apply_buy(userid, stockid, quantity, value)
+    lot = StockLot(user_id=userid, stock_id=stockid, transaction_id=transaction.id, quantity=quantity, price=price,
+                   acquired=order_time)
+    db.session.add(lot)
+    db.session.flush()  # assigns lot.id so it can be sold by specific id
+    record_event('buy', user_id=userid, stock_id=stockid, transaction_id=transaction.id, price=price,
+                 cash=-amount, shares=quantity, cost=value, inventory=-quantity)
+    return {"transaction_id": transaction.id, "stock_id": stockid, "quantity": quantity, "price": price, "value": value,
+            "amount": amount, "lot_id": lot.id}
+
+
+def _order_time(transaction_date):
+    """Timestamp of an order's log rows and lot, now for today's orders and midnight for backdated ones."""
+    if transaction_date == date.today():
+        return datetime.now()
+    return datetime.combine(transaction_date, datetime.min.time())
+
+
+def _sell(userid, stockid, price, quantity, transaction_date, lots=None):
+    """
+    Applies one sell inside the caller's transaction.
+
+    The holdings row is locked first, so a user can never sell more shares than they hold,
+    then tax lots are consumed FIFO, or by specific id when lots is given. Each consumed lot
+    records its realized gain as long-term or short-term, tax is charged on the positive gain
+    of each term, and the proceeds after tax are credited. The proceeds and the tax are each
+    rounded to whole units. Nothing is committed here.
+    """
+    if lots:
+        if not isinstance(lots, list) or not all(isinstance(selection, dict) and _is_quantity(selection.get("quantity"))
+                                                 for selection in lots):
+            raise OrderError("Lots must be a list of {\"id\", \"quantity\"} objects")
+        selected = sum(selection["quantity"] for selection in lots)
+        if quantity is not None and quantity != selected:
+            raise OrderError(f"Quantity {quantity} does not match the {selected} shares selected in lots")
+        quantity = selected
+    if not _is_quantity(quantity):
+        raise OrderError("Quantity must be a positive integer")
+    value = quantity * price
+    amount = _cash(value)
+
+    holding = StockHolding.lock(userid, stockid)
+    if holding is None or holding.quantity < quantity:
+        raise OrderError("No stock to sell")
+    try:
+        if lots:
+            consumed = StockLot.consume_specific(userid, stockid, lots)
+        else:
+            consumed = StockLot.consume_fifo(userid, stockid, quantity)
+    except ValueError as e:
+        raise OrderError(str(e))
+
+    transaction = StockTransaction(user_id=userid, transaction_type='sell', quantity=quantity, transaction_date=transaction_date)
+    db.session.add(transaction)
+    db.session.flush()  # assigns transaction.id for the link and lot sale rows
+
+    sold_at = datetime.now()
+    realized = {"long": 0.0, "short": 0.0}
+    cost_basis = 0.0
+    lots_closed = 0
+    for lot, taken in consumed:
+        term = "long" if lot.is_long_term(sold_at) else "short"
+        cost = taken * lot.price
+        realized[term] += taken * price - cost
+        cost_basis += cost
+        lots_closed += 0 if lot.remaining else 1
+        db.session.add(StockLotSale(transaction_id=transaction.id, lot_id=lot.id, quantity=taken,
+                                    cost=cost, proceeds=taken * price, term=term))
+    holding.reduce(quantity, cost_basis, lots_closed)
+    tax = _cash(max(realized["long"], 0) * app.config['TAX_RATE_LONG_TERM']
+                + max(realized["short"], 0) * app.config['TAX_RATE_SHORT_TERM'])
+
+    db.session.execute(
+        update(StockUser)
+        .where(StockUser.id == userid)
+        .values(_stockmoney=StockUser._stockmoney + (amount - tax))
+        .execution_options(synchronize_session=False))
+    db.session.execute(
+        update(TableStock)
+        .where(TableStock.id == stockid)
+        .values(_quantity=TableStock._quantity + quantity)
+        .execution_options(synchronize_session=False))
+
+    link = UserTransactionStock(user_id=userid, transaction_id=transaction.id, stock_id=stockid, quantity=quantity,
+                                price_per_stock=price, transaction_amount=amount, transaction_time=_order_time(transaction_date))
+    link._tax_deduction_amount = tax
+    db.session.add(link)
+    record_event('sell', user_id=userid, stock_id=stockid, transaction_id=transaction.id, price=price,
+                 cash=amount - tax, shares=-quantity, cost=-cost_basis, inventory=quantity)
+    return {"transaction_id": transaction.id, "stock_id": stockid, "quantity": quantity, "price": price, "value": value,
+            "amount": amount, "cost_basis": cost_basis, "realized_long_term": realized["long"], "realized_short_term": realized["short"],
+            "tax": tax, "lots": [{"lot_id": lot.id, "quantity": taken} for lot, taken in consumed]}
+
+
+def run_in_transaction(work):
+    """
+    Runs work() in one database transaction and commits once.
+
+    OperationalError (lock timeouts, deadlocks) and IntegrityError (two first buys racing to
+    insert the same holdings row) are retried up to ORDER_MAX_RETRIES times with a short backoff.
+    OrderError rolls back and is re-raised to the caller.
+    """
+    retries = app.config['ORDER_MAX_RETRIES']
+    for attempt in range(retries + 1):
+        try:
+            result = work()
+            db.session.commit()
+            return result
+        except OrderError:
+            db.session.rollback()
+            raise
+        except (OperationalError, IntegrityError):
+            db.session.rollback()
+            if attempt == retries:
+                raise
+            time.sleep(app.config['ORDER_RETRY_BACKOFF'] * (attempt + 1))
+        except Exception:
+            db.session.rollback()
+            raise
+
+
+def execute_buy(uid, symbol, quantity, backdate=False):
+    """
+    Executes a buy order as a single database transaction.
+
+    Parameters:
+    - uid (str): The uid of the stock user placing the order.
+    - symbol (str): The stock symbol to buy.
+    - quantity (int): The number of shares to buy.
+    - backdate (bool): Record the transaction one year in the past, used by /initialbuy to seed long-term positions.
+
+    Returns:
+    - tuple: (dict, status code), the filled order on success or an error message.
+    """
+    transaction_date = date.today()
+    if backdate:
+        transaction_date = transaction_date - relativedelta(years=1)
+
+    def work():
+        userid = _resolve_user(uid)
+        stockid, price = _resolve_stock(symbol)
+        fill = _buy(userid, stockid, price, quantity, transaction_date)
+        fill.update({"side": "buy", "symbol": symbol})
+        return fill
+
+    try:
+        fill = run_in_transaction(work)
+        _apply_fills([fill])
+        return fill, 200
+    except OrderError as e:
+        return {"error": e.message}, e.code
+    except Exception as e:
+        return {"error": f"Order failed: {str(e)}"}, 500
+
+
+def execute_sell(uid, symbol, quantity, lots=None):
+    """
+    Executes a sell order as a single database transaction.
+
+    Parameters:
+    - uid (str): The uid of the stock user placing the order.
+    - symbol (str): The stock symbol to sell.
+    - quantity (int): The number of shares to sell, FIFO from the oldest lot.
+    - lots (list): Optional {"id", "quantity"} selections to sell specific lots instead of FIFO.
+
+    Returns:
+    - tuple: (dict, status code), the filled order with realized gains and tax, or an error message.
+    """
+    def work():
+        userid = _resolve_user(uid)
+        stockid, price = _resolve_stock(symbol)
+        fill = _sell(userid, stockid, price, quantity, date.today(), lots)
+        fill.update({"side": "sell", "symbol": symbol})
+        return fill
+
+    try:
+        fill = run_in_transaction(work)
+        _apply_fills([fill])
+        return fill, 200
+    except OrderError as e:
+        return {"error": e.message}, e.code
+    except Exception as e:
+        return {"error": f"Order failed: {str(e)}"}, 500
+
+
+def execute_orders(uid, orders, mode=ALL_OR_NOTHING):
+    """
+    Executes a basket of buy and sell orders for one user in a single database transaction.
+
+    All symbols are resolved, with their current prices, in one query up front. In all_or_nothing mode the first rejected order
+    rolls back the whole basket. In best_effort mode each order runs in its own SAVEPOINT, so a
+    rejected order is rolled back alone and the rest are committed together.
+
+    Parameters:
+    - uid (str): The uid of the stock user placing the orders.
+    - orders (list): Dictionaries with "side" ("buy" or "sell"), "symbol", "quantity" and, for sells, optional "lots".
+    - mode (str): Either "all_or_nothing" or "best_effort".
+
+    Returns:
+    - tuple: (dict, status code), with a per-order result list under "results".
+    """
+    if mode not in ORDER_MODES:
+        return {"error": f"Mode must be one of {list(ORDER_MODES)}"}, 400
+    if not isinstance(orders, list) or len(orders) == 0:
+        return {"error": "Expected a non-empty list of orders"}, 400
+    if len(orders) > app.config['ORDER_BATCH_LIMIT']:
+        return {"error": f"At most {app.config['ORDER_BATCH_LIMIT']} orders per request"}, 400
+    if not all(isinstance(order, dict) for order in orders):
+        return {"error": "Each order must be an object"}, 400
+
+    transaction_date = date.today()
+    results = []
+
+    def execute_one(userid, stocks, order):
+        side = order.get("side")
+        symbol = order.get("symbol")
+        if side not in ("buy", "sell"):
+            raise OrderError("Side must be 'buy' or 'sell'")
+        if not isinstance(symbol, str) or symbol not in stocks:
+            raise OrderError(f"No such stock exists: {symbol}", 404)
+        stockid, price = stocks[symbol]
+        if side == "buy":
+            fill = _buy(userid, stockid, price, order.get("quantity"), transaction_date)
+        else:
+            fill = _sell(userid, stockid, price, order.get("quantity"), transaction_date, order.get("lots"))
+        fill.update({"side": side, "symbol": symbol})
+        return fill
+
+    def work():
+        results.clear()
+        userid = _resolve_user(uid)
+        # a list or object symbol is unhashable, it is rejected per order as an unknown stock
+        stocks = _resolve_stocks([order.get("symbol") for order in orders])
+        for index, order in enumerate(orders):
+            try:
+                if mode == BEST_EFFORT:
+                    with db.session.begin_nested():
+                        fill = execute_one(userid, stocks, order)
+                else:
+                    fill = execute_one(userid, stocks, order)
+                results.append({"index": index, "status": "filled", **fill})
+            except OrderError as e:
+                results.append({"index": index, "status": "rejected", "error": e.message})
+                if mode == ALL_OR_NOTHING:
+                    raise
+        return results
+
+    try:
+        run_in_transaction(work)
+    except OrderError as e:
+        if not results:
+            # the user could not be resolved, no order was attempted
+            return {"error": e.message}, e.code
+        for result in results:
+            if result["status"] == "filled":
+                result["status"] = "rolled_back"
+                result.pop("transaction_id")
+        return {"mode": mode, "committed": False, "results": results}, 400
+    except Exception as e:
+        return {"error": f"Orders failed: {str(e)}"}, 500
+    _apply_fills([result for result in results if result["status"] == "filled"])
+    return {"mode": mode, "committed": True, "results": results}, 200
@@ -0,0 +1,118 @@
+""" Password hashing service, pbkdf2 runs in a process pool instead of the request thread """
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from werkzeug.security import DEFAULT_PBKDF2_ITERATIONS, check_password_hash, generate_password_hash
+
+from __init__ import app
+
+
+class PasswordHasherBusy(RuntimeError):
+    """Raised when PASSWORD_HASH_QUEUE hashes are already waiting for longer than PASSWORD_HASH_TIMEOUT."""
+
+
+def normalize_method(method):
+    """
+    Spells out the work factor of a werkzeug hash method, as werkzeug writes it into the hash.
+
+    'pbkdf2:sha256' and 'pbkdf2:sha256:1000000' name the same policy while the werkzeug default
+    is 1000000 iterations; both normalize to the second. Unknown methods are returned unchanged.
+    """
+    name, *args = method.split(":")
+    if name == "pbkdf2":
+        return f"pbkdf2:{args[0] if args else 'sha256'}:{int(args[1]) if len(args) > 1 else DEFAULT_PBKDF2_ITERATIONS}"
+    if name == "scrypt":
+        n, r, p = (list(map(int, args)) + [2**15, 8, 1][len(args):])[:3]
+        return f"scrypt:{n}:{r}:{p}"
+    return method
+
+
+class PasswordHasher:
+    """
+    Hashes and verifies passwords in a pool of PASSWORD_HASH_WORKERS processes.
+
+    A worker thread waiting on the pool holds no GIL and no CPU, so a threaded (gthread) web
+    worker keeps serving other requests while logins hash, and hashes run on as many cores as
+    the pool has. A sync worker serves one request at a time and gains nothing, so the pool is
+    opt-in: PASSWORD_HASH_WORKERS = 0, the default, hashes inline in the request thread.
+    At most PASSWORD_HASH_QUEUE hashes are submitted at once; further callers wait up to
+    PASSWORD_HASH_TIMEOUT seconds for a slot and then get PasswordHasherBusy, so a login storm
+    is shed instead of queueing without bound.
+
+    The work factor is the PASSWORD_HASH_METHOD and PASSWORD_SALT_LENGTH policy. Hashes made
+    under an older policy still verify, and needs_rehash() tells the caller to replace them.
+
+    The pool is started on first use in each process, so every forked gunicorn worker gets its
+    own, and uses spawned processes, which never inherit the worker's threads or connections.
+    """
+    def __init__(self):
+        self._pool = None
+        self._pid = None
+        self._slots = None
+        self._lock = threading.Lock()
+
+    @property
+    def method(self):
+        return normalize_method(app.config['PASSWORD_HASH_METHOD'])
+
+    @property
+    def salt_length(self):
+        return app.config['PASSWORD_SALT_LENGTH']
+
+    def _executor(self):
+        workers = app.config['PASSWORD_HASH_WORKERS']
+        if workers <= 0:
+            return None
+        with self._lock:
+            if self._pool is None or self._pid != os.getpid():
+                self._pool = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'))
+                self._pid = os.getpid()
+                self._slots = threading.BoundedSemaphore(app.config['PASSWORD_HASH_QUEUE'])
+            return self._pool
+
+    def _run(self, function, *args):
+        pool = self._executor()
+        if pool is None:
+            return function(*args)
+        slots = self._slots
+        if not slots.acquire(timeout=app.config['PASSWORD_HASH_TIMEOUT']):
+            raise PasswordHasherBusy("Too many password checks in progress, try again")
+        try:
+            return pool.submit(function, *args).result()
+        except BrokenProcessPool:
+            # a pool process died, start a new pool on the next call and answer this one inline
+            with self._lock:
+                if self._pool is pool:
+                    self._pool = None
+            return function(*args)
+        finally:
+            slots.release()
+
+    def hash(self, password):
+        """Returns a salted hash of password under the current policy."""
+        return self._run(generate_password_hash, password, self.method, self.salt_length)
+
+    def verify(self, pwhash, password):
+        """Checks password against a hash made under any policy."""
+        return self._run(check_password_hash, pwhash, password)
+
+    def needs_rehash(self, pwhash):
+        """True when a hash was made with a method, work factor or salt length other than the current policy."""
+        if pwhash.count("$") < 2:
+            return True
+        method, salt, _ = pwhash.split("$", 2)
+        return normalize_method(method) != self.method or len(salt) != self.salt_length
+
+    def shutdown(self):
+        """Stops this process's pool, the next hash starts a new one."""
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown()
+
+
+# one hasher, and pool, per worker process
+password_hasher = PasswordHasher()
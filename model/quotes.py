@@ -0,0 +1,104 @@
+""" Market data client and bulk price refresh for the stock game """
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from __init__ import app
+from model.stocks import TableStock, price_snapshot
+
+
+class QuoteClient:
+    """
+    Fetches quotes from an FMP-compatible /quote endpoint.
+
+    Symbols are requested in batches of batch_size per HTTP call, at most max_workers calls in
+    flight at once, over one pooled session so connections are reused between batches.
+
+    Parameters:
+    - base_url (str): The quote endpoint, symbols are appended as a path segment, defaults to QUOTE_BASE_URL.
+    - api_key (str): The FMP API key sent as the apikey query parameter.
+    - batch_size (int): Symbols per request.
+    - max_workers (int): Concurrent requests.
+    - timeout (float): Seconds before a request is abandoned.
+    """
+    def __init__(self, base_url=None, api_key=None, batch_size=None, max_workers=None, timeout=None):
+        self.base_url = (base_url or app.config['QUOTE_BASE_URL']).rstrip('/')
+        self.api_key = api_key or app.config['FMP_API_KEY']
+        self.batch_size = batch_size or app.config['QUOTE_BATCH_SIZE']
+        self.max_workers = max_workers or app.config['QUOTE_MAX_WORKERS']
+        self.timeout = timeout or app.config['QUOTE_TIMEOUT']
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def close(self):
+        self.session.close()
+
+    def _fetch_batch(self, symbols):
+        """Returns ({symbol: price}, error message or None) for one batch."""
+        url = f"{self.base_url}/{','.join(symbols)}"
+        try:
+            response = self.session.get(url, params={'apikey': self.api_key}, timeout=self.timeout)
+            if response.status_code == 429:
+                return {}, f"rate limited for {len(symbols)} symbols, retry after {response.headers.get('Retry-After', '?')}s"
+            if response.status_code != 200:
+                return {}, f"status {response.status_code} for {len(symbols)} symbols"
+            prices = {}
+            for quote in response.json() or []:
+                if quote.get('symbol') in symbols and quote.get('price') is not None:
+                    prices[quote['symbol']] = quote['price']
+            return prices, None
+        except (requests.RequestException, ValueError) as e:
+            return {}, f"{type(e).__name__} for {len(symbols)} symbols: {str(e)}"
+
+    def fetch(self, symbols):
+        """
+        Fetches the latest price of every symbol.
+
+        Returns:
+        - tuple: ({symbol: price}, [error messages of failed batches])
+        """
+        symbols = list(symbols)
+        batches = [symbols[i:i + self.batch_size] for i in range(0, len(symbols), self.batch_size)]
+        prices, errors = {}, []
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            for batch_prices, error in pool.map(self._fetch_batch, batches):
+                prices.update(batch_prices)
+                if error:
+                    errors.append(error)
+        return prices, errors
+
+
+def refresh_prices(symbols=None, client=None):
+    """
+    Refreshes stock prices from the quote feed and applies them with one bulk UPDATE.
+
+    Parameters:
+    - symbols (list): Symbols to refresh, defaults to the whole stock table.
+    - client (QuoteClient): The client to fetch with, defaults to one built from app.config.
+
+    Returns:
+    - dict: Counts of requested and updated symbols, failed batch errors and elapsed seconds.
+    """
+    start = time.perf_counter()
+    if symbols is None:
+        symbols = [quote.symbol for quote in price_snapshot.all()]
+    symbols = list(dict.fromkeys(symbols))
+    own_client = client is None
+    client = client or QuoteClient()
+    try:
+        prices, errors = client.fetch(symbols)
+    finally:
+        if own_client:
+            client.close()
+    updated = TableStock.bulk_update_prices(prices)
+    return {
+        "requested": len(symbols),
+        "updated": updated,
+        "missing": sorted(set(symbols) - set(prices)),
+        "errors": errors,
+        "elapsed": round(time.perf_counter() - start, 3),
+    }
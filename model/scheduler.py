@@ -0,0 +1,300 @@
+""" Background price refresh scheduler for the stock game """
+import math
+import os
+import random
+import socket
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+
+from __init__ import app, db
+from model.cache import UPSERT_INSERTS
+from model.stocks import TableStock, UserTransactionStock, price_snapshot
+from model.quotes import refresh_prices
+
+
+class SchedulerLease(db.Model):
+    """
+    SchedulerLease Model
+
+    A named lease that at most one process holds at a time. The holder renews it on every run;
+    when it stops renewing, the lease expires and another worker or node can take it over.
+
+    Attributes:
+        _name (Column): The name of the scheduled job, the primary key.
+        _owner (Column): host:pid of the process holding the lease.
+        _expires (Column): When the lease lapses unless renewed.
+    """
+    __tablename__ = 'scheduler_leases'
+
+    _name = db.Column(db.String(64), primary_key=True)
+    _owner = db.Column(db.String(255), nullable=False)
+    _expires = db.Column(db.DateTime, nullable=False)
+
+    def __init__(self, name, owner, expires):
+        self._name = name
+        self._owner = owner
+        self._expires = expires
+
+    def read(self):
+        return {"name": self._name, "owner": self._owner, "expires": self._expires}
+
+    @staticmethod
+    def acquire(name, owner, ttl):
+        """
+        Takes or renews a lease with one conditional UPDATE, inserting it the first time.
+
+        Returns:
+        - bool: True when owner holds the lease for the next ttl seconds.
+        """
+        now = datetime.utcnow()
+        table = SchedulerLease.__table__
+        try:
+            result = db.session.execute(
+                table.update()
+                .where(table.c._name == name, (table.c._owner == owner) | (table.c._expires < now))
+                .values(_owner=owner, _expires=now + timedelta(seconds=ttl)))
+            if result.rowcount == 0:
+                if db.session.get(SchedulerLease, name) is not None:
+                    db.session.rollback()
+                    return False
+                db.session.execute(table.insert().values(_name=name, _owner=owner, _expires=now + timedelta(seconds=ttl)))
+            db.session.commit()
+            return True
+        except IntegrityError:
+            # another process inserted the lease first
+            db.session.rollback()
+            return False
+
+
+class WatchedSymbol(db.Model):
+    """
+    WatchedSymbol Model
+
+    A symbol a client of any worker is watching, so the lease holder refreshes it first
+    wherever the client connected. Rows older than PRICE_REFRESH_WATCH_TTL are ignored and
+    deleted by the lease holder.
+
+    Attributes:
+        _symbol (Column): The watched stock symbol, the primary key.
+        _seen (Column): When a client last asked for the symbol.
+    """
+    __tablename__ = 'watched_symbols'
+
+    _symbol = db.Column(db.String(255), primary_key=True)
+    _seen = db.Column(db.DateTime, nullable=False, index=True)
+
+    @staticmethod
+    def touch(symbols, seen):
+        """Upserts the seen time of symbols with one statement, caller commits."""
+        table = WatchedSymbol.__table__
+        rows = [{"_symbol": symbol, "_seen": seen} for symbol in symbols]
+        dialect = db.session.get_bind().dialect.name
+        insert = UPSERT_INSERTS.get(dialect)
+        if insert is None:
+            for row in rows:
+                result = db.session.execute(table.update().where(table.c._symbol == row["_symbol"]).values(_seen=seen))
+                if result.rowcount == 0:
+                    db.session.execute(table.insert().values(**row))
+            return
+        statement = insert(table)
+        if dialect in ('mysql', 'mariadb'):
+            statement = statement.on_duplicate_key_update(_seen=statement.inserted._seen)
+        else:
+            statement = statement.on_conflict_do_update(index_elements=['_symbol'], set_={'_seen': statement.excluded._seen})
+        db.session.execute(statement, rows)
+
+
+class RateBudget:
+    """Token bucket of quote requests, refilled at per_minute tokens per minute."""
+    def __init__(self, per_minute):
+        self.per_minute = per_minute
+        self.tokens = float(per_minute)
+        self.updated = time.monotonic()
+
+    def available(self):
+        now = time.monotonic()
+        self.tokens = min(self.per_minute, self.tokens + (now - self.updated) * self.per_minute / 60.0)
+        self.updated = now
+        return int(self.tokens)
+
+    def spend(self, requests):
+        self.tokens -= requests
+
+
+class PriceScheduler:
+    """
+    Refreshes prices on a fixed interval with jitter, under a database lease.
+
+    Each run refreshes as many symbols as the rate budget allows, in priority order:
+    symbols watched by clients of any worker, then recently traded symbols, then the rest of
+    the universe in rotation so every stock is eventually refreshed. Only the process holding
+    the 'price_refresh' lease runs; the others skip their turn and try again next interval.
+    Watched symbols are shared through the watched_symbols table, since the worker a client
+    asks is rarely the lease holder.
+    """
+    LEASE_NAME = 'price_refresh'
+
+    def __init__(self):
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self.budget = None
+        self._watched = {}
+        self._rotation = 0
+        self._thread = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self.metrics = {
+            "runs": 0,
+            "skipped": 0,
+            "last_run": None,
+            "last_latency": None,
+            "last_schedule_lag": None,
+            "last_refreshed": 0,
+            "last_errors": [],
+            "last_success": None,
+        }
+
+    def watch(self, symbols):
+        """
+        Marks symbols as watched so the lease holder's next runs refresh them first, and commits.
+
+        Unknown symbols are ignored. A symbol this worker marked within the last tenth of
+        PRICE_REFRESH_WATCH_TTL is not written again, so a busy symbol costs one write per
+        interval per worker, not one per request.
+        """
+        known = price_snapshot.get_many(symbols)
+        now = time.monotonic()
+        refresh = app.config['PRICE_REFRESH_WATCH_TTL'] / 10
+        with self._lock:
+            due = sorted(symbol for symbol in known if symbol not in self._watched or now - self._watched[symbol] >= refresh)
+            for symbol in due:
+                self._watched[symbol] = now
+        if not due:
+            return
+        try:
+            WatchedSymbol.touch(due, datetime.utcnow())
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            with self._lock:
+                for symbol in due:
+                    self._watched.pop(symbol, None)
+            app.logger.exception("Price scheduler failed to record watched symbols")
+
+    def _watched_symbols(self):
+        """Returns the symbols watched on any worker, most recent first, and deletes expired ones."""
+        cutoff = datetime.utcnow() - timedelta(seconds=app.config['PRICE_REFRESH_WATCH_TTL'])
+        db.session.query(WatchedSymbol).filter(WatchedSymbol._seen < cutoff).delete(synchronize_session=False)
+        db.session.commit()
+        rows = (db.session.query(WatchedSymbol._symbol)
+                .filter(WatchedSymbol._seen >= cutoff)
+                .order_by(WatchedSymbol._seen.desc())
+                .all())
+        return [symbol for symbol, in rows]
+
+    def _traded_symbols(self):
+        cutoff = datetime.now() - timedelta(minutes=app.config['PRICE_REFRESH_TRADED_WINDOW'])
+        rows = (db.session.query(TableStock._symbol)
+                .join(UserTransactionStock, UserTransactionStock._stock_id == TableStock.id)
+                .filter(UserTransactionStock._transaction_time >= cutoff)
+                .group_by(TableStock._symbol)
+                .order_by(func.max(UserTransactionStock._transaction_time).desc())
+                .all())
+        return [symbol for symbol, in rows]
+
+    def pick_symbols(self, limit):
+        """Returns up to limit symbols in priority order."""
+        picked = dict.fromkeys(self._watched_symbols())
+        picked.update(dict.fromkeys(self._traded_symbols()))
+        universe = [quote.symbol for quote in price_snapshot.all()]
+        if universe and len(picked) < limit:
+            start = self._rotation % len(universe)
+            taken = 0
+            for symbol in universe[start:] + universe[:start]:
+                if len(picked) >= limit:
+                    break
+                picked.setdefault(symbol)
+                taken += 1
+            self._rotation = start + taken
+        return list(picked)[:limit]
+
+    def run_once(self, scheduled_at=None):
+        """
+        Runs one refresh if this process holds the lease.
+
+        Returns:
+        - dict: The refresh result, or None when the lease is held elsewhere or the budget is spent.
+        """
+        started = time.monotonic()
+        if self.budget is None:
+            self.budget = RateBudget(app.config['PRICE_REFRESH_RATE_BUDGET'])
+        lease_ttl = app.config['PRICE_REFRESH_INTERVAL'] * 3
+        if not SchedulerLease.acquire(self.LEASE_NAME, self.owner, lease_ttl):
+            self.metrics["skipped"] += 1
+            return None
+        calls = self.budget.available()
+        if calls <= 0:
+            self.metrics["skipped"] += 1
+            return None
+        symbols = self.pick_symbols(calls * app.config['QUOTE_BATCH_SIZE'])
+        result = refresh_prices(symbols)
+        self.budget.spend(math.ceil(len(symbols) / app.config['QUOTE_BATCH_SIZE']))
+
+        self.metrics["runs"] += 1
+        self.metrics["last_run"] = datetime.utcnow().isoformat()
+        self.metrics["last_latency"] = round(time.monotonic() - started, 3)
+        self.metrics["last_schedule_lag"] = round(started - scheduled_at, 3) if scheduled_at else None
+        self.metrics["last_refreshed"] = result["updated"]
+        self.metrics["last_errors"] = result["errors"]
+        if result["updated"]:
+            self.metrics["last_success"] = time.time()
+        return result
+
+    def status(self):
+        """
+        Returns the run metrics of this process and the current lease holder.
+
+        The metrics live in memory, so under several workers they describe only the process that
+        answers; "process" names it and "lease" names the one process actually refreshing prices.
+        A worker that does not hold the lease reports no runs.
+        """
+        metrics = dict(self.metrics)
+        last_success = metrics.pop("last_success")
+        metrics["data_age"] = round(time.time() - last_success, 3) if last_success else None
+        metrics["running"] = self._thread is not None and self._thread.is_alive()
+        lease = db.session.get(SchedulerLease, self.LEASE_NAME)
+        return {"process": self.owner, "metrics": metrics, "lease": lease.read() if lease else None}
+
+    def loop(self):
+        """Runs until stop(), sleeping the interval plus jitter between runs."""
+        interval = app.config['PRICE_REFRESH_INTERVAL']
+        jitter = app.config['PRICE_REFRESH_JITTER']
+        next_run = time.monotonic()
+        while not self._stop.is_set():
+            with app.app_context():
+                try:
+                    self.run_once(scheduled_at=next_run)
+                except Exception as e:
+                    db.session.rollback()
+                    self.metrics["last_errors"] = [str(e)]
+                finally:
+                    db.session.remove()
+            next_run = time.monotonic() + interval + random.uniform(0, jitter)
+            self._stop.wait(max(0.0, next_run - time.monotonic()))
+
+    def start(self):
+        """Starts the loop in a daemon thread of this process."""
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self.loop, name='price-scheduler', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+
+# one scheduler per worker process, the lease decides which one runs
+price_scheduler = PriceScheduler()
@@ -0,0 +1,133 @@
+""" Idempotent schema upgrades for databases created before a column or index was added to a model """
+from sqlalchemy import BigInteger, Float, Numeric, inspect, text
+
+from __init__ import db
+
+
+def _columns(inspector, table):
+    return {column['name'] for column in inspector.get_columns(table)}
+
+
+def _indexes(inspector, table):
+    return {index['name'] for index in inspector.get_indexes(table)}
+
+
+def _dialect():
+    return db.session.get_bind().dialect.name
+
+
+def _change_type(inspector, table, column, wider, sql_type):
+    """
+    Changes the type of a column unless it already is of the wider type class, or one of a tuple of them.
+
+    SQLite is skipped: its columns take integers of 64 bits and fractional values whatever
+    their declared type, and it cannot alter a column type in place.
+    """
+    if _dialect() == 'sqlite':
+        return []
+    current = next(c for c in inspector.get_columns(table) if c['name'] == column)
+    if isinstance(current['type'], wider):
+        return []
+    if _dialect() in ('mysql', 'mariadb'):
+        null = "NULL" if current['nullable'] else "NOT NULL"
+        db.session.execute(text(f"ALTER TABLE {table} MODIFY {column} {sql_type} {null}"))
+    else:
+        db.session.execute(text(f"ALTER TABLE {table} ALTER COLUMN {column} TYPE {sql_type}"))
+    return [f"{table}.{column} {sql_type}"]
+
+
+def _widen_to_bigint(inspector, table, column):
+    """Widens an INTEGER column to BIGINT."""
+    return _change_type(inspector, table, column, BigInteger, "BIGINT")
+
+
+def _add_stock_user_status(inspector):
+    """stock_users._status and its (_status, _accountdate) expiry index, added with the expiry sweep."""
+    applied = []
+    if '_status' not in _columns(inspector, 'stock_users'):
+        # every existing account was trading, the sweep expires the old ones on its next run
+        db.session.execute(text(
+            "ALTER TABLE stock_users ADD COLUMN _status VARCHAR(16) NOT NULL DEFAULT 'active'"))
+        applied.append("stock_users._status")
+    if 'ix_stock_users_expiry' not in _indexes(inspector, 'stock_users'):
+        db.session.execute(text(
+            "CREATE INDEX ix_stock_users_expiry ON stock_users (_status, _accountdate)"))
+        applied.append("ix_stock_users_expiry")
+    return applied
+
+
+def _unique_stock_symbol(inspector):
+    """The unique index on table_stocks._symbol that the stock loader upserts on."""
+    unique = ([index['column_names'] for index in inspector.get_indexes('table_stocks') if index['unique']]
+              + [constraint['column_names'] for constraint in inspector.get_unique_constraints('table_stocks')])
+    if ['_symbol'] in unique:
+        return []
+    duplicates = db.session.execute(text(
+        "SELECT _symbol FROM table_stocks GROUP BY _symbol HAVING COUNT(*) > 1")).scalars().all()
+    if duplicates:
+        raise RuntimeError(f"table_stocks has duplicate symbols, remove them before migrating: {duplicates[:20]}")
+    if 'ix_table_stocks__symbol' in _indexes(inspector, 'table_stocks'):
+        # the plain index of older models, replaced by the unique one of the same name
+        db.session.execute(text("DROP INDEX ix_table_stocks__symbol" if _dialect() not in ('mysql', 'mariadb')
+                                else "DROP INDEX ix_table_stocks__symbol ON table_stocks"))
+    db.session.execute(text("CREATE UNIQUE INDEX ix_table_stocks__symbol ON table_stocks (_symbol)"))
+    return ["ix_table_stocks__symbol UNIQUE"]
+
+
+def _widen_inventory(inspector):
+    """Stock quantities and inventory deltas in the trillions, past a 32-bit INT."""
+    return (_widen_to_bigint(inspector, 'table_stocks', '_quantity')
+            + _widen_to_bigint(inspector, 'trade_events', '_inventory')
+            + _widen_to_bigint(inspector, 'ledger_snapshot_rows', '_inventory'))
+
+
+def _transaction_history_indexes(inspector):
+    """The indexes of user_transaction_stocks behind the keyset paged history and the streaming export."""
+    applied = []
+    existing = _indexes(inspector, 'user_transaction_stocks')
+    for name, columns in (('ix_user_transaction_stocks_history', '_user_id, _transaction_time, _transaction_id'),
+                          ('ix_user_transaction_stocks__transaction_time', '_transaction_time')):
+        if name not in existing:
+            # checked against the inspector rather than IF NOT EXISTS, which MySQL does not support
+            db.session.execute(text(f"CREATE INDEX {name} ON user_transaction_stocks ({columns})"))
+            applied.append(name)
+    return applied
+
+
+def _fractional_prices(inspector):
+    """Stock prices with cents, the simulated market and the quote feed write fractional prices."""
+    return _change_type(inspector, 'table_stocks', '_sheesh', (Numeric, Float), "NUMERIC(18, 4)")
+
+
+# applied in order, each one checks the live schema and does nothing when already applied
+UPGRADES = [
+    _add_stock_user_status,
+    _unique_stock_symbol,
+    _widen_inventory,
+    _fractional_prices,
+    _transaction_history_indexes,
+]
+
+
+def migrate_schema():
+    """
+    Brings the tables of an existing database up to the models.
+
+    db.create_all() creates missing tables but never alters existing ones, so each column, index
+    or column type changed on an existing table has an upgrade here that applies it when missing.
+    Running it again, or on a database created from the current models, changes nothing.
+
+    Returns:
+    - list: The changes applied, empty when the schema was already current.
+    """
+    db.create_all()
+    applied = []
+    try:
+        for upgrade in UPGRADES:
+            # inspect through the session's connection, which sees the earlier upgrades' changes
+            applied.extend(upgrade(inspect(db.session.connection())))
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return applied
@@ -0,0 +1,104 @@
+""" Symbol and company name autocomplete for the stock game """
+import re
+import threading
+from bisect import bisect_left
+
+from __init__ import db
+from model.cache import VersionStamp
+from model.stocks import TableStock
+
+# match kinds, in ranking order
+EXACT_SYMBOL = 0
+SYMBOL_PREFIX = 1
+NAME_PREFIX = 2
+WORD_PREFIX = 3
+# company name words too common to be worth indexing on their own
+STOP_WORDS = frozenset(['inc', 'corp', 'co', 'ltd', 'plc', 'the', 'and', 'of', 'class', 'company', 'corporation',
+                        'group', 'holdings', 'incorporated', 'sa', 'nv', 'ag', 'lp', 'llc', 'a', 'b', 'c'])
+
+
+class StockSearch:
+    """
+    Prefix index over stock symbols, full company names and company name words.
+
+    Each kind of key is one sorted list; a query bisects to the first key >= the query and
+    walks forward while keys still start with it, so a lookup is O(log n + matches) with no
+    database call. Matches rank exact symbol first, then symbol prefixes, full company name
+    prefixes and word prefixes, and within a kind by the stock's size column.
+
+    The index is built from TableStock with one query and rebuilt when the 'stock_catalog'
+    CacheVersion moves, which stock creates, renames and imports bump.
+    """
+    def __init__(self):
+        self._stamp = VersionStamp(TableStock.CATALOG_VERSION)
+        self._version = None
+        self._lock = threading.Lock()
+        self._stocks = []
+        # kind -> (sorted keys, stock positions in the same order)
+        self._keys = {}
+
+    def rebuild(self):
+        """Loads every stock with one query and swaps in a new index."""
+        with self._lock:
+            version = self._stamp.refresh()
+            rows = (db.session.query(TableStock._symbol, TableStock._company, TableStock._quantity)
+                    .order_by(TableStock._quantity.desc())
+                    .all())
+            stocks = [{"symbol": symbol, "company": company, "size": size or 0} for symbol, company, size in rows]
+            entries = {SYMBOL_PREFIX: [], NAME_PREFIX: [], WORD_PREFIX: []}
+            for position, stock in enumerate(stocks):
+                company = stock["company"].lower()
+                entries[SYMBOL_PREFIX].append((stock["symbol"].lower(), position))
+                entries[NAME_PREFIX].append((company, position))
+                for word in set(re.findall(r'[a-z0-9]+', company)):
+                    if word not in STOP_WORDS:
+                        entries[WORD_PREFIX].append((word, position))
+            keys = {}
+            for kind, pairs in entries.items():
+                pairs.sort()
+                keys[kind] = ([key for key, _ in pairs], [position for _, position in pairs])
+            self._stocks = stocks
+            self._keys = keys
+            self._version = version
+
+    def _ensure(self):
+        if self._stamp.current() != self._version:
+            self.rebuild()
+
+    def search(self, query, limit=10):
+        """
+        Returns up to limit stocks matching a symbol or company name prefix, best first.
+
+        Parameters:
+        - query (str): The text typed so far, case insensitive.
+        - limit (int): Maximum number of matches.
+
+        Returns:
+        - list: Dictionaries with symbol, company and the kind of match.
+        """
+        query = query.strip().lower()
+        if not query:
+            return []
+        self._ensure()
+        stocks, keys = self._stocks, self._keys
+        ranked = {}
+        for kind in (SYMBOL_PREFIX, NAME_PREFIX, WORD_PREFIX):
+            sorted_keys, positions = keys[kind]
+            index = bisect_left(sorted_keys, query)
+            while index < len(sorted_keys) and sorted_keys[index].startswith(query):
+                position = positions[index]
+                match = EXACT_SYMBOL if kind == SYMBOL_PREFIX and sorted_keys[index] == query else kind
+                if position not in ranked or match < ranked[position]:
+                    ranked[position] = match
+                index += 1
+        # positions follow size order, so sorting by (kind, position) ranks larger stocks first
+        best = sorted(ranked.items(), key=lambda item: (item[1], item[0]))[:limit]
+        return [
+            {"symbol": stocks[position]["symbol"], "company": stocks[position]["company"],
+             "match": ('symbol', 'symbol', 'company', 'word')[kind]}
+            for position, kind in best
+        ]
+
+
+# one index per worker process
+stock_search = StockSearch()
@@ -2,10 +2,17 @@ from random import randrange
 from datetime import date
 import os, base64
 import json
+import threading
+import time
+from collections import deque, namedtuple
 
 from flask_login import UserMixin
+import numpy as np
 
 from __init__ import app, db
+from model.cache import VersionStamp, bump_version, read_version
+from model.events import record_event
+from sqlalchemy import bindparam, case, func
 from sqlalchemy.exc import IntegrityError
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime, timedelta
@@ -13,13 +20,25 @@ from dateutil.relativedelta import relativedelta
 
 #from model.user import User
 
+# lots held longer than this are taxed at the long-term rate
+LONG_TERM_DAYS = 365
+# number of open lots fetched per locked batch when selling FIFO
+LOT_BATCH_SIZE = 64
+
 class TableStock(db.Model):
     __tablename__ = 'table_stocks'
     id = db.Column(db.Integer, primary_key=True)
-    _symbol = db.Column(db.String(255), unique=False, nullable=False)
+    _symbol = db.Column(db.String(255), unique=True, nullable=False, index=True)
     _company = db.Column(db.String(255), unique=False, nullable=False)
-    _quantity = db.Column(db.Integer, unique=False, nullable=False)
-    _sheesh = db.Column(db.Integer, unique=False, nullable=False)
+    # shares available, the seed CSV has counts in the trillions, past a 32-bit INT
+    _quantity = db.Column(db.BigInteger, unique=False, nullable=False)
+    # price per share, fractional since the live and simulated feeds quote cents; read back as float
+    _sheesh = db.Column(db.Numeric(18, 4, asdecimal=False), unique=False, nullable=False)
+
+    # callables run with {stock_id: price} inside every price write transaction, before commit
+    price_write_hooks = []
+    # bumped when stocks are added or renamed, see model/search.py
+    CATALOG_VERSION = 'stock_catalog'
 
     def __init__(self, symbol, company, quantity, sheesh):
         self._symbol = symbol
@@ -65,6 +84,10 @@ class TableStock(db.Model):
     def create(self):
         try:
             db.session.add(self)
+            db.session.flush()
+            record_event('supply', stock_id=self.id, inventory=self._quantity)
+            bump_version(PriceSnapshot.VERSION_NAME)
+            bump_version(TableStock.CATALOG_VERSION)
             db.session.commit()
             return self
         except IntegrityError:
@@ -77,33 +100,27 @@ class TableStock(db.Model):
         if len(company) > 0:
             self.company = company
         if quantity is not None and isinstance(quantity, int) and quantity > 0:
+            record_event('supply', stock_id=self.id, inventory=quantity - self._quantity)
             self.quantity = quantity
+        bump_version(PriceSnapshot.VERSION_NAME)
+        bump_version(TableStock.CATALOG_VERSION)
         db.session.commit()
         return self
-    # gets price of stock
+    # gets price of stock from the in-memory price snapshot
     def get_price(self,body):
         stock = body.get("symbol")
         try:
-            return TableStock.query.filter(TableStock._symbol == stock).value(TableStock._sheesh)
+            quote = price_snapshot.get(stock)
+            return quote.price if quote else None
         except Exception as e:
             return {"error": "No such stock exists"},500
     # returns stock id: refered in many to many table: User_Transaction_Stocks
     def get_stockid(self,symbol):
         try:
-            return TableStock.query.filter(TableStock._symbol == symbol).value(TableStock.id)
+            quote = price_snapshot.get(symbol)
+            return quote.id if quote else None
         except Exception as e:
             return {"error": "No such stock exists"},500
-    def updatequantity(self,body,isbuy):
-        if isbuy == True:
-            quantity = body.get("quantity")
-            symbol = body.get("symbol")
-            currentquantity = TableStock.query.filter(TableStock._symbol == symbol).value(TableStock._quantity)
-            newquantity = currentquantity - quantity
-            idnum = TableStock.query.filter(TableStock._symbol==symbol).value(TableStock.id)
-            x= TableStock.query.get(idnum)
-            print("this is x" + str(x))
-            x.update(quantity = newquantity)
-            return print("updated quanity")
     def updatestockprice(self,body = None,isloop = None,latest_price = None,stock = None, topstock = None):
     #symbol = body.get('symbol')
     # updates stock price 
@@ -114,9 +131,53 @@ class TableStock(db.Model):
         elif isloop == True:
             stock.sheesh = latest_price
             price = stock.sheesh
+            StockPriceHistory.record({stock.id: price})
+            TableStock._run_price_write_hooks({stock.id: price})
+            # other workers see the new price version and reload their snapshot
+            bump_version(PriceSnapshot.VERSION_NAME)
+            version = read_version(PriceSnapshot.VERSION_NAME)
             db.session.commit()
+            price_snapshot.write_through([Quote(stock.id, stock.symbol, price, stock.quantity)], version)
             return price
         
+    @staticmethod
+    def _run_price_write_hooks(prices):
+        for hook in TableStock.price_write_hooks:
+            hook(prices)
+
+    @staticmethod
+    def bulk_update_prices(prices):
+        """
+        Writes many prices with one executemany UPDATE, records them in the price history with
+        one executemany INSERT, and commits once.
+
+        Parameters:
+        - prices (dict): {symbol: price}, symbols not in the stock table are ignored.
+
+        Returns:
+        - int: The number of stocks updated.
+        """
+        quotes = price_snapshot.get_many(prices.keys())
+        rows = [{"b_id": quote.id, "b_price": prices[symbol]} for symbol, quote in quotes.items()]
+        if not rows:
+            return 0
+        table = TableStock.__table__
+        try:
+            db.session.execute(
+                table.update().where(table.c.id == bindparam("b_id")).values(_sheesh=bindparam("b_price")),
+                rows)
+            written = {quote.id: prices[symbol] for symbol, quote in quotes.items()}
+            StockPriceHistory.record(written)
+            TableStock._run_price_write_hooks(written)
+            bump_version(PriceSnapshot.VERSION_NAME)
+            version = read_version(PriceSnapshot.VERSION_NAME)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        price_snapshot.write_through([quote._replace(price=prices[symbol]) for symbol, quote in quotes.items()], version)
+        return len(rows)
+
     def read(self):
         return {
             "id": self.id,
@@ -125,15 +186,268 @@ class TableStock(db.Model):
             "quantity": self.quantity,
             "sheesh": self.sheesh,
         }
+# bar sizes accepted by StockPriceHistory.ohlc, in seconds, with the default and the longest range of each
+RESOLUTIONS = {'1m': 60, '1h': 3600, '1d': 86400}
+DEFAULT_RANGES = {'1m': timedelta(days=1), '1h': timedelta(days=30), '1d': timedelta(days=365)}
+MAX_RANGES = {'1m': timedelta(days=7), '1h': timedelta(days=90), '1d': timedelta(days=3 * 365)}
+
+
+class StockPriceHistory(db.Model):
+    """
+    StockPriceHistory Model
+
+    Every price written to the stock table, one row per stock per write. The (stock, ts, price)
+    index covers range queries, so a chart range is read from the index alone. Rows older than
+    PRICE_HISTORY_RETENTION_DAYS are deleted by prune(), run daily with 'flask custom prune_price_history'.
+
+    Attributes:
+        id (Column): The primary key.
+        _stock_id (Column): Foreign key to the 'table_stocks' table.
+        _ts (Column): When the price was written.
+        _price (Column): The price written.
+    """
+    __tablename__ = 'stock_price_history'
+    __table_args__ = (
+        db.Index('ix_stock_price_history_stock_ts', '_stock_id', '_ts', '_price'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    _stock_id = db.Column(db.Integer, db.ForeignKey('table_stocks.id', ondelete='CASCADE'), nullable=False)
+    _ts = db.Column(db.DateTime, nullable=False)
+    _price = db.Column(db.Float, nullable=False)
+
+    def __init__(self, stock_id, ts, price):
+        self._stock_id = stock_id
+        self._ts = ts
+        self._price = price
+
+    def read(self):
+        return {"stock_id": self._stock_id, "ts": self._ts, "price": self._price}
+
+    # adds {stock_id: price} to the history with one executemany INSERT, caller commits
+    @staticmethod
+    def record(prices, ts=None):
+        ts = ts or datetime.utcnow()
+        rows = [{"_stock_id": stockid, "_ts": ts, "_price": price} for stockid, price in prices.items()]
+        if rows:
+            db.session.execute(StockPriceHistory.__table__.insert(), rows)
+
+    @staticmethod
+    def prune(days=None):
+        """
+        Deletes the prices older than days, PRICE_HISTORY_RETENTION_DAYS by default.
+
+        Each stock is one DELETE over a range of the (stock, ts) index prefix, committed on its
+        own, so no statement scans the whole table or holds locks for the whole prune.
+
+        Returns:
+        - dict: The cutoff, the number of rows deleted and elapsed seconds.
+        """
+        start = time.perf_counter()
+        cutoff = datetime.utcnow() - timedelta(days=app.config['PRICE_HISTORY_RETENTION_DAYS'] if days is None else days)
+        table = StockPriceHistory.__table__
+        deleted = 0
+        for (stockid,) in db.session.query(TableStock.id).order_by(TableStock.id).all():
+            try:
+                deleted += db.session.execute(
+                    table.delete().where(table.c._stock_id == stockid, table.c._ts < cutoff)).rowcount
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
+        return {"cutoff": cutoff.isoformat(), "deleted": deleted, "elapsed": round(time.perf_counter() - start, 3)}
+
+    @staticmethod
+    def ohlc(stockid, resolution, start, end):
+        """
+        Aggregates the prices of a stock in [start, end) into OHLC bars.
+
+        The ticks of the range are read in time order from the covering index and bucketed with
+        vectorized NumPy: bar boundaries are where the bucket number changes, open and close are
+        the first and last tick of each bar, and high and low are reduceat over the bars.
+
+        Parameters:
+        - stockid (int): The stock to aggregate.
+        - resolution (str): One of RESOLUTIONS.
+        - start (datetime): Start of the range, inclusive, UTC.
+        - end (datetime): End of the range, exclusive, UTC.
+
+        Returns:
+        - list: One dictionary per bar with t (bar start), o, h, l, c and n (tick count).
+        """
+        rows = (db.session.query(StockPriceHistory._ts, StockPriceHistory._price)
+                .filter(StockPriceHistory._stock_id == stockid,
+                        StockPriceHistory._ts >= start,
+                        StockPriceHistory._ts < end)
+                .order_by(StockPriceHistory._ts)
+                .all())
+        if not rows:
+            return []
+        seconds = RESOLUTIONS[resolution]
+        times = np.array([ts for ts, _ in rows], dtype='datetime64[s]').astype(np.int64)
+        prices = np.array([price for _, price in rows], dtype=np.float64)
+        buckets = times // seconds
+        starts = np.concatenate(([0], np.flatnonzero(np.diff(buckets)) + 1))
+        ends = np.concatenate((starts[1:], [len(prices)]))
+        opens = prices[starts]
+        closes = prices[ends - 1]
+        highs = np.maximum.reduceat(prices, starts)
+        lows = np.minimum.reduceat(prices, starts)
+        counts = ends - starts
+        bar_times = (buckets[starts] * seconds).astype('datetime64[s]')
+        return [
+            {"t": str(t) + "Z", "o": float(o), "h": float(h), "l": float(l), "c": float(c), "n": int(n)}
+            for t, o, h, l, c, n in zip(bar_times, opens, highs, lows, closes, counts)
+        ]
+
+
+Quote = namedtuple('Quote', ['id', 'symbol', 'price', 'quantity'])
+
+
+class PriceSnapshot:
+    """
+    In-memory symbol -> Quote map of the whole stock table, stamped with a version.
+
+    Every price write bumps the 'prices' CacheVersion in the same transaction. Each worker
+    compares that counter with the version its snapshot was loaded at, at most once per
+    CACHE_VERSION_CHECK_INTERVAL, and reloads all rows with one query when it moved. Between
+    checks, quote lookups make no database calls. Writes made by this worker are applied to the
+    snapshot immediately; quantity is kept current only for trades made in this worker.
+
+    Listeners added with add_listener() are called with {symbol: price} for every price change
+    the snapshot sees, whether written by this worker or picked up on reload.
+    """
+    VERSION_NAME = 'prices'
+
+    def __init__(self):
+        self._quotes = {}
+        self._by_id = {}
+        self._version = None
+        self._stamp = VersionStamp(self.VERSION_NAME)
+        self._lock = threading.Lock()
+        self._listeners = []
+
+    def add_listener(self, listener):
+        """Registers listener(changes) to be called with {symbol: price} on price changes."""
+        self._listeners.append(listener)
+
+    def _notify(self, changes):
+        if changes:
+            for listener in self._listeners:
+                listener(changes)
+
+    @property
+    def version(self):
+        """The price version the snapshot was loaded at."""
+        self._ensure()
+        return self._version
+
+    def _ensure(self):
+        version = self._stamp.current()
+        if version != self._version:
+            self.reload()
+
+    def reload(self):
+        """Loads every stock with one query and stamps the snapshot with the current version."""
+        with self._lock:
+            version = self._stamp.refresh()
+            rows = db.session.query(TableStock.id, TableStock._symbol, TableStock._sheesh, TableStock._quantity).all()
+            quotes = {symbol: Quote(stockid, symbol, price, quantity) for stockid, symbol, price, quantity in rows}
+            previous = self._quotes if self._version is not None else {}
+            self._quotes = quotes
+            self._by_id = {quote.id: quote for quote in quotes.values()}
+            self._version = version
+        # prices written by other workers since the last load
+        self._notify({symbol: quote.price for symbol, quote in quotes.items()
+                      if symbol in previous and previous[symbol].price != quote.price})
+
+    def get(self, symbol):
+        """Returns the Quote for a symbol, or None when the symbol does not exist."""
+        self._ensure()
+        return self._quotes.get(symbol)
+
+    def get_many(self, symbols):
+        """Returns {symbol: Quote} for the requested symbols that exist."""
+        self._ensure()
+        quotes = self._quotes
+        return {symbol: quotes[symbol] for symbol in symbols if symbol in quotes}
+
+    def all(self):
+        """Returns every Quote in the snapshot."""
+        self._ensure()
+        return list(self._quotes.values())
+
+    def read_versioned(self, symbols=None):
+        """Returns (version, [Quote]) for the requested symbols that exist, or every stock, read together."""
+        self._ensure()
+        with self._lock:
+            quotes = self._quotes
+            if symbols is None:
+                return self._version, list(quotes.values())
+            return self._version, [quotes[symbol] for symbol in symbols if symbol in quotes]
+
+    def is_stale(self):
+        """True when another worker has written prices the snapshot has not loaded yet."""
+        return self._version != read_version(self.VERSION_NAME)
+
+    def write_through(self, quotes, version=None):
+        """
+        Applies committed price writes from this worker without waiting for the next reload.
+
+        version is the price version the write committed. When it directly follows the loaded
+        version the snapshot takes it, so the version always names the prices being served;
+        otherwise another worker wrote in between and the next read reloads.
+        """
+        with self._lock:
+            for quote in quotes:
+                self._quotes[quote.symbol] = quote
+                self._by_id[quote.id] = quote
+            if version is not None and self._version is not None:
+                if version == self._version + 1:
+                    self._version = version
+                    self._stamp.observe(version)
+                else:
+                    # never a real version, so the next read reloads and notifies the missed prices
+                    self._version = -1
+        self._notify({quote.symbol: quote.price for quote in quotes})
+
+    def adjust_quantity(self, stockid, delta):
+        """Applies a committed inventory change from a trade in this worker."""
+        with self._lock:
+            quote = self._by_id.get(stockid)
+            if quote is not None:
+                quote = quote._replace(quantity=quote.quantity + delta)
+                self._quotes[quote.symbol] = quote
+                self._by_id[stockid] = quote
+
+
+# one snapshot per worker process
+price_snapshot = PriceSnapshot()
+
+
 class StockUser(db.Model):
     __tablename__ = 'stock_users'
+    __table_args__ = (
+        # the expiry sweep range-scans active accounts by opening date, see model/expiry.py
+        db.Index('ix_stock_users_expiry', '_status', '_accountdate'),
+    )
+    # bumped by account opens, balance adjustments and bulk rewrites, trades are tracked by the event log, see model/leaderboard.py
+    VERSION_NAME = 'stock_accounts'
+    ACTIVE = 'active'
+    EXPIRED = 'expired'
+    # callables run with the StockUser id inside close(), before the account row is deleted
+    close_hooks = []
+
     id = db.Column(db.Integer, primary_key=True)
     _uid = db.Column(db.String(255), db.ForeignKey('users._uid', ondelete='CASCADE'), nullable=False)
     _stockmoney = db.Column(db.Integer, nullable=False)
     _accountdate = db.Column(db.Date)
+    # set by the expiry sweep, trading refuses expired accounts
+    _status = db.Column(db.String(16), nullable=False, default=ACTIVE, server_default=ACTIVE)
 
     # creates a one to many relatio with transaction table
-    transactions = db.relationship('StockTransaction', lazy='subquery', backref=db.backref('stock_users', lazy=True))
+    # dynamic, loading a stock user does not load its history, page it with /stock/transactions
+    transactions = db.relationship('StockTransaction', lazy='dynamic', backref=db.backref('stock_users', lazy=True))
     #
     # 
     # users = db.relationship("User", backref=db.backref("stockuser", single_parent=True), lazy=True)
@@ -142,6 +456,7 @@ class StockUser(db.Model):
         self._uid = uid
         self._stockmoney = stockmoney
         self._accountdate = date.today()
+        self._status = StockUser.ACTIVE
 
     @property
     def uid(self):
@@ -170,6 +485,9 @@ class StockUser(db.Model):
     def create(self):
         try:
             db.session.add(self)
+            db.session.flush()
+            record_event('open', user_id=self.id, cash=self._stockmoney)
+            bump_version(StockUser.VERSION_NAME)
             db.session.commit()
             return self
         except IntegrityError:
@@ -178,7 +496,9 @@ class StockUser(db.Model):
 
     def update(self, stockmoney=None):
         if stockmoney is not None and isinstance(stockmoney, int) and stockmoney > 0:
+            record_event('adjust', user_id=self.id, cash=stockmoney - self._stockmoney)
             self.stockmoney = stockmoney
+            bump_version(StockUser.VERSION_NAME)
         db.session.commit()
         return self
     
@@ -188,6 +508,7 @@ class StockUser(db.Model):
             "uid": self.uid,
             "stockmoney": self.stockmoney,
             "accountdate": self._accountdate,
+            "status": self._status,
         }
     # returns balance of user 
     def get_balance(self,body):
@@ -203,39 +524,51 @@ class StockUser(db.Model):
         except Exception as e:
                 return {"error": "Can't find user in StockUser table. Possible fix: Run /initilize first to log user in StockUser table"},500
     
-    def updatebal(self,body,val):
-        uid = body.get("uid")
-        bal =  StockUser.get_balance(self,body)
-        newbal = bal - val
-        userid = StockUser.query.filter(StockUser._uid == uid).value(StockUser.id)
-        x = StockUser.query.get(userid)
-        print("this is second x" + str(x))
-        x.stockmoney = newbal
-        db.session.commit()
-        return print("account balance updated")
-    
+    def close(self):
+        """
+        Closes the account inside the caller's transaction, caller commits.
+
+        The ledger gets one 'close' event per holding, returning its shares to the stock's
+        inventory, and one for the balance, so replaying the log ends the account at zero like
+        an expiry does. The account's trades, lots and holdings are deleted with it; the
+        events stay, since they carry plain ids.
+        """
+        holdings = StockHolding.query.filter(StockHolding._user_id == self.id, StockHolding._quantity > 0).all()
+        stocks = TableStock.__table__
+        for holding in holdings:
+            record_event('close', user_id=self.id, stock_id=holding._stock_id, shares=-holding._quantity,
+                         cost=-holding._cost_basis, inventory=holding._quantity)
+            db.session.execute(stocks.update().where(stocks.c.id == holding._stock_id)
+                               .values(_quantity=stocks.c._quantity + holding._quantity))
+        record_event('close', user_id=self.id, cash=-self._stockmoney)
+        for hook in StockUser.close_hooks:
+            hook(self.id)
+        lots = db.session.query(StockLot.id).filter(StockLot._user_id == self.id)
+        db.session.query(StockLotSale).filter(StockLotSale._lot_id.in_(lots)).delete(synchronize_session=False)
+        db.session.query(StockLot).filter(StockLot._user_id == self.id).delete(synchronize_session=False)
+        db.session.query(StockHolding).filter(StockHolding._user_id == self.id).delete(synchronize_session=False)
+        db.session.query(UserTransactionStock).filter(UserTransactionStock._user_id == self.id).delete(synchronize_session=False)
+        db.session.query(StockTransaction).filter(StockTransaction._user_id == self.id).delete(synchronize_session=False)
+        # a bulk DELETE, the ORM delete would cascade to the User through the users backref
+        db.session.query(StockUser).filter(StockUser.id == self.id).delete(synchronize_session=False)
+        db.session.expunge(self)
+        bump_version(StockUser.VERSION_NAME)
+        if holdings:
+            bump_version(PriceSnapshot.VERSION_NAME)
+        return len(holdings)
+
+    @staticmethod
+    def expired_ids():
+        """Returns a subquery of the ids of expired accounts, for filters such as notin_."""
+        return db.session.query(StockUser.id).filter(StockUser._status == StockUser.EXPIRED)
+
     def check_expire(self, body):
+        """Returns True once the expiry sweep has frozen the account, None for an unknown user."""
         uid = body.get("uid")
-        accountdate = StockUser.query.filter(StockUser._uid == uid).value(StockUser._accountdate)
-        
-        if accountdate is not None:
-            # Convert accountdate to datetime object
-            account_datetime = datetime.combine(accountdate, datetime.min.time())
-            
-            # Add 6 weeks to the accountdate
-            expire_date = account_datetime + timedelta(weeks=6)
-            
-            # Get the current date and time
-            current_datetime = datetime.now()
-            
-            # Check if the account has expired
-            if current_datetime > expire_date:
-                return True  # Account has expired
-            else:
-                return False  # Account is still valid
-        else:
-            # Handle the case where accountdate is None
-            return None  # or raise an exception or handle appropriately
+        status = StockUser.query.filter(StockUser._uid == uid).value(StockUser._status)
+        if status is None:
+            return None
+        return status == StockUser.EXPIRED
 class StockTransaction(db.Model):
     __tablename__ = 'stock_transactions'
 
@@ -367,13 +700,17 @@ class StockTransaction(db.Model):
 # Many to many intermedetary table
 class UserTransactionStock(db.Model):
     __tablename__ = 'user_transaction_stocks'
+    __table_args__ = (
+        # newest first history of a user, the keyset of /stock/transactions
+        db.Index('ix_user_transaction_stocks_history', '_user_id', '_transaction_time', '_transaction_id'),
+    )
     _user_id = db.Column(db.Integer, db.ForeignKey('stock_users.id'), primary_key=True, nullable=False)
     _transaction_id = db.Column(db.Integer, db.ForeignKey('stock_transactions.id', ondelete='CASCADE'), primary_key=True, nullable=False)
     _stock_id = db.Column(db.Integer, db.ForeignKey('table_stocks.id', ondelete='CASCADE'), primary_key=True, nullable=False)
     _quantity = db.Column(db.Integer, nullable=False)
     _price_per_stock = db.Column(db.Float, nullable=False)
     _transaction_amount = db.Column(db.Integer, nullable=False)
-    _transaction_time = db.Column(db.DateTime, nullable=False, default=db.func.current_timestamp())
+    _transaction_time = db.Column(db.DateTime, nullable=False, default=db.func.current_timestamp(), index=True)
     _tax_deduction_amount = db.Column(db.Integer, default = 0)
 
     stock = db.relationship(
@@ -478,154 +815,547 @@ class UserTransactionStock(db.Model):
             "transaction_amount": self._transaction_amount,
             "transaction_time": self._transaction_time
         }
-    # creates log in this table
-    def multilog_buy(self,body,value,transactionid):
-        transaction = StockTransaction.query.filter_by(id=transactionid).first()
-        uid = body.get("uid")
-        symbol = body.get("symbol")
-        quantity = body.get("quantity")
-        if transaction:
-            found = transaction.stock_transaction is not None
-            if not found:
-                userid = StockUser.get_userid(self,uid)
-                stockid = TableStock.get_stockid(self,symbol)
-                stockprice = TableStock.get_price(self,body)
-                stock_transaction = UserTransactionStock(user_id=userid,transaction_id=transaction.id, stock_id=stockid, quantity=quantity,price_per_stock=stockprice,transaction_amount= value,transaction_time= date.today())
-                db.session.add(stock_transaction)
-                db.session.commit()
-            else:
-                print("error: transaction log has not been created yet")\
-                    
-    def multilog_buy_initial(self,body,value,transactionid):
-        transaction = StockTransaction.query.filter_by(id=transactionid).first()
-        uid = body.get("uid")
-        symbol = body.get("symbol")
-        quantity = body.get("quantity")
-        if transaction:
-            found = transaction.stock_transaction is not None
-            if not found:
-                user = StockUser.query.filter_by(_uid=uid).first()
-            # Get the current date
-                current_date = date.today()
-            # Subtract one year from the current date by adjusting the year attribute
-                new_date = current_date.replace(year=current_date.year - 1)
-                userid = StockUser.get_userid(self,uid)
-                stockid = TableStock.get_stockid(self,symbol)
-                stockprice = TableStock.get_price(self,body)
-                stock_transaction = UserTransactionStock(user_id=userid,transaction_id=transaction.id, stock_id=stockid, quantity=quantity,price_per_stock=stockprice,transaction_amount= value,transaction_time= new_date)
-                db.session.add(stock_transaction)
-                db.session.commit()
-            else:
-                print("error: transaction log has not been created yet")
-    def check_tax(self,body):
-        symbol = body.get("symbol")
-        quantity = body.get("quantity")
-        uid = body.get("uid")
-        stockid = TableStock.get_stockid(self,symbol)
-        userid = StockUser.get_userid(self,uid)
-        one_year_ago = datetime.now() - timedelta(days=365)
+
+    @staticmethod
+    def history(userid, stockid=None, transaction_type=None, start=None, end=None, cursor=None):
+        """
+        Builds the query of a user's trades, newest first, ordered on the (time, transaction id) keyset.
+
+        A page continues after cursor with a seek on the history index instead of an OFFSET, so
+        page 1000 costs the same as page 1 and rows written meanwhile never shift a page.
+
+        Parameters:
+        - userid (int): The StockUser id.
+        - stockid (int): Only trades of this stock.
+        - transaction_type (str): Only 'buy' or only 'sell' trades.
+        - start (datetime): Only trades at or after start.
+        - end (datetime): Only trades before end.
+        - cursor (tuple): (transaction_time, transaction_id) of the last row already returned.
+
+        Returns:
+        - Query: Rows of transaction id, time, type, stock id, quantity, price, amount and tax.
+        """
+        uts = UserTransactionStock
+        query = (db.session.query(uts._transaction_id, uts._transaction_time, StockTransaction._transaction_type,
+                                  uts._stock_id, uts._quantity, uts._price_per_stock, uts._transaction_amount,
+                                  uts._tax_deduction_amount)
+                 .join(StockTransaction, StockTransaction.id == uts._transaction_id)
+                 .filter(uts._user_id == userid))
+        if stockid is not None:
+            query = query.filter(uts._stock_id == stockid)
+        if transaction_type is not None:
+            query = query.filter(StockTransaction._transaction_type == transaction_type)
+        if start is not None:
+            query = query.filter(uts._transaction_time >= start)
+        if end is not None:
+            query = query.filter(uts._transaction_time < end)
+        if cursor is not None:
+            time, transaction_id = cursor
+            query = query.filter((uts._transaction_time < time) |
+                                 ((uts._transaction_time == time) & (uts._transaction_id < transaction_id)))
+        return query.order_by(uts._transaction_time.desc(), uts._transaction_id.desc())
+
+    @staticmethod
+    def encode_cursor(row):
+        """Returns the opaque cursor that continues a history after row."""
+        return base64.urlsafe_b64encode(f"{row[1].isoformat()}|{row[0]}".encode()).decode()
+
+    @staticmethod
+    def decode_cursor(cursor):
+        """Returns the (time, transaction id) of a cursor, raises ValueError when malformed."""
         try:
-            s = list(UserTransactionStock.query.filter_by(_stock_id = stockid, _user_id = userid).all())
-            buy_list = []
-            self.sell_list = []
-            self.one_year_list = []
-            one_year_quantity = 0
-            less_one_year_quantity = 0
-            self.total_sell_quantity = 0
-            self.less_one_year_list = []
-            
-            for i in s:
-                transactionid = i.transaction_id
-                transaction_type = StockTransaction.query.filter(StockTransaction.id == transactionid).value(StockTransaction._transaction_type)
-                if transaction_type == 'buy':
-                    buy_list.append(i)
-                else:
-                    self.sell_list.append(i)
-            for j in buy_list:
-                time = j._transaction_time
-                if time <= one_year_ago:
-                    self.one_year_list.append(j)
-                else:
-                    self.less_one_year_list.append(j)
-                #print(str(one_year_list))
-        # quantity of stocks made one year ago
-            for k in self.one_year_list:
-                one_year_quantity += k.quantity
-        # quantity of stock made less than one year ago
-            for l in self.less_one_year_list:
-                less_one_year_quantity += l.quantity
-        # total quantity of stocks sold
-            for x in self.sell_list:
-                self.total_sell_quantity += x.quantity
-            #print("this is one_year_quantity" + str( one_year_quantity))
-            #print("this is less_one_year_quantity" + str(less_one_year_quantity))
-            #print((one_year_quantity - (total_sell_quantity + quantity)) <= 0)
-            if not (one_year_quantity - (self.total_sell_quantity + quantity)) <= 0:
-                return True
-            else:
-                return False
-                    
-        except Exception as e:
-            return {e}
-        
-    def calculate_tax_value(self,body,tax_rate):
-        uid = body.get("uid")
-        symbol = body.get("symbol")
-        quantity = body.get("quantity")
-        stockid = TableStock.get_stockid(self,symbol)
-        userid = StockUser.get_userid(self,uid)
-        if tax_rate == 0.2:
-            print("this is list" + str(self.one_year_list))
-            buycounter = 0
-            for i  in self.one_year_list:
-                if buycounter ==0:
-                    buycounter += i.quantity
-                if buycounter >= self.total_sell_quantity:
-                    remainder = buycounter - self.total_sell_quantity
-                    if remainder - quantity > 0:
-                        old_value = i.price_per_stock *(quantity)
-                        new_value = TableStock.get_price(self,body) * quantity
-                        profit = (new_value) - old_value
-                        print("this is profit:" + str(profit))
-                        if profit > 0:
-                            return ((profit *0.2))
-                        else:
-                            return(0)   
-                    else:
-                        return("z")
-                else:
-                    buycounter += i.quantity
-                    
-                    
-                
-                
-        else: 
-            pass
-               
-        
+            time, transaction_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+            return datetime.fromisoformat(time), int(transaction_id)
+        except (UnicodeError, TypeError, base64.binascii.Error) as e:
+            raise ValueError(str(e))
     def check_stock_quantity(self,body):
         symbol = body.get("symbol")
         uid = body.get("uid")
         stockid = TableStock.get_stockid(self,symbol)
         userid = StockUser.get_userid(self,uid)
+        # available quantity is a primary key lookup on the holdings table
+        return StockHolding.get_quantity(userid, stockid)
+
+
+class StockHolding(db.Model):
+    """
+    StockHolding Model
+
+    Materialized position of a stock user in a single stock, one row per (stock_user, stock).
+    The row is maintained in the same database transaction as each buy or sell, so the
+    available quantity and cost basis are a primary key lookup instead of a rescan of the
+    transaction log. StockHolding.rebuild() recomputes the table from the log.
+
+    Attributes:
+        _user_id (Column): Foreign key to the 'stock_users' table, part of the primary key.
+        _stock_id (Column): Foreign key to the 'table_stocks' table, part of the primary key.
+        _quantity (Column): Number of shares currently held.
+        _cost_basis (Column): Total cost of the shares currently held.
+        _lot_count (Column): Number of buy lots that make up the position.
+    """
+    __tablename__ = 'stock_holdings'
+
+    _user_id = db.Column(db.Integer, db.ForeignKey('stock_users.id', ondelete='CASCADE'), primary_key=True, nullable=False)
+    _stock_id = db.Column(db.Integer, db.ForeignKey('table_stocks.id', ondelete='CASCADE'), primary_key=True, nullable=False)
+    _quantity = db.Column(db.Integer, nullable=False, default=0)
+    _cost_basis = db.Column(db.Float, nullable=False, default=0)
+    _lot_count = db.Column(db.Integer, nullable=False, default=0)
+
+    def __init__(self, user_id, stock_id, quantity=0, cost_basis=0, lot_count=0):
+        self._user_id = user_id
+        self._stock_id = stock_id
+        self._quantity = quantity
+        self._cost_basis = cost_basis
+        self._lot_count = lot_count
+
+    def __repr__(self):
+        return f'<StockHolding {self._user_id} {self._stock_id} {self._quantity}>'
+
+    @property
+    def user_id(self):
+        return self._user_id
+
+    @property
+    def stock_id(self):
+        return self._stock_id
+
+    @property
+    def quantity(self):
+        return self._quantity
+
+    @property
+    def cost_basis(self):
+        return self._cost_basis
+
+    @property
+    def lot_count(self):
+        return self._lot_count
+
+    def read(self):
+        return {
+            "user_id": self._user_id,
+            "stock_id": self._stock_id,
+            "quantity": self._quantity,
+            "cost_basis": self._cost_basis,
+            "lot_count": self._lot_count,
+        }
+
+    # returns the held quantity of a stock, 0 when there is no position
+    @staticmethod
+    def get_quantity(userid, stockid):
+        holding = db.session.get(StockHolding, (userid, stockid))
+        return holding.quantity if holding else 0
+
+    # adds a buy to the position with an atomic increment, caller commits
+    @staticmethod
+    def apply_buy(userid, stockid, quantity, value):
+        table = StockHolding.__table__
+        result = db.session.execute(
+            table.update()
+            .where(table.c._user_id == userid, table.c._stock_id == stockid)
+            .values(_quantity=table.c._quantity + quantity,
+                    _cost_basis=table.c._cost_basis + value,
+                    _lot_count=table.c._lot_count + 1))
+        if result.rowcount == 0:
+            # first buy of this stock, a concurrent first buy surfaces as an IntegrityError
+            db.session.execute(table.insert().values(
+                _user_id=userid, _stock_id=stockid, _quantity=quantity, _cost_basis=value, _lot_count=1))
+
+    # locks the position row for a sell, returns None when there is no position
+    @staticmethod
+    def lock(userid, stockid):
+        return (StockHolding.query
+                .filter_by(_user_id=userid, _stock_id=stockid)
+                .with_for_update()
+                .populate_existing()
+                .first())
+
+    # removes sold shares and their lot cost from a locked position, caller commits
+    def reduce(self, quantity, cost, lots_closed):
+        self._quantity -= quantity
+        self._cost_basis -= cost
+        self._lot_count -= lots_closed
+        if self._quantity == 0:
+            db.session.delete(self)
+
+    @staticmethod
+    def portfolio(uid):
+        """
+        Values every position of a stock user at the current stock prices.
+
+        One query joins the user to its holdings and their stock prices, so the cost is a single
+        round trip however many positions the user holds. The outer joins keep the user row when
+        there are no positions, which tells an empty portfolio from an unknown user.
+
+        Parameters:
+        - uid (str): The uid of the stock user.
+
+        Returns:
+        - dict: Cash, positions with quantity, average cost, market value and unrealized P&L, and
+          their totals, or None when uid has no stock account.
+        """
+        market_value = StockHolding._quantity * TableStock._sheesh
+        rows = (db.session.query(
+                    StockUser._stockmoney,
+                    TableStock._symbol,
+                    TableStock._company,
+                    StockHolding._quantity,
+                    StockHolding._cost_basis,
+                    TableStock._sheesh,
+                    market_value)
+                .select_from(StockUser)
+                .outerjoin(StockHolding, (StockHolding._user_id == StockUser.id) & (StockHolding._quantity > 0))
+                .outerjoin(TableStock, TableStock.id == StockHolding._stock_id)
+                .filter(StockUser._uid == uid)
+                .order_by(market_value.desc())
+                .all())
+        if not rows:
+            return None
+        positions = []
+        for _, symbol, company, quantity, cost_basis, price, value in rows:
+            if symbol is None:
+                continue
+            positions.append({
+                "symbol": symbol,
+                "company": company,
+                "quantity": quantity,
+                "average_cost": round(cost_basis / quantity, 4),
+                "cost_basis": round(cost_basis, 2),
+                "price": price,
+                "market_value": round(value, 2),
+                "unrealized_pnl": round(value - cost_basis, 2),
+                "unrealized_pnl_percent": round((value - cost_basis) / cost_basis * 100, 2) if cost_basis else None,
+            })
+        cash = rows[0][0]
+        total_value = sum(position["market_value"] for position in positions)
+        total_cost = sum(position["cost_basis"] for position in positions)
+        return {
+            "cash": cash,
+            "market_value": round(total_value, 2),
+            "cost_basis": round(total_cost, 2),
+            "unrealized_pnl": round(total_value - total_cost, 2),
+            "net_worth": round(cash + total_value, 2),
+            "positions": positions,
+        }
+
+    @staticmethod
+    def rebuild():
+        """
+        Recomputes every holding from the open tax lots with one aggregate query.
+
+        Run StockLot.rebuild() first to replay the transaction log into lots. Quantity is the
+        remaining shares, cost basis the remaining cost of those shares, and lot count the
+        number of open lots in the position. Expired accounts hold nothing: their positions were
+        liquidated by the expiry sweep, which writes no sell transactions.
+
+        Returns:
+        - int: The number of holdings written.
+        """
+        rows = (db.session.query(
+                    StockLot._user_id,
+                    StockLot._stock_id,
+                    func.sum(StockLot._remaining),
+                    func.sum(StockLot._remaining * StockLot._price),
+                    func.count(StockLot.id))
+                .filter(StockLot._open == True, StockLot._user_id.notin_(StockUser.expired_ids()))
+                .group_by(StockLot._user_id, StockLot._stock_id)
+                .all())
+        holdings = [{"_user_id": user_id, "_stock_id": stock_id, "_quantity": quantity,
+                     "_cost_basis": cost_basis, "_lot_count": lots}
+                    for user_id, stock_id, quantity, cost_basis, lots in rows]
         try:
-            s = list(UserTransactionStock.query.filter_by(_stock_id = stockid, _user_id = userid).all())
-            buy_list = []
-            sell_list = []
-            num_buy = 0
-            num_sell = 0
-            for i in s:
-                transactionid = i.transaction_id
-                transaction_type = StockTransaction.query.filter(StockTransaction.id == transactionid).value(StockTransaction._transaction_type)
-                if transaction_type == 'buy':
-                    buy_list.append(i)
-                    #print(buy_list)
-                    num_buy += i.quantity
-                else:
-                    sell_list.append(i)
-                    num_sell += i.quantity
-            
-            return num_buy - num_sell
-        except Exception as e:
-            return {e}
-    
+            db.session.query(StockHolding).delete()
+            if holdings:
+                db.session.execute(StockHolding.__table__.insert(), holdings)
+            bump_version(StockUser.VERSION_NAME)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        return len(holdings)
+
+
+class StockLot(db.Model):
+    """
+    StockLot Model
+
+    A tax lot, created by each buy and consumed by sells either FIFO or by specific lot id.
+    Open lots are found through the (user, stock, open, acquired, id) index, so a sell seeks
+    straight to the oldest open lot and closed lots are never scanned again, which keeps each
+    consumed lot amortized O(1) no matter how many buys a user has made.
+
+    Attributes:
+        id (Column): The primary key, an integer representing the lot.
+        _user_id (Column): Foreign key to the 'stock_users' table.
+        _stock_id (Column): Foreign key to the 'table_stocks' table.
+        _transaction_id (Column): Foreign key to the buy in the 'stock_transactions' table.
+        _quantity (Column): Number of shares bought in the lot.
+        _remaining (Column): Number of shares of the lot not yet sold.
+        _price (Column): Price paid per share.
+        _acquired (Column): Time the lot was bought, used for the long-term/short-term split.
+        _open (Column): True while the lot has remaining shares.
+    """
+    __tablename__ = 'stock_lots'
+    __table_args__ = (
+        db.Index('ix_stock_lots_open', '_user_id', '_stock_id', '_open', '_acquired', 'id'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    _user_id = db.Column(db.Integer, db.ForeignKey('stock_users.id', ondelete='CASCADE'), nullable=False)
+    _stock_id = db.Column(db.Integer, db.ForeignKey('table_stocks.id', ondelete='CASCADE'), nullable=False)
+    _transaction_id = db.Column(db.Integer, db.ForeignKey('stock_transactions.id', ondelete='CASCADE'), nullable=True)
+    _quantity = db.Column(db.Integer, nullable=False)
+    _remaining = db.Column(db.Integer, nullable=False)
+    _price = db.Column(db.Float, nullable=False)
+    _acquired = db.Column(db.DateTime, nullable=False)
+    _open = db.Column(db.Boolean, nullable=False, default=True)
+
+    def __init__(self, user_id, stock_id, transaction_id, quantity, price, acquired):
+        self._user_id = user_id
+        self._stock_id = stock_id
+        self._transaction_id = transaction_id
+        self._quantity = quantity
+        self._remaining = quantity
+        self._price = price
+        self._acquired = acquired
+        self._open = True
+
+    def __repr__(self):
+        return f'<StockLot {self.id} {self._user_id} {self._stock_id} {self._remaining}/{self._quantity}>'
+
+    @property
+    def remaining(self):
+        return self._remaining
+
+    @property
+    def price(self):
+        return self._price
+
+    @property
+    def acquired(self):
+        return self._acquired
+
+    def read(self):
+        return {
+            "id": self.id,
+            "user_id": self._user_id,
+            "stock_id": self._stock_id,
+            "transaction_id": self._transaction_id,
+            "quantity": self._quantity,
+            "remaining": self._remaining,
+            "price": self._price,
+            "acquired": self._acquired,
+        }
+
+    # True when the lot was held past the one-year boundary at the time of the sale
+    def is_long_term(self, sold_at):
+        return self._acquired <= sold_at - timedelta(days=LONG_TERM_DAYS)
+
+    # takes shares out of the lot, returns True when the lot closed
+    def take(self, quantity):
+        self._remaining -= quantity
+        if self._remaining == 0:
+            self._open = False
+        return not self._open
+
+    @staticmethod
+    def consume_fifo(userid, stockid, quantity):
+        """
+        Consumes the oldest open lots of a position, caller commits.
+
+        Lots are fetched in small locked batches from the open-lot index and closed lots are
+        flushed before the next batch, so only the lots actually sold are read.
+
+        Returns:
+        - list: (lot, quantity taken) pairs in the order consumed.
+        """
+        consumed = []
+        remaining = quantity
+        while remaining > 0:
+            lots = (StockLot.query
+                    .filter_by(_user_id=userid, _stock_id=stockid, _open=True)
+                    .order_by(StockLot._acquired, StockLot.id)
+                    .limit(min(remaining, LOT_BATCH_SIZE))
+                    .with_for_update()
+                    .all())
+            if not lots:
+                raise ValueError("Not enough open lots to sell")
+            for lot in lots:
+                taken = min(lot.remaining, remaining)
+                lot.take(taken)
+                consumed.append((lot, taken))
+                remaining -= taken
+                if remaining == 0:
+                    break
+            db.session.flush()
+        return consumed
+
+    @staticmethod
+    def consume_specific(userid, stockid, selections):
+        """
+        Consumes named lots of a position, caller commits.
+
+        Parameters:
+        - selections (list): Dictionaries with a lot "id" and the "quantity" to sell from it.
+
+        Returns:
+        - list: (lot, quantity taken) pairs in the order requested.
+        """
+        ids = [selection.get("id") for selection in selections]
+        lots = (StockLot.query
+                .filter(StockLot.id.in_(ids), StockLot._user_id == userid, StockLot._stock_id == stockid, StockLot._open == True)
+                .with_for_update()
+                .all())
+        by_id = {lot.id: lot for lot in lots}
+        consumed = []
+        for selection in selections:
+            lot = by_id.get(selection.get("id"))
+            quantity = selection.get("quantity")
+            if lot is None:
+                raise ValueError(f"Lot {selection.get('id')} is not an open lot of this position")
+            if not isinstance(quantity, int) or quantity <= 0 or quantity > lot.remaining:
+                raise ValueError(f"Lot {lot.id} has {lot.remaining} shares remaining")
+            lot.take(quantity)
+            consumed.append((lot, quantity))
+        return consumed
+
+    @staticmethod
+    def rebuild():
+        """
+        Replays the transaction log into tax lots in one streamed ordered pass.
+
+        Each sell consumes the lots its StockLotSale rows record, so sells of specific lots
+        replay as placed; only sells without lot records, or the shares they leave unrecorded,
+        are consumed FIFO. Lots keep their ids, so the lot sale rows stay valid and are never
+        rewritten; lots of buys that have none yet are inserted.
+
+        Expired accounts are skipped and keep their closed lots: the expiry sweep liquidates
+        positions without sell transactions, so replaying their log would reopen them.
+
+        Returns:
+        - int: The number of open lots.
+        """
+        expired = StockUser.expired_ids()
+        lot_ids = dict(db.session.query(StockLot._transaction_id, StockLot.id)
+                       .filter(StockLot._user_id.notin_(expired), StockLot._transaction_id.isnot(None)))
+        # sell transaction id -> [(lot id, shares)] in the order the sell consumed them
+        sales = {}
+        for transaction_id, lot_id, quantity in (db.session.query(StockLotSale._transaction_id, StockLotSale._lot_id,
+                                                                  StockLotSale._quantity)
+                                                 .join(StockLot, StockLot.id == StockLotSale._lot_id)
+                                                 .filter(StockLot._user_id.notin_(expired))
+                                                 .order_by(StockLotSale.id)):
+            sales.setdefault(transaction_id, []).append((lot_id, quantity))
+        rows = (db.session.query(
+                    UserTransactionStock._user_id,
+                    UserTransactionStock._stock_id,
+                    UserTransactionStock._transaction_id,
+                    StockTransaction._transaction_type,
+                    UserTransactionStock._quantity,
+                    UserTransactionStock._price_per_stock,
+                    UserTransactionStock._transaction_time)
+                .join(StockTransaction, StockTransaction.id == UserTransactionStock._transaction_id)
+                .filter(UserTransactionStock._user_id.notin_(expired))
+                .order_by(UserTransactionStock._user_id, UserTransactionStock._stock_id,
+                          UserTransactionStock._transaction_time, UserTransactionStock._transaction_id)
+                .yield_per(1000))
+        lots = []
+        position, queue, by_id = None, deque(), {}
+        for user_id, stock_id, transaction_id, transaction_type, quantity, price, time in rows:
+            if position != (user_id, stock_id):
+                position, queue, by_id = (user_id, stock_id), deque(), {}
+            if transaction_type == 'buy':
+                lot = {"id": lot_ids.get(transaction_id), "_user_id": user_id, "_stock_id": stock_id,
+                       "_transaction_id": transaction_id, "_quantity": quantity, "_remaining": quantity,
+                       "_price": price, "_acquired": time}
+                lots.append(lot)
+                queue.append(lot)
+                if lot["id"] is not None:
+                    by_id[lot["id"]] = lot
+                continue
+            for lot_id, taken in sales.get(transaction_id, ()):
+                lot = by_id.get(lot_id)
+                if lot is not None:
+                    lot["_remaining"] -= taken
+                    quantity -= taken
+            while queue and quantity > 0:
+                lot = queue[0]
+                taken = min(lot["_remaining"], quantity)
+                lot["_remaining"] -= taken
+                quantity -= taken
+                if lot["_remaining"] == 0:
+                    queue.popleft()
+
+        updates = [{"b_id": lot["id"], "b_remaining": lot["_remaining"], "b_open": lot["_remaining"] > 0}
+                   for lot in lots if lot["id"] is not None]
+        inserts = [dict((key, value) for key, value in lot.items() if key != "id") | {"_open": True}
+                   for lot in lots if lot["id"] is None and lot["_remaining"] > 0]
+        kept = {lot["id"] for lot in lots if lot["id"] is not None}
+        table = StockLot.__table__
+        try:
+            if updates:
+                db.session.execute(
+                    table.update().where(table.c.id == bindparam("b_id"))
+                    .values(_remaining=bindparam("b_remaining"), _open=bindparam("b_open")),
+                    updates)
+            # lots whose buy is gone from the log, unless a recorded sale still points at them
+            stale = [lot_id for lot_id in lot_ids.values() if lot_id not in kept]
+            if stale:
+                sold = db.session.query(StockLotSale._lot_id)
+                db.session.query(StockLot).filter(StockLot.id.in_(stale), StockLot.id.notin_(sold)).delete(synchronize_session=False)
+            if inserts:
+                db.session.execute(table.insert(), inserts)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        return sum(1 for lot in lots if lot["_remaining"] > 0)
+
+
+class StockLotSale(db.Model):
+    """
+    StockLotSale Model
+
+    The realized gain of one lot consumed by one sell, split into long-term and short-term
+    by the one-year holding boundary.
+
+    Attributes:
+        id (Column): The primary key.
+        _transaction_id (Column): Foreign key to the sell in the 'stock_transactions' table.
+        _lot_id (Column): Foreign key to the consumed lot in the 'stock_lots' table.
+        _quantity (Column): Number of shares sold from the lot.
+        _cost (Column): Cost of the shares sold, at the lot price.
+        _proceeds (Column): Proceeds of the shares sold, at the sell price.
+        _term (Column): 'long' or 'short'.
+    """
+    __tablename__ = 'stock_lot_sales'
+
+    id = db.Column(db.Integer, primary_key=True)
+    _transaction_id = db.Column(db.Integer, db.ForeignKey('stock_transactions.id', ondelete='CASCADE'), nullable=False, index=True)
+    _lot_id = db.Column(db.Integer, db.ForeignKey('stock_lots.id', ondelete='CASCADE'), nullable=False)
+    _quantity = db.Column(db.Integer, nullable=False)
+    _cost = db.Column(db.Float, nullable=False)
+    _proceeds = db.Column(db.Float, nullable=False)
+    _term = db.Column(db.String(5), nullable=False)
+
+    def __init__(self, transaction_id, lot_id, quantity, cost, proceeds, term):
+        self._transaction_id = transaction_id
+        self._lot_id = lot_id
+        self._quantity = quantity
+        self._cost = cost
+        self._proceeds = proceeds
+        self._term = term
+
+    @property
+    def gain(self):
+        return self._proceeds - self._cost
+
+    def read(self):
+        return {
+            "lot_id": self._lot_id,
+            "quantity": self._quantity,
+            "cost": self._cost,
+            "proceeds": self._proceeds,
+            "gain": self.gain,
+            "term": self._term,
+        }
@@ -0,0 +1,159 @@
+""" Server-Sent Events broadcaster for stock price changes """
+import json
+import threading
+import time
+
+from flask import current_app
+
+from __init__ import app, db
+from model.stocks import price_snapshot
+
+# seconds between the watcher's version checks at the least, CACHE_VERSION_CHECK_INTERVAL may be 0
+MIN_WATCH_INTERVAL = 0.1
+
+
+def encode_price(symbol, price):
+    """Encodes one price change as a Server-Sent Event."""
+    return f"event: price\ndata: {json.dumps({'symbol': symbol, 'price': price})}\n\n".encode()
+
+
+class Subscription:
+    """
+    One connected stream client.
+
+    pending holds at most one encoded event per symbol, so a burst of updates to a symbol
+    between two reads coalesces into its latest price and memory stays bounded by the number
+    of symbols the client follows.
+    """
+    __slots__ = ('symbols', 'pending', 'cond', 'closed')
+
+    def __init__(self, symbols, lock):
+        self.symbols = symbols
+        self.pending = {}
+        self.cond = threading.Condition(lock)
+        self.closed = False
+
+
+class PriceBroadcaster:
+    """
+    Fans price changes out to every stream subscriber of this worker.
+
+    Each change is encoded once and only the subscriptions that follow its symbol are woken.
+    Price changes written by other workers reach this worker through the price snapshot reload,
+    which a watcher thread triggers every CACHE_VERSION_CHECK_INTERVAL while anyone is subscribed.
+
+    Every stream holds a worker thread (gunicorn gthread), so a worker serves at most
+    STREAM_MAX_SUBSCRIBERS streams, kept below --threads; more clients need more workers.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._all = set()
+        self._by_symbol = {}
+        self._count = 0
+        self._watcher = None
+
+    @property
+    def count(self):
+        return self._count
+
+    def subscribe(self, symbols=None):
+        """
+        Adds a subscription for symbols, or for every symbol when symbols is None.
+
+        Returns:
+        - Subscription: The new subscription, or None when STREAM_MAX_SUBSCRIBERS is reached.
+        """
+        subscription = Subscription(frozenset(symbols) if symbols else None, self._lock)
+        with self._lock:
+            if self._count >= app.config['STREAM_MAX_SUBSCRIBERS']:
+                return None
+            if subscription.symbols is None:
+                self._all.add(subscription)
+            else:
+                for symbol in subscription.symbols:
+                    self._by_symbol.setdefault(symbol, set()).add(subscription)
+            self._count += 1
+        self._start_watcher()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """Removes a subscription, calling it again for the same subscription does nothing."""
+        with self._lock:
+            if subscription.closed:
+                return
+            subscription.closed = True
+            if subscription.symbols is None:
+                self._all.discard(subscription)
+            else:
+                for symbol in subscription.symbols:
+                    followers = self._by_symbol.get(symbol)
+                    if followers is not None:
+                        followers.discard(subscription)
+                        if not followers:
+                            del self._by_symbol[symbol]
+            self._count -= 1
+
+    def publish(self, changes):
+        """Encodes {symbol: price} once and queues it on every subscription that follows the symbol."""
+        if self._count == 0:
+            return
+        encoded = {symbol: encode_price(symbol, price) for symbol, price in changes.items()}
+        with self._lock:
+            woken = set()
+            for symbol, event in encoded.items():
+                for subscription in self._by_symbol.get(symbol, ()):
+                    subscription.pending[symbol] = event
+                    woken.add(subscription)
+            for subscription in self._all:
+                subscription.pending.update(encoded)
+                woken.add(subscription)
+            for subscription in woken:
+                subscription.cond.notify()
+
+    def events(self, subscription, initial=b''):
+        """
+        Yields the encoded events of a subscription until the client disconnects.
+
+        A comment line is sent every STREAM_HEARTBEAT seconds without events so proxies keep the
+        connection open and a closed client is noticed. The caller unsubscribes when the response
+        is closed, which the server does even when the generator was never started.
+        """
+        heartbeat = app.config['STREAM_HEARTBEAT']
+        yield b'retry: 3000\n\n' + initial
+        while not subscription.closed:
+            with subscription.cond:
+                if not subscription.pending:
+                    subscription.cond.wait(heartbeat)
+                pending, subscription.pending = subscription.pending, {}
+            if pending:
+                yield b''.join(pending.values())
+            else:
+                yield b': keepalive\n\n'
+
+    def _start_watcher(self):
+        with self._lock:
+            if self._watcher is not None:
+                return
+            self._watcher = threading.Thread(target=self._watch, name='price-stream-watcher', daemon=True)
+            self._watcher.start()
+
+    def _watch(self):
+        """Reloads the price snapshot on version changes while there are subscribers."""
+        while True:
+            with self._lock:
+                if self._count == 0:
+                    self._watcher = None
+                    return
+            with app.app_context():
+                try:
+                    price_snapshot.version
+                except Exception:
+                    current_app.logger.exception("Price stream watcher failed to check the price version")
+                finally:
+                    db.session.remove()
+            time.sleep(max(app.config['CACHE_VERSION_CHECK_INTERVAL'], MIN_WATCH_INTERVAL))
+
+
+# one broadcaster per worker process
+price_broadcaster = PriceBroadcaster()
+price_snapshot.add_listener(price_broadcaster.publish)
@@ -2,15 +2,19 @@
 from flask import current_app
 from flask_login import UserMixin
 from datetime import date
+from sqlalchemy import func
 from sqlalchemy.exc import IntegrityError
-from werkzeug.security import generate_password_hash, check_password_hash
+from sqlalchemy.orm import configure_mappers, joinedload, lazyload, selectinload
 import os
 import json
 
 from __init__ import app, db
 from model.github import GitHubUser
 from model.kasm import KasmUser
-from model.stocks import StockUser
+from model.stocks import StockUser, price_snapshot
+from model.cache import bump_version
+from model.events import record_event
+from model.passwords import password_hasher
 
 
 """ Helper Functions """
@@ -68,6 +72,8 @@ class Section(db.Model):
         _abbreviation (db.Column): A unique string representing the abbreviation of the section's name. It cannot be null.
     """
     __tablename__ = 'sections'
+    # bumped by every write to sections, see api/response_cache.py
+    VERSION_NAME = 'sections'
 
     id = db.Column(db.Integer, primary_key=True)
     _name = db.Column(db.String(255), unique=False, nullable=False)
@@ -75,7 +81,8 @@ class Section(db.Model):
   
     # Define many-to-many relationship with User model through UserSection table
     # Overlaps setting avoids cicular dependencies with UserSection class
-    users = db.relationship('User', secondary=UserSection.__table__, lazy='subquery',
+    # lazy, a section list never loads rosters, see the loading profiles below
+    users = db.relationship('User', secondary=UserSection.__table__, lazy='select',
                             backref=db.backref('section_users_rel', lazy=True, viewonly=True), overlaps="section_users_rel,user_sections_rel,user")    
     
     # Constructor
@@ -95,6 +102,7 @@ class Section(db.Model):
     def create(self):
         try:
             db.session.add(self)
+            bump_version(Section.VERSION_NAME)
             db.session.commit()
             return self
         except IntegrityError:
@@ -109,10 +117,21 @@ class Section(db.Model):
             "abbreviation": self._abbreviation
         }
         
+    @staticmethod
+    def read_with_counts():
+        """Reads every section with its number of users, counted in one grouped query without loading rosters."""
+        rows = (db.session.query(Section, func.count(UserSection.user_id))
+                .outerjoin(UserSection, UserSection.section_id == Section.id)
+                .group_by(Section.id)
+                .order_by(Section.id)
+                .all())
+        return [dict(section.read(), user_count=count) for section, count in rows]
+
     # CRUD delete: remove self
     # None
     def delete(self):
         db.session.delete(self)
+        bump_version(Section.VERSION_NAME)
         db.session.commit()
         return None
 
@@ -138,6 +157,8 @@ class User(db.Model, UserMixin):
         sections (Relationship): A many-to-many relationship between users and sections, allowing users to be associated with multiple sections.
     """
     __tablename__ = 'users'
+    # bumped by every write to users or their sections, see api/response_cache.py
+    VERSION_NAME = 'users'
 
     id = db.Column(db.Integer, primary_key=True)
     _name = db.Column(db.String(255), unique=False, nullable=False)
@@ -150,7 +171,8 @@ class User(db.Model, UserMixin):
    
     # Define many-to-many relationship with Section model through UserSection table 
     # Overlaps setting avoids cicular dependencies with UserSection class
-    sections = db.relationship('Section', secondary=UserSection.__table__, lazy='subquery',
+    # lazy, an auth check never loads sections, see the loading profiles below
+    sections = db.relationship('Section', secondary=UserSection.__table__, lazy='select',
                                backref=db.backref('user_sections_rel', lazy=True, viewonly=True), overlaps="user_sections_rel,section,section_users_rel,user,users")
     
     # Define one-to-one relationship with StockUser model
@@ -236,14 +258,21 @@ class User(db.Model, UserMixin):
             
     # set password, this is conventional setter with business logic
     def set_password(self, password):
-        """Create a hashed password."""
-        self._password = generate_password_hash(password, "pbkdf2:sha256", salt_length=10)
+        """Create a hashed password, in the hashing pool under the current work-factor policy."""
+        self._password = password_hasher.hash(password)
 
     # check password parameter versus stored/encrypted password
     def is_password(self, password):
         """Check against hashed password."""
-        result = check_password_hash(self._password, password)
-        return result
+        return password_hasher.verify(self._password, password)
+
+    # replace a verified password's hash made under an older work-factor policy, caller commits
+    def upgrade_password(self, password):
+        """Rehash a verified password when the policy has changed, returns True when there is a change to commit."""
+        if not password_hasher.needs_rehash(self._password):
+            return False
+        self.set_password(password)
+        return True
 
     # output content using str(object) in human readable form, uses getter
     # output content using json dumps, this is ready for API response
@@ -254,6 +283,7 @@ class User(db.Model, UserMixin):
     def role(self):
         return self._role
 
+    # cached principals hold the role, save a change with update(), which bumps the users version
     @role.setter
     def role(self, role):
         self._role = role
@@ -276,6 +306,7 @@ class User(db.Model, UserMixin):
     def create(self, inputs=None):
         try:
             db.session.add(self)  # add prepares to persist person object to Users table
+            bump_version(User.VERSION_NAME)
             db.session.commit()  # SqlAlchemy "unit of work pattern" requires a manual commit
             if inputs:
                 self.update(inputs)
@@ -348,6 +379,7 @@ class User(db.Model, UserMixin):
                 kasm_user.delete(self.uid)
 
         try:
+            bump_version(User.VERSION_NAME)
             db.session.commit()
         except IntegrityError:
             db.session.rollback()
@@ -359,10 +391,19 @@ class User(db.Model, UserMixin):
     def delete(self):
         try:
             KasmUser().delete(self.uid)
+            # the stock account is closed in the ledger first, its balance and shares do not outlive the user
+            returned = self.stock_user.close() if self.stock_user else 0
+            # sections and user_sections_rel both map user_sections, one DELETE here instead of one from each
+            db.session.query(UserSection).filter(UserSection.user_id == self.id).delete(synchronize_session=False)
+            db.session.expire(self, ['sections', 'user_sections_rel', 'stock_user'])
             db.session.delete(self)
+            bump_version(User.VERSION_NAME)
             db.session.commit()
         except IntegrityError:
             db.session.rollback()
+            return None
+        if returned:
+            price_snapshot.reload()
         return None   
     
     def save_pfp(self, image_data, filename):
@@ -381,6 +422,7 @@ class User(db.Model, UserMixin):
     def delete_pfp(self):
         """Deletes profile picture from user record."""
         self.pfp = None
+        bump_version(User.VERSION_NAME)
         db.session.commit()
         
     def add_section(self, section):
@@ -392,6 +434,7 @@ class User(db.Model, UserMixin):
             # Add the section to the user's sections
             user_section = UserSection(user=self, section=section)
             db.session.add(user_section)
+            bump_version(User.VERSION_NAME)
             
             # Commit the changes to the database
             db.session.commit()
@@ -454,6 +497,7 @@ class User(db.Model, UserMixin):
         if section:
             # Update the year for the found section
             section.year = year
+            bump_version(User.VERSION_NAME)
             db.session.commit()
             return True  # Update successful
         else:
@@ -477,6 +521,7 @@ class User(db.Model, UserMixin):
                 else:
                     # If the section is not found, raise a ValueError
                     raise ValueError(f"Section with abbreviation '{abbreviation}' not found.")
+            bump_version(User.VERSION_NAME)
             db.session.commit()
             return True
         except ValueError as e:
@@ -502,6 +547,7 @@ class User(db.Model, UserMixin):
         # Update the UID if a new one is provided
         if new_uid and new_uid != self._uid:
             self._uid = new_uid
+            bump_version(User.VERSION_NAME)
             # Commit the UID change to the database
             db.session.commit()
 
@@ -518,6 +564,9 @@ class User(db.Model, UserMixin):
         """
         if not self.stock_user:
             self.stock_user = StockUser(uid=self._uid, stockmoney=100000)
+            db.session.flush()
+            record_event('open', user_id=self.stock_user.id, cash=self.stock_user.stockmoney)
+            bump_version(StockUser.VERSION_NAME)
             db.session.commit()
         return self 
             
@@ -528,7 +577,85 @@ class User(db.Model, UserMixin):
         if self.stock_user:
             return self.stock_user.read()
         return None
-    
+
+    # listing field -> column attribute, "sections" is loaded separately
+    LIST_FIELDS = {
+        "id": "id",
+        "uid": "_uid",
+        "name": "_name",
+        "email": "_email",
+        "role": "_role",
+        "pfp": "_pfp",
+        "kasm_server_needed": "kasm_server_needed",
+    }
+
+    @staticmethod
+    def listing(fields=None, role=None, section=None, kasm_server_needed=None, cursor=None, limit=None):
+        """
+        Lists users as dictionaries in id order, the same shape as read().
+
+        Only the requested columns are selected, as plain rows rather than User objects, and the
+        sections of the whole page are loaded with one more query per 500 users, so the query
+        count no longer grows with the number of users.
+
+        Parameters:
+        - fields (list): Keys of read() to return, defaults to all of them.
+        - role (str): Only users with this role.
+        - section (str): Only users enrolled in the section with this abbreviation.
+        - kasm_server_needed (bool): Only users with this Kasm flag.
+        - cursor (int): Only users with an id above this, the last id of the previous page.
+        - limit (int): Maximum number of users, defaults to all.
+
+        Returns:
+        - tuple: (list of user dictionaries, the cursor of the next page or None)
+        """
+        fields = list(fields or [*User.LIST_FIELDS, "sections"])
+        names = ["id"] + [field for field in fields if field in User.LIST_FIELDS and field != "id"]
+        query = db.session.query(*[getattr(User, User.LIST_FIELDS[name]) for name in names])
+        if role is not None:
+            query = query.filter(User._role == role)
+        if kasm_server_needed is not None:
+            query = query.filter(User.kasm_server_needed == kasm_server_needed)
+        if section is not None:
+            query = query.filter(User.id.in_(
+                db.session.query(UserSection.user_id).join(Section).filter(Section._abbreviation == section)))
+        if cursor is not None:
+            query = query.filter(User.id > cursor)
+        query = query.order_by(User.id)
+        rows = query.limit(limit + 1).all() if limit else query.all()
+        next_cursor = None
+        if limit and len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = rows[-1][0]
+        users = [dict(zip(names, row)) for row in rows]
+        if "sections" in fields:
+            by_id = {}
+            for user in users:
+                user["sections"] = by_id[user["id"]] = []
+            ids = list(by_id)
+            for start in range(0, len(ids), 500):
+                enrollments = (db.session.query(UserSection.user_id, Section.id, Section._name, Section._abbreviation, UserSection.year)
+                               .join(Section, Section.id == UserSection.section_id)
+                               .filter(UserSection.user_id.in_(ids[start:start + 500])))
+                for user_id, section_id, name, abbreviation, year in enrollments:
+                    by_id[user_id].append({"id": section_id, "name": name, "abbreviation": abbreviation, "year": year})
+        if "id" not in fields:
+            for user in users:
+                del user["id"]
+        return users, next_cursor
+
+""" Loading Profiles """
+
+# Pass to Query.options(). Relationships default to lazy loading, so each call site picks what it reads.
+# the backrefs used below exist once the mappers are configured
+configure_mappers()
+# principal of an auth check: the users row alone
+PRINCIPAL = (lazyload('*'),)
+# read(): enrollments and their sections with one more query, however many users
+PROFILE = (selectinload(User.user_sections_rel).joinedload(UserSection.section),)
+# user tables: section abbreviations with one more query
+ROSTER = (selectinload(User.sections),)
+
 """Database Creation and Testing """
 
 # Builds working data set for testing
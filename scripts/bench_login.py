@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+
+""" bench_login.py
+Benchmarks login password checks under concurrent load, in the request thread versus the hashing pool.
+
+- Hashes one password under the current PASSWORD_HASH_METHOD policy.
+- For each mode, starts C client threads (default 16), as a threaded gunicorn worker would, each
+  verifying the password L times (default 8), which is the cost of one /api/authenticate.
+- Meanwhile a probe thread runs a small pure-Python task every 10 ms, standing in for the other
+  requests of the same worker, and records how late it runs.
+- Reports logins per second and probe latency for inline hashing (PASSWORD_HASH_WORKERS=0, the
+  default) and for the pool. The pool only pays off for a threaded (gthread) gunicorn worker on
+  more than one core; a sync worker handles one login at a time either way.
+
+Usage: Run from the terminal as such:
+
+Goto the scripts directory:
+> cd scripts; ./bench_login.py --clients 16 --logins 8 --workers 4
+
+Or run from the root of the project:
+> scripts/bench_login.py
+
+"""
+import argparse
+import sys
+import os
+import threading
+import time
+
+# Add the directory containing main.py to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+# Import application object
+from main import app
+from model.passwords import password_hasher
+
+
+def run(clients, logins, pwhash, password):
+    """Returns (logins per second, median and max probe delay in ms) of one load run."""
+    done = threading.Event()
+    delays = []
+
+    def probe():
+        while not done.is_set():
+            start = time.perf_counter()
+            sum(i * i for i in range(2000))
+            time.sleep(0.01)
+            delays.append(time.perf_counter() - start - 0.01)
+
+    def client():
+        for _ in range(logins):
+            assert password_hasher.verify(pwhash, password)
+
+    prober = threading.Thread(target=probe, daemon=True)
+    prober.start()
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    done.set()
+    prober.join()
+    delays.sort()
+    return clients * logins / elapsed, delays[len(delays) // 2] * 1000, delays[-1] * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark login password checks under concurrent load')
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--logins', type=int, default=8)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='Hashing pool processes')
+    args = parser.parse_args()
+
+    password = 'bench-password'
+    with app.app_context():
+        app.config['PASSWORD_HASH_WORKERS'] = 0
+        pwhash = password_hasher.hash(password)
+        print(f"{app.config['PASSWORD_HASH_METHOD']}, {args.clients} concurrent clients x {args.logins} logins, {os.cpu_count()} cpus")
+        for label, workers in (("inline (request thread)", 0), (f"pool of {args.workers} processes", args.workers)):
+            app.config['PASSWORD_HASH_WORKERS'] = workers
+            if workers:
+                password_hasher.verify(pwhash, password)  # start the pool outside the timing
+            rate, median, worst = run(args.clients, args.logins, pwhash, password)
+            print(f"  {label:28s} {rate:7.1f} logins/s, other requests delayed median {median:6.1f} ms, max {worst:7.1f} ms")
+        password_hasher.shutdown()
+
+
+if __name__ == "__main__":
+    main()
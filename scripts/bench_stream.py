@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+""" bench_stream.py
+Benchmarks the price stream broadcaster of one worker at its deployed subscriber ceiling.
+
+- Opens STREAM_MAX_SUBSCRIBERS subscriptions (48 in the Dockerfile, read from the environment like
+  the app does), half following all symbols and half following 5 symbols. A gthread gunicorn
+  worker serves each stream in one of its --threads, so that is all one worker can hold.
+- Starts one consumer thread per subscription, as the worker does.
+- Publishes full-universe price ticks and measures the time until every consumer has them.
+- Reports memory per idle subscriber, fan-out latency and how many workers a target number of
+  clients (--clients, default 1000) needs.
+
+Usage: Run from the terminal as such:
+
+Goto the scripts directory:
+> cd scripts; STREAM_MAX_SUBSCRIBERS=48 ./bench_stream.py --ticks 20
+
+Or run from the root of the project:
+> scripts/bench_stream.py
+
+"""
+import argparse
+import math
+import random
+import sys
+import os
+import threading
+import time
+import tracemalloc
+
+# Add the directory containing main.py to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+# Import application object
+from main import app
+from model.stream import PriceBroadcaster
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the price stream broadcaster')
+    ceiling = app.config['STREAM_MAX_SUBSCRIBERS']
+    parser.add_argument('--subscribers', type=int, default=ceiling, help='Streams on the worker, at most STREAM_MAX_SUBSCRIBERS')
+    parser.add_argument('--clients', type=int, default=1000, help='Concurrent clients to size the deployment for')
+    parser.add_argument('--symbols', type=int, default=504)
+    parser.add_argument('--ticks', type=int, default=20)
+    args = parser.parse_args()
+    if not 0 < args.subscribers <= ceiling:
+        parser.error(f"--subscribers must be 1..{ceiling}, a worker refuses streams past STREAM_MAX_SUBSCRIBERS")
+
+    app.config['STREAM_HEARTBEAT'] = 3600
+    symbols = [f"S{i:03d}" for i in range(args.symbols)]
+    broadcaster = PriceBroadcaster()
+    broadcaster._start_watcher = lambda: None  # no database in this benchmark
+
+    # Step 1: memory of idle subscriptions
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    subscriptions = []
+    for i in range(args.subscribers):
+        followed = None if i % 2 == 0 else random.sample(symbols, 5)
+        subscriptions.append(broadcaster.subscribe(followed))
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    idle_bytes = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    print(f"{args.subscribers} idle subscribers: {idle_bytes / 1024:.1f} KiB, {idle_bytes / args.subscribers:.0f} bytes each")
+
+    # Step 2: one consumer thread per subscription, counting delivered ticks
+    received = [0] * args.subscribers
+    done = threading.Event()
+
+    def consume(index, subscription):
+        for chunk in broadcaster.events(subscription):
+            if b'"price"' in chunk:
+                received[index] += 1
+            if done.is_set():
+                return
+
+    threads = [threading.Thread(target=consume, args=(i, s), daemon=True) for i, s in enumerate(subscriptions)]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.5)
+
+    # Step 3: publish ticks and time the fan-out
+    latencies = []
+    for tick in range(args.ticks):
+        target = [count + 1 for count in received]
+        changes = {symbol: round(random.uniform(10, 500), 2) for symbol in symbols}
+        start = time.perf_counter()
+        broadcaster.publish(changes)
+        publish_time = time.perf_counter() - start
+        while any(received[i] < target[i] for i in range(args.subscribers)):
+            time.sleep(0.0005)
+        latencies.append((publish_time, time.perf_counter() - start))
+
+    done.set()
+    broadcaster.publish({symbols[0]: 0})
+    publish = sorted(p for p, _ in latencies)
+    delivered = sorted(d for _, d in latencies)
+    print(f"{args.ticks} ticks of {args.symbols} symbols to {args.subscribers} subscribers")
+    print(f"  publish (encode once + queue): median {publish[len(publish) // 2] * 1000:.1f} ms")
+    print(f"  delivered to every consumer:   median {delivered[len(delivered) // 2] * 1000:.1f} ms, max {delivered[-1] * 1000:.1f} ms")
+    print(f"{args.clients} clients need {math.ceil(args.clients / ceiling)} workers of {ceiling} streams each")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+
+""" quote_server.py
+Local stand-in for the FMP quote API, for benchmarks and offline development.
+
+- Serves GET /api/v3/quote/AAPL,MSFT,... in the FMP response format.
+- Prices come from stocks_table_exp.csv, or move with each request under --simulate using
+  the same per symbol drift and volatility as the simulated market (model/market_parameters.py).
+- Injects latency (--latency, --jitter), random 500 errors (--error-rate) and 429 responses
+  once more than --rate-limit requests arrive within a minute.
+- Uses a fixed --seed so runs are reproducible: every symbol moves on its own generator in whole
+  --tick steps, so its prices do not depend on which request thread got there first.
+
+Usage: Run from the terminal as such:
+
+Goto the scripts directory:
+> cd scripts; ./quote_server.py --port 8099 --latency 50 --error-rate 0.05 --rate-limit 300
+
+Or run from the root of the project:
+> scripts/quote_server.py --simulate
+
+Then point the app at it and benchmark a full refresh:
+> export QUOTE_BASE_URL=http://127.0.0.1:8099/api/v3/quote
+> flask custom refresh_prices
+
+"""
+import argparse
+import collections
+import csv
+import json
+import math
+import os
+import random
+import sys
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+# Add the directory containing main.py to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from model.constants import STOCKS_CSV
+from model.market_parameters import TRADING_YEAR, load_parameters
+
+QUOTE_PATH = '/api/v3/quote/'
+
+
+class QuoteBook:
+    """
+    Prices served by the stand-in, optionally moving with geometric Brownian motion.
+
+    Time advances in whole ticks of wall time. A quoted symbol catches up on the ticks since it was
+    last quoted with one draw from its own generator, seeded from --seed and the symbol, which is
+    exact for GBM; the lock keeps concurrent requests from advancing a symbol twice.
+    """
+    def __init__(self, path, simulate, time_scale, tick, seed):
+        self.simulate = simulate
+        self.tick = tick
+        self.dt = tick * time_scale / TRADING_YEAR
+        self.lock = threading.Lock()
+        self.companies = {}
+        self.prices = {}
+        with open(path, newline='') as f:
+            for row in csv.DictReader(f):
+                self.companies[row['_symbol']] = row['_company']
+                self.prices[row['_symbol']] = float(row['_sheesh'])
+        self.parameters = load_parameters(path) if simulate else {}
+        self.randoms = {symbol: random.Random(seed ^ zlib.crc32(symbol.encode())) for symbol in self.parameters}
+        self.ticks = dict.fromkeys(self.parameters, 0)
+        self.started = time.monotonic()
+
+    def _advance(self, symbol, tick):
+        steps = tick - self.ticks[symbol]
+        if steps <= 0:
+            return
+        self.ticks[symbol] = tick
+        drift, volatility = self.parameters[symbol]
+        dt = steps * self.dt
+        shock = self.randoms[symbol].gauss(0, 1)
+        self.prices[symbol] *= math.exp((drift - 0.5 * volatility ** 2) * dt + volatility * math.sqrt(dt) * shock)
+
+    def quotes(self, symbols):
+        symbols = [symbol for symbol in symbols if symbol in self.prices]
+        with self.lock:
+            if self.simulate:
+                tick = int((time.monotonic() - self.started) / self.tick)
+                for symbol in symbols:
+                    if symbol in self.parameters:
+                        self._advance(symbol, tick)
+            timestamp = int(time.time())
+            return [
+                {"symbol": symbol, "name": self.companies[symbol], "price": round(self.prices[symbol], 2),
+                 "exchange": "NASDAQ", "timestamp": timestamp}
+                for symbol in symbols
+            ]
+
+
+class Faults:
+    """Injected latency and errors, drawn from one seeded generator under a lock."""
+    def __init__(self, latency, jitter, error_rate, seed):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def draw(self):
+        """Returns the milliseconds to delay a response and whether to fail it."""
+        with self.lock:
+            delay = self.latency + (self.random.uniform(0, self.jitter) if self.jitter else 0)
+            failed = bool(self.error_rate) and self.random.random() < self.error_rate
+        return delay, failed
+
+
+class RateLimiter:
+    """Sliding one minute window of request times, a limit of 0 allows everything."""
+    def __init__(self, per_minute):
+        self.per_minute = per_minute
+        self.requests = collections.deque()
+        self.lock = threading.Lock()
+
+    def retry_after(self):
+        """Returns 0 when the request is allowed, else the seconds until the window has room."""
+        if not self.per_minute:
+            return 0
+        now = time.monotonic()
+        with self.lock:
+            while self.requests and now - self.requests[0] >= 60:
+                self.requests.popleft()
+            if len(self.requests) >= self.per_minute:
+                return max(1, math.ceil(60 - (now - self.requests[0])))
+            self.requests.append(now)
+            return 0
+
+
+def make_handler(book, limiter, faults, args, stats):
+    class QuoteHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def _send(self, status, payload, headers=None):
+            body = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            path = urlparse(self.path).path
+            if not path.startswith(QUOTE_PATH):
+                return self._send(404, {"Error Message": "Unknown endpoint"})
+            retry_after = limiter.retry_after()
+            if retry_after:
+                stats[429] += 1
+                return self._send(429, {"Error Message": "Limit Reach"}, {'Retry-After': str(retry_after)})
+            delay, failed = faults.draw()
+            if delay:
+                time.sleep(delay / 1000.0)
+            if failed:
+                stats[500] += 1
+                return self._send(500, {"Error Message": "Injected error"})
+            symbols = [symbol for symbol in path[len(QUOTE_PATH):].split(',') if symbol]
+            stats[200] += 1
+            self._send(200, book.quotes(symbols))
+
+        def log_message(self, format, *log_args):
+            if args.verbose:
+                super().log_message(format, *log_args)
+
+    return QuoteHandler
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local stand-in for the FMP quote API')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8099)
+    parser.add_argument('--csv', default=STOCKS_CSV, help='Stock table seed file with _symbol, _company and _sheesh')
+    parser.add_argument('--simulate', action='store_true', help='Move prices between requests')
+    parser.add_argument('--time-scale', type=float, default=60, help='Simulated market seconds per wall second')
+    parser.add_argument('--tick', type=float, default=1, help='Wall seconds per price step under --simulate')
+    parser.add_argument('--latency', type=float, default=0, help='Milliseconds added to every response')
+    parser.add_argument('--jitter', type=float, default=0, help='Random extra milliseconds, up to this value')
+    parser.add_argument('--error-rate', type=float, default=0, help='Fraction of requests answered with a 500')
+    parser.add_argument('--rate-limit', type=int, default=0, help='Requests per minute before 429s, 0 for no limit')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--verbose', action='store_true', help='Log every request')
+    args = parser.parse_args()
+
+    book = QuoteBook(args.csv, args.simulate, args.time_scale, args.tick, args.seed)
+    faults = Faults(args.latency, args.jitter, args.error_rate, args.seed)
+    stats = collections.Counter()
+    server = ThreadingHTTPServer((args.host, args.port),
+                                 make_handler(book, RateLimiter(args.rate_limit), faults, args, stats))
+    print(f"Serving {len(book.prices)} symbols on http://{args.host}:{args.port}{QUOTE_PATH.rstrip('/')}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(f"Responses: {dict(stats)}")
+
+
+if __name__ == "__main__":
+    main()
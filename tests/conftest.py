@@ -0,0 +1,106 @@
+""" Shared fixtures: the app on a throwaway SQLite database, seeded users and an authenticated client """
+import os
+import sys
+import tempfile
+
+import jwt
+import pytest
+from sqlalchemy import event
+
+# a fresh database and a cheap hash, set before the app reads its configuration
+_DB_DIR = tempfile.mkdtemp(prefix='flask_tests_')
+os.environ['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{os.path.join(_DB_DIR, 'test.db')}"
+os.environ['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256:1'
+os.environ['PASSWORD_HASH_WORKERS'] = '0'
+os.environ['CACHE_VERSION_CHECK_INTERVAL'] = '0'
+os.environ['PRICE_SCHEDULER_ENABLED'] = 'false'
+
+# Add the directory containing main.py to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from main import app as flask_app
+from __init__ import db
+from model.cache import bump_version
+from model.kasm import KasmUser
+from model.orders import execute_buy
+from model.stocks import StockUser, TableStock, price_snapshot
+from model.user import Section, User, UserSection
+
+
+@pytest.fixture(scope='session')
+def app():
+    with flask_app.app_context():
+        db.create_all()
+    yield flask_app
+
+
+@pytest.fixture
+def seed_users(app):
+    """Returns seed(n), which replaces every user with an admin and n users enrolled in two sections each."""
+    def seed(n):
+        with app.app_context():
+            db.session.query(UserSection).delete()
+            db.session.query(User).delete()
+            db.session.query(Section).delete()
+            sections = [Section('Computer Science A', 'CSA'), Section('Computer Science Principles', 'CSP'),
+                        Section('Robotics', 'ROB')]
+            db.session.add_all(sections)
+            db.session.add(User(name='Admin', uid='admin', role='Admin'))
+            for i in range(n):
+                user = User(name=f'Student {i}', uid=f'student{i:04d}', kasm_server_needed=i % 2 == 0)
+                user.sections.extend([sections[i % 3], sections[(i + 1) % 3]])
+                db.session.add(user)
+            # the seed writes users and sections, as their create() methods do
+            bump_version(User.VERSION_NAME)
+            bump_version(Section.VERSION_NAME)
+            db.session.commit()
+    return seed
+
+
+@pytest.fixture
+def trader(app, seed_users, monkeypatch):
+    """A seeded student with a stock account holding 5 shares of the TEST stock, the only open account."""
+    monkeypatch.setattr(KasmUser, 'delete', lambda self, uid: None)
+    with app.app_context():
+        # earlier accounts are closed through the ledger, so the ledger still reconciles
+        for account in StockUser.query.all():
+            account.close()
+        db.session.commit()
+    seed_users(1)
+    with app.app_context():
+        if TableStock.query.filter_by(_symbol='TEST').first() is None:
+            TableStock('TEST', 'Test Corp', 1000, 10).create()
+        price_snapshot.reload()
+        User.query.filter_by(_uid='student0000').first().add_stockuser()
+        _, status = execute_buy('student0000', 'TEST', 5)
+        assert status == 200
+    return 'student0000'
+
+
+@pytest.fixture
+def admin_client(app):
+    """A test client holding the JWT cookie of the seeded admin."""
+    client = app.test_client()
+    token = jwt.encode({"_uid": 'admin'}, app.config['SECRET_KEY'], algorithm="HS256")
+    client.set_cookie(app.config['JWT_TOKEN_NAME'], token)
+    return client
+
+
+@pytest.fixture
+def count_statements(app):
+    """Returns count(function), which runs function() and returns how many SQL statements it executed, BEGIN aside."""
+    def count(function):
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            if statement.strip().upper() != 'BEGIN':
+                statements.append(statement)
+
+        with app.app_context():
+            engine = db.engine
+            event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+            try:
+                function()
+            finally:
+                event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+        return len(statements)
+    return count
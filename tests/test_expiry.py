@@ -0,0 +1,21 @@
+""" Expired accounts stay liquidated through a rebuild of lots and holdings """
+from datetime import date, timedelta
+
+from __init__ import db
+from model import ledger
+from model.expiry import expire_accounts
+from model.stocks import StockHolding, StockLot, StockUser
+
+
+def test_rebuild_keeps_expired_positions_closed(app, trader):
+    with app.app_context():
+        result = expire_accounts(date.today() + timedelta(weeks=app.config['ACCOUNT_EXPIRY_WEEKS'] + 1))
+        assert result["expired"] == 1 and result["positions"] == 1
+        userid = StockUser.query.filter_by(_uid=trader).first().id
+
+        StockLot.rebuild()
+        StockHolding.rebuild()
+
+        assert StockHolding.query.filter_by(_user_id=userid).count() == 0
+        assert StockLot.query.filter_by(_user_id=userid, _open=True).count() == 0
+        assert ledger.reconcile()["mismatch_count"] == 0
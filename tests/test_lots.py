@@ -0,0 +1,55 @@
+""" Rebuilding tax lots and holdings from the transaction log keeps the lots each sell consumed """
+from __init__ import db
+from model import ledger
+from model.orders import execute_buy, execute_sell
+from model.stocks import StockHolding, StockLot, StockLotSale, StockUser, TableStock
+
+
+def _reprice(symbol, price):
+    TableStock.query.filter_by(_symbol=symbol).first()._sheesh = price
+    db.session.commit()
+
+
+def _holding(userid):
+    holding = StockHolding.query.filter_by(_user_id=userid).one()
+    return holding._quantity, round(holding._cost_basis, 4), holding._lot_count
+
+
+def test_rebuild_replays_specific_lot_sells(app, trader):
+    with app.app_context():
+        userid = StockUser.query.filter_by(_uid=trader).first().id
+        _reprice('TEST', 20)
+        fill, status = execute_buy(trader, 'TEST', 5)
+        assert status == 200
+        # sell 3 shares of the newer, dearer lot, FIFO would take the first lot
+        fill, status = execute_sell(trader, 'TEST', None, lots=[{"id": fill["lot_id"], "quantity": 3}])
+        assert status == 200, fill
+        _reprice('TEST', 10)
+        before = _holding(userid)
+        sales = StockLotSale.query.count()
+        assert before == (7, 5 * 10 + 2 * 20, 2)
+
+        StockLot.rebuild()
+        StockHolding.rebuild()
+
+        assert _holding(userid) == before
+        assert StockLotSale.query.count() == sales
+        assert ledger.reconcile()["mismatch_count"] == 0
+
+
+def test_rebuild_replays_fifo_sells(app, trader):
+    with app.app_context():
+        userid = StockUser.query.filter_by(_uid=trader).first().id
+        _reprice('TEST', 20)
+        execute_buy(trader, 'TEST', 5)
+        fill, status = execute_sell(trader, 'TEST', 6)
+        assert status == 200, fill
+        _reprice('TEST', 10)
+        before = _holding(userid)
+        assert before == (4, 4 * 20, 1)
+
+        StockLot.rebuild()
+        StockHolding.rebuild()
+
+        assert _holding(userid) == before
+        assert ledger.reconcile()["mismatch_count"] == 0
@@ -0,0 +1,33 @@
+""" Order endpoints trade only the logged in user's account """
+import jwt
+
+
+def _client(app, uid):
+    client = app.test_client()
+    client.set_cookie(app.config['JWT_TOKEN_NAME'], jwt.encode({"_uid": uid}, app.config['SECRET_KEY'], algorithm="HS256"))
+    return client
+
+
+def test_orders_and_sell_require_login(app, trader):
+    client = app.test_client()
+    order = {"uid": trader, "orders": [{"side": "sell", "symbol": "TEST", "quantity": 1}]}
+    assert client.post('/stock/orders', json=order).status_code == 401
+    assert client.post('/stock/sell', json={"uid": trader, "symbol": "TEST", "quantity": 1}).status_code == 401
+
+
+def test_orders_ignore_the_uid_in_the_body(app, trader):
+    # the admin has no stock account, naming the trader in the body must not reach the trader's shares
+    client = _client(app, 'admin')
+    response = client.post('/stock/sell', json={"uid": trader, "symbol": "TEST", "quantity": 1})
+    assert response.status_code == 404
+    response = _client(app, trader).post('/stock/orders', json={"orders": [{"side": "sell", "symbol": "TEST", "quantity": 1}]})
+    assert response.status_code == 200, response.get_json()
+
+
+def test_order_quantity_validation(app, trader):
+    client = _client(app, trader)
+    for quantity in (True, 0, -1, 1.5, 10**30, 2**63 - 1):
+        assert client.post('/stock/sell', json={"symbol": "TEST", "quantity": quantity}).status_code == 400, quantity
+        order = {"orders": [{"side": "buy", "symbol": "TEST", "quantity": quantity}]}
+        assert client.post('/stock/orders', json=order).status_code == 400, quantity
+    assert client.post('/stock/sell', json={"symbol": "TEST", "lots": [{"id": 1, "quantity": True}]}).status_code == 400
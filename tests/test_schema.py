@@ -0,0 +1,18 @@
+""" migrate_schema brings an existing database up to the models and is safe to rerun """
+from sqlalchemy import inspect, text
+
+from __init__ import db
+from model.schema import migrate_schema
+
+
+def test_migrate_schema_adds_missing_history_indexes(app):
+    names = ('ix_user_transaction_stocks_history', 'ix_user_transaction_stocks__transaction_time')
+    with app.app_context():
+        for name in names:
+            db.session.execute(text(f"DROP INDEX IF EXISTS {name}"))
+        db.session.commit()
+
+        assert set(names) <= set(migrate_schema())
+        assert migrate_schema() == []
+        indexes = {index['name'] for index in inspect(db.engine).get_indexes('user_transaction_stocks')}
+        assert set(names) <= indexes
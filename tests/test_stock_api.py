@@ -0,0 +1,20 @@
+""" Query validation of the stock search and price history endpoints """
+import jwt
+
+
+def test_search_limit_validation(app, trader):
+    client = app.test_client()
+    assert client.get('/stock/search?q=TE&limit=0').status_code == 400
+    assert client.get('/stock/search?q=TE&limit=-3').status_code == 400
+    assert client.get('/stock/search?q=TE&limit=5').status_code == 200
+
+
+def test_history_accepts_timezone_offsets(app, trader):
+    client = app.test_client()
+    client.set_cookie(app.config['JWT_TOKEN_NAME'], jwt.encode({"_uid": trader}, app.config['SECRET_KEY'], algorithm="HS256"))
+    query = '/stock/history/TEST?resolution=1h&start=2024-07-01T00:00:00%2B02:00&end=2024-07-02T00:00:00Z'
+    response = client.get(query)
+    assert response.status_code == 200, response.get_json()
+    # mixing an aware and a naive bound compares as UTC too
+    assert client.get('/stock/history/TEST?resolution=1h&start=2024-07-01T00:00:00-05:00&end=2024-07-02T00:00:00').status_code == 200
+    assert client.get('/stock/history/TEST?resolution=1h&start=2024-07-02T03:00:00%2B02:00&end=2024-07-02T00:00:00').status_code == 400
@@ -0,0 +1,24 @@
+""" Deleting a user closes its stock account in the trade ledger """
+from __init__ import db
+from model import ledger
+from model.events import TradeEvent, last_event_id
+from model.stocks import StockHolding, StockUser, TableStock
+from model.user import User
+
+
+def test_delete_closes_the_account_in_the_ledger(app, trader):
+    with app.app_context():
+        userid = StockUser.query.filter_by(_uid=trader).first().id
+        mark = last_event_id()
+        User.query.filter_by(_uid=trader).first().delete()
+
+        assert User.query.filter_by(_uid=trader).first() is None
+        assert db.session.get(StockUser, userid) is None
+        assert StockHolding.query.filter_by(_user_id=userid).count() == 0
+        # the shares are back in the inventory and the ledger ends the account at zero
+        assert TableStock.query.filter_by(_symbol='TEST').first()._quantity == 1000
+        kinds = [kind for kind, in db.session.query(TradeEvent._kind).filter(TradeEvent.id > mark)]
+        assert kinds == ['close', 'close']
+        state = ledger.load_state()
+        assert state.cash[userid] == 0
+        assert userid not in {user_id for user_id, _ in state.open_holdings()}
@@ -0,0 +1,82 @@
+""" GET /api/user listing: constant query count, cursor pages, limit and field projection """
+import pytest
+
+from model.user import User
+
+
+def _list(client, query=''):
+    response = client.get(f'/api/user{query}')
+    assert response.status_code == 200, response.get_data(as_text=True)
+    return response.get_json(), response.headers.get('X-Next-Cursor')
+
+
+@pytest.mark.parametrize('fields', [None, ['uid', 'name', 'sections']])
+def test_listing_query_count_is_constant_in_users(seed_users, count_statements, fields):
+    counts = {}
+    for n in (5, 60):
+        seed_users(n)
+        counts[n] = count_statements(lambda: User.listing(fields=fields))
+    # one query for the users and one for the sections of the page, however many users
+    assert counts[5] == counts[60] == 2
+
+
+def test_listing_without_sections_is_one_query(seed_users, count_statements):
+    seed_users(20)
+    assert count_statements(lambda: User.listing(fields=['uid', 'name'])) == 1
+
+
+def test_listing_returns_sections(seed_users, app):
+    seed_users(3)
+    with app.app_context():
+        users, next_cursor = User.listing(fields=['uid', 'sections'])
+    assert next_cursor is None
+    student = next(user for user in users if user['uid'] == 'student0000')
+    assert sorted(section['abbreviation'] for section in student['sections']) == ['CSA', 'CSP']
+    assert set(student) == {'uid', 'sections'}
+
+
+def test_cursor_pages_cover_every_user_once(seed_users, admin_client):
+    seed_users(7)
+    everyone, next_cursor = _list(admin_client)
+    assert next_cursor is None
+    assert len(everyone) == 8
+
+    pages, cursor = [], None
+    while True:
+        page, cursor = _list(admin_client, f'?limit=3' + (f'&cursor={cursor}' if cursor else ''))
+        assert len(page) <= 3
+        pages.append(page)
+        if cursor is None:
+            break
+    assert [len(page) for page in pages] == [3, 3, 2]
+    assert [user['uid'] for page in pages for user in page] == [user['uid'] for user in everyone]
+
+
+def test_limit_and_cursor_validation(seed_users, admin_client):
+    seed_users(2)
+    assert admin_client.get('/api/user?limit=0').status_code == 400
+    assert admin_client.get('/api/user?limit=abc').status_code == 400
+    assert admin_client.get('/api/user?cursor=abc').status_code == 400
+
+
+def test_fields_projection(seed_users, admin_client):
+    seed_users(4)
+    users, _ = _list(admin_client, '?fields=uid,name')
+    assert users and all(set(user) == {'uid', 'name'} for user in users)
+
+    users, _ = _list(admin_client, '?fields=uid,access')
+    assert all(set(user) == {'uid', 'access'} for user in users)
+    assert all(user['access'] == ['rw'] for user in users)
+
+    assert admin_client.get('/api/user?fields=uid,password').status_code == 400
+
+
+def test_filters(seed_users, admin_client):
+    seed_users(6)
+    users, _ = _list(admin_client, '?section=ROB&fields=uid')
+    # students 1, 2, 4 and 5 take ROB
+    assert [user['uid'] for user in users] == ['student0001', 'student0002', 'student0004', 'student0005']
+    users, _ = _list(admin_client, '?role=Admin&fields=uid')
+    assert [user['uid'] for user in users] == ['admin']
+    users, _ = _list(admin_client, '?kasm_server_needed=true&fields=uid')
+    assert [user['uid'] for user in users] == ['student0000', 'student0002', 'student0004']